@@ -0,0 +1,176 @@
+'''
+An explicit relevance engine for the sequential CNN encoders, the VGG features and the ResNet with the Add/Flatten
+modules. It gives the same relevance as the hook based lrp_wrapper.compute_lrp with the SequentialPresetA rules, but
+the forward pass only keeps the inputs of the layers whose rule needs them, and the relevance is propagated layer by
+layer under no_grad. A single sample can be explained for a stack of targets, the activations of the sample are
+broadcast against the relevance of every target.
+'''
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import LRPtools.utils as util
+from . import lrp_modules
+from . import lrp_wrapper
+import models.resnet as resnet
+
+
+def get_layers(model):
+    '''
+    flattens the encoder into the list of layers in the order of the forward pass, a residual block is kept as one layer
+    '''
+    if isinstance(model, nn.Sequential):
+        layers = []
+        for module in model:
+            layers += get_layers(module)
+        return layers
+    if isinstance(model, resnet.ResNet):
+        # the same layers as ResNet._forward_impl, the avgpool and the fc are not part of the encoder
+        return [model.conv1, model.bn1, model.relu, model.maxpool] + get_layers(model.layer1) + \
+               get_layers(model.layer2) + get_layers(model.layer3) + get_layers(model.layer4)
+    return [model]
+
+
+def residual_branches(block):
+    if isinstance(block, resnet.Bottleneck):
+        main = [block.conv1, block.bn1, block.relu, block.conv2, block.bn2, block.relu, block.conv3, block.bn3]
+    else:
+        main = [block.conv1, block.bn1, block.relu, block.conv2, block.bn2]
+    shortcut = get_layers(block.downsample) if block.downsample is not None else []
+    return main, shortcut
+
+
+def forward_layers(layers, x):
+    '''
+    :return: the output and the saved inputs, None for the layers that do not need their input
+    '''
+    saved = []
+    for layer in layers:
+        if isinstance(layer, (resnet.Bottleneck, resnet.BasicBlock)):
+            main, shortcut = residual_branches(layer)
+            main_out, main_saved = forward_layers(main, x)
+            shortcut_out, shortcut_saved = forward_layers(shortcut, x)
+            saved.append((main_out, shortcut_out, main_saved, shortcut_saved))
+            x = layer.relu(main_out + shortcut_out)
+        elif isinstance(layer, (nn.ReLU, nn.Dropout, nn.Dropout2d, nn.Identity)):
+            # the identity rule does not need the input, nn.Identity is a folded BatchNorm
+            saved.append(None)
+            x = layer(x)
+        else:
+            saved.append(x)
+            x = layer(x)
+    return x, saved
+
+
+def relevance_layers(layers, saved, relevance, lrp_params):
+    for layer, x in zip(layers[::-1], saved[::-1]):
+        relevance = relevance_layer(layer, x, relevance, lrp_params)
+    return relevance
+
+
+def relevance_layer(layer, x, relevance, lrp_params):
+    if isinstance(layer, (resnet.Bottleneck, resnet.BasicBlock)):
+        main_out, shortcut_out, main_saved, shortcut_saved = x
+        main, shortcut = residual_branches(layer)
+        # the relu after the addition passes the relevance
+        r_main, r_shortcut = relevance_add(main_out, shortcut_out, relevance)
+        return relevance_layers(main, main_saved, r_main, lrp_params) + \
+               relevance_layers(shortcut, shortcut_saved, r_shortcut, lrp_params)
+    if isinstance(layer, (nn.ReLU, nn.Dropout, nn.Dropout2d, nn.Identity)):
+        return relevance
+    if isinstance(layer, nn.Conv2d):
+        return relevance_conv(layer, x, relevance, lrp_params)
+    if isinstance(layer, nn.MaxPool2d):
+        return relevance_maxpool(layer, x, relevance)
+    if isinstance(layer, nn.AvgPool2d):
+        return relevance_avgpool(layer, x, relevance)
+    if isinstance(layer, nn.BatchNorm2d):
+        return relevance_batchnorm(layer, x, relevance)
+    if isinstance(layer, resnet.Flatten):
+        return relevance.view(relevance.size(0), *x.size()[1:])
+    raise ValueError("Layer type {} not known.".format(type(layer)))
+
+
+def relevance_conv(layer, x, relevance, lrp_params):
+    '''
+    the alpha-beta rule of lrp_modules.Conv2d, the gradient of the convolution is computed explicitly
+    '''
+    if not hasattr(layer, 'lrp_weight'):
+        lrp_modules.Conv2d.prepare(layer, lrp_params.get("ignore_bias", True))
+    input_size = (relevance.size(0),) + x.size()[1:]
+    r_in = torch.zeros(input_size, device=relevance.device, dtype=relevance.dtype)
+    for rule, coefficient in [('pos', lrp_params["alpha"]), ('neg', -lrp_params["beta"])]:
+        if coefficient == 0:
+            continue
+        # the first half of the weight sees x+, the second half sees x-
+        weight_a, weight_b = layer.lrp_weight[rule].chunk(2, dim=0)
+        z = lrp_modules.Conv2d._fused_conv(layer, rule)(x)
+        s = util.safe_divide(relevance, z)
+        grad_a = torch.nn.grad.conv2d_input(input_size, weight_a, s, layer.stride, layer.padding, layer.dilation,
+                                            layer.groups)
+        grad_b = torch.nn.grad.conv2d_input(input_size, weight_b, s, layer.stride, layer.padding, layer.dilation,
+                                            layer.groups)
+        grad = torch.where(x > 0, grad_a, grad_b)
+        r_in = r_in + coefficient * x * grad
+    return r_in
+
+
+def relevance_maxpool(layer, x, relevance):
+    '''
+    the rule of lrp_modules.Pool2d, every window sends its relevance to its maximum
+    '''
+    z, indices = F.max_pool2d(x, layer.kernel_size, layer.stride, layer.padding, layer.dilation, layer.ceil_mode,
+                              return_indices=True)
+    s = util.safe_divide(relevance, z)
+    batch_size, channels = relevance.size()[:2]
+    grad = torch.zeros(batch_size, channels, x.size(-2) * x.size(-1), device=relevance.device, dtype=relevance.dtype)
+    grad.scatter_add_(2, indices.flatten(2).expand(batch_size, -1, -1), s.flatten(2))
+    return x * grad.view(batch_size, channels, x.size(-2), x.size(-1))
+
+
+def relevance_avgpool(layer, x, relevance):
+    with torch.enable_grad():
+        x = x.expand(relevance.size(0), *x.size()[1:]).clone().detach().requires_grad_(True)
+        z = layer(x)
+        z.backward(util.safe_divide(relevance, z))
+    return (x * x.grad).detach()
+
+
+def relevance_batchnorm(layer, x, relevance):
+    '''
+    the rule of lrp_modules.BatchNorm2d
+    '''
+    std = torch.sqrt(layer.running_var + layer.eps)
+    w = (layer.weight / std)[:, None, None]
+    b = (layer.bias - layer.running_mean * layer.weight / std)[:, None, None]
+    xw = torch.abs(x * w)
+    return util.safe_divide(xw, xw + torch.abs(b)) * relevance
+
+
+def relevance_add(input_1, input_2, relevance):
+    '''
+    the rule of lrp_modules.Add, the relevance is split in proportion to the two inputs, half and half when the sum is 0
+    '''
+    out = input_1 + input_2
+    zero = out == 0
+    out = out + util.EPSILON * out.sign()
+    out = out.masked_fill(zero, 1)
+    r_1 = torch.where(zero, 0.5 * relevance, relevance * input_1 / out)
+    r_2 = torch.where(zero, 0.5 * relevance, relevance * input_2 / out)
+    return r_1, r_2
+
+
+def compute_lrp(model, sample, target, lrp_params=None):
+    '''
+    :param model: the encoder, an nn.Sequential or a resnet.ResNet
+    :param sample: the input image (1, C, H, W) or (n, C, H, W)
+    :param target: the relevance of the output (n, fea_dim, h, w)
+    :param lrp_params: the parameters of the rules, SequentialPresetA by default
+    :return: the relevance of the input (n, C, H, W)
+    '''
+    if lrp_params is None:
+        lrp_params = lrp_wrapper.SequentialPresetA().lrp_params
+    layers = get_layers(model)
+    with torch.no_grad():
+        _, saved = forward_layers(layers, sample)
+        relevance = relevance_layers(layers, saved, target.to(sample.dtype), lrp_params)
+    return relevance
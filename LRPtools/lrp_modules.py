@@ -53,73 +53,37 @@ class ReLU:
             assert not torch.isinf(R.sum())
             return (R,)
 
-class PosNetConv(nn.Module):
-
-    def _clone_module(self, module):
-        clone = nn.Conv2d(module.in_channels, module.out_channels, module.kernel_size,
-                          **{attr: getattr(module, attr) for attr in ['stride', 'padding', 'dilation', 'groups']})
-        return clone.to(module.weight.device)
-
-    def __init__(self, conv, ignorebias):
-        super(PosNetConv, self).__init__()
-
-        self.posconv = self._clone_module(conv)
-        self.posconv.weight = torch.nn.Parameter(conv.weight.data.clone().clamp(min=0),requires_grad=False)
-
-        self.negconv = self._clone_module(conv)
-        self.negconv.weight = torch.nn.Parameter(conv.weight.data.clone().clamp(max=0),requires_grad=False)
-
-        if ignorebias == True:
-            self.posconv.bias = None
-            self.negconv.bias = None
-        else:
-            if conv.bias is not None:
-                self.posconv.bias = torch.nn.Parameter(conv.bias.data.clone().clamp(min=0),requires_grad=False)
-                self.negconv.bias = torch.nn.Parameter(conv.bias.data.clone().clamp(max=0),requires_grad=False)
-
-
-    def forward(self, x):
-        vp = self.posconv(torch.clamp(x, min=0))
-        vn = self.negconv(torch.clamp(x, max=0))
-        return vp + vn
-
-class NegNetConv(nn.Module):
-
-    def _clone_module(self, module):
-        clone = nn.Conv2d(module.in_channels, module.out_channels, module.kernel_size,
-                          **{attr: getattr(module, attr) for attr in ['stride', 'padding', 'dilation', 'groups']})
-        return clone.to(module.weight.device)
-
-    def __init__(self, conv, ignorebias):
-        super(NegNetConv, self).__init__()
-
-        self.posconv = self._clone_module(conv)
-        self.posconv.weight = torch.nn.Parameter(conv.weight.data.clone().clamp(min=0),requires_grad=False)
-
-        self.negconv = self._clone_module(conv)
-        self.negconv.weight = torch.nn.Parameter(conv.weight.data.clone().clamp(max=0),requires_grad=False)
-
-        if ignorebias == True:
-            self.posconv.bias = None
-            self.negconv.bias = None
-        else:
-            if conv.bias is not None:
-                self.posconv.bias = torch.nn.Parameter(conv.bias.data.clone().clamp(min=0),requires_grad=False)
-                self.negconv.bias = torch.nn.Parameter(conv.bias.data.clone().clamp(max=0),requires_grad=False)
-
-
-    def forward(self, x):
-        vp = self.posconv(torch.clamp(x, max=0))
-        vn = self.negconv(torch.clamp(x, min=0))
-        return vp + vn
-
 class Conv2d:
-    #@profile()
-    def _clone_module(self, module):
+    @staticmethod
+    def prepare(module, ignore_bias):
+        """
+        Precomputes the clamped weights of the alpha-beta rule once per layer. For the positive rule
+        z = w+ * x+ + w- * x-, for the negative rule z = w- * x+ + w+ * x-. Each rule is a single grouped convolution
+        of [x+, x-] with the two weights stacked along the output channels, the two halves of the output are summed.
+        """
+        weight = module.weight.detach()
+        weight_pos, weight_neg = weight.clamp(min=0), weight.clamp(max=0)
+        module.lrp_weight = {'pos': torch.cat((weight_pos, weight_neg), dim=0),
+                             'neg': torch.cat((weight_neg, weight_pos), dim=0)}
+        if ignore_bias or module.bias is None:
+            module.lrp_bias = {'pos': None, 'neg': None}
+        else:
+            bias = module.bias.detach()
+            bias_pos, bias_neg = bias.clamp(min=0), bias.clamp(max=0)
+            module.lrp_bias = {'pos': torch.cat((bias_pos, bias_neg), dim=0),
+                               'neg': torch.cat((bias_neg, bias_pos), dim=0)}
+
+    @staticmethod
+    def _fused_conv(module, rule):
+        weight, bias = module.lrp_weight[rule], module.lrp_bias[rule]
+
+        def fused_conv(x):
+            x = torch.cat((x.clamp(min=0), x.clamp(max=0)), dim=1)
+            z = F.conv2d(x, weight, bias, module.stride, module.padding, module.dilation, 2 * module.groups)
+            z_1, z_2 = z.chunk(2, dim=1)
+            return z_1 + z_2
+        return fused_conv
 
-        clone = nn.Conv2d(module.in_channels, module.out_channels, module.kernel_size,
-                         **{attr: getattr(module, attr) for attr in ['stride', 'padding', 'dilation', 'groups']})
-        return clone.to(module.weight.device)
     #@profile()
     def propagate_relevance(self, module, relevance_input, relevance_output,
                             lrp_method, lrp_params=None):
@@ -127,27 +91,27 @@ class Conv2d:
         ignore_bias = lrp_params.get("ignore_bias", True)
         input_ = module.input[0]
         if lrp_method =="alpha_beta":
-            pnconv = PosNetConv(module, ignore_bias)
-            nnconv = NegNetConv(module, ignore_bias)
+            if not hasattr(module, 'lrp_weight'):
+                self.prepare(module, ignore_bias)
             with torch.enable_grad():
                 X = input_.clone().detach().requires_grad_(True)
-
+                R = torch.zeros_like(input_)
                 # Positive contribution
-                R_pos = lrp_params["alpha"] * (
-                        util.lrp_backward(_input=X, layer=pnconv, relevance_output=relevance_output[0])
-                )
-                # Clear gradients
-                X.grad.detach_()
-                X.grad.zero_()
-
-                # Negative contribution
-                R_neg = lrp_params["beta"] * (
-                    util.lrp_backward(_input=X, layer=nnconv, relevance_output=relevance_output[0])
-                )
-                R = R_pos - R_neg
-
-                del pnconv
-                del nnconv
+                if lrp_params["alpha"] != 0:
+                    R = R + lrp_params["alpha"] * (
+                        util.lrp_backward(_input=X, layer=self._fused_conv(module, 'pos'),
+                                          relevance_output=relevance_output[0])
+                    )
+                    # Clear gradients
+                    X.grad.detach_()
+                    X.grad.zero_()
+
+                # Negative contribution, skipped for the default beta = 0
+                if lrp_params["beta"] != 0:
+                    R = R - lrp_params["beta"] * (
+                        util.lrp_backward(_input=X, layer=self._fused_conv(module, 'neg'),
+                                          relevance_output=relevance_output[0])
+                    )
         else:
             raise NotImplementedError('Only adopt alpha 1 rule for conv layer')
         assert R.shape == input_.shape
@@ -161,12 +125,10 @@ class Conv2d:
                 assert relevance_input[2] is None
             else:
                 assert relevance_input[2].shape == module.bias.shape
-            torch.cuda.empty_cache()
             return R, relevance_input[1], relevance_input[2]
         elif len(relevance_input) == 2:
             assert relevance_input[0].shape == R.shape
             assert relevance_input[1].shape == module.weight.shape
-            torch.cuda.empty_cache()
             return R, relevance_input[1]
 
 class Pool2d:
@@ -0,0 +1,66 @@
+import torch
+from .utils import EPSILON
+
+
+def stabilize(forward_output, eps=EPSILON):
+    ''' adds eps with the sign of the output so that the denominator of the epsilon rule is never zero '''
+    forward_output_eps = forward_output + eps * forward_output.sign()  # Z.sign() returns -1 or 0 or 1
+    return forward_output_eps.masked_fill(forward_output_eps == 0, eps)
+
+
+def lrp_linear_eps(r_out, forward_input, forward_output, weight, eps=EPSILON):
+    '''
+    The epsilon rule for a linear layer, r_in_j = x_j * sum_i w_ij * r_out_i / (z_i + eps). The leading dims are batch
+    dims, e.g. all the pixels of an image can be explained in one call
+    :param r_out:  relevance of the output (..., out_feature)
+    :param forward_input: the input tensor (..., in_feature)
+    :param forward_output: the output tensor (..., out_feature), pass False to compute it from the input and the weight
+    :param weight:  weight tensor shape (out_feature, in_feature)
+    :param eps:
+    :return: r_in (..., in_feature)
+    '''
+    if type(forward_output) == bool:
+        forward_output = torch.matmul(forward_input, weight.transpose(0, 1))
+    relevance_input = forward_input * torch.matmul(r_out / stabilize(forward_output, eps), weight)  #(..., in_feature)
+    return relevance_input
+
+
+def lrp_elementwise_eps(r_out, forward_input, forward_output, eps=EPSILON):
+    '''
+    The epsilon rule for the additive and the gating nodes, e.g. c_t = f_t * c_{t-1} + i_t * g_t or h_t + context_t.
+    It gives the same result as lrp_linear_eps with an identity weight: every input element only contributes to the
+    output element at the same position, so the d x d attribution reduces to an elementwise ratio
+    :param r_out: relevance of the output (..., feature)
+    :param forward_input: the contribution of the input to the output (..., feature), e.g. f_t * c_{t-1}
+    :param forward_output: the output tensor (..., feature)
+    :param eps:
+    :return: r_in (..., feature)
+    '''
+    return forward_input * r_out / stabilize(forward_output, eps)
+
+
+def lrp_mha_eps(alpha, value, r_context, context, eps=EPSILON):
+    '''
+    The epsilon rule for the multi-head attention context_h = sum_k alpha_hk * value_hk, applied to all the heads and
+    all the pixels at once. Head h only sees the h-th d_k slice of the value. The leading dims of alpha are batch dims,
+    e.g. the attention of several decoding steps
+    :param alpha: attention weights (..., num_head, num_pixel)
+    :param value: (num_pixel, hidden_dim)
+    :param r_context: relevance of the context (..., hidden_dim), a single step also accepts (1, hidden_dim)
+    :param context: (..., hidden_dim), a single step also accepts (1, hidden_dim)
+    :param eps:
+    :return: the value relevance spread by every head (..., num_head, num_pixel, hidden_dim), zero outside the slice of
+             the head, and the head-summed value relevance (..., num_pixel, hidden_dim)
+    '''
+    batch_size = alpha.size()[:-2]
+    num_head, num_pixel = alpha.size()[-2:]
+    hidden_dim = value.size(-1)
+    d_k = hidden_dim // num_head
+    ratio = (r_context / stabilize(context, eps)).reshape(*batch_size, num_head, 1, d_k)  #(..., num_head, 1, d_k)
+    value = value.reshape(num_pixel, num_head, d_k).transpose(0, 1)  #(num_head, num_pixel, d_k)
+    r_value = value * alpha.unsqueeze(-1) * ratio  #(..., num_head, num_pixel, d_k)
+    r_value_sum = r_value.transpose(-3, -2).reshape(*batch_size, num_pixel, hidden_dim)  #(..., num_pixel, hidden_dim)
+    head_mask = torch.eye(num_head, device=value.device, dtype=value.dtype)
+    r_value_heads = torch.einsum('...hpd,hg->...hpgd', r_value, head_mask).reshape(*batch_size, num_head, num_pixel,
+                                                                                    hidden_dim)
+    return r_value_heads, r_value_sum
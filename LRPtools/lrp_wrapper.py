@@ -44,12 +44,18 @@ def add_lrp(model):
         # Take only the leaf modules
         num_modules = len(list(module.children()))
         if num_modules == 0:
+            if type(module) == nn.Identity:
+                # a folded BatchNorm, the output is the input tensor itself and needs no hook
+                continue
             if type(module) in[ nn.Linear] :
                 lrp_method_curr = 'epsilon'
             if type(module)  in [nn.BatchNorm2d, nn.BatchNorm1d,]:
                 lrp_method_curr = 'epsilon'
             if type(module) == nn.ReLU:
                 lrp_method_curr = 'identity'
+            if type(module) == nn.Conv2d:
+                # the clamped weights are computed once here instead of at every backward pass
+                lrp_modules.Conv2d.prepare(module, ignore_bias=preset.lrp_params["ignore_bias"])
             module.register_forward_hook(save_input_hook)
             module.register_backward_hook(
                 get_lrp_hook(lrp_method_curr, lrp_params=preset.lrp_params))
@@ -62,7 +68,11 @@ def add_lrp(model):
 # @profile()
 def compute_lrp(model, sample, target=None, return_output=False,
                 rectify_logits=False, explain_diff=False):
-    # target: list of class labels
+    # target: list of class labels, or the relevance of the output
+    # a single sample with a stack of targets (n, ...) is repeated n times, so that all the targets are propagated as a
+    # batch in one forward and one backward pass, output[i] is the relevance of target[i]
+    if torch.is_tensor(target) and sample.size(0) == 1 and target.size(0) > 1:
+        sample = sample.repeat(target.size(0), *[1] * (sample.dim() - 1))
     if sample.requires_grad==False:
         sample.requires_grad = True  # We need to compute LRP until input layer
     # sample.register_hook(get_tensor_hook)
@@ -40,6 +40,7 @@ def imgcap_adaptive_argument_parser():
 
     parser.add_argument('--finetune_encoder', type=bool, default=False)
     parser.add_argument('--cider_tune', type=bool, default=False)
+    parser.add_argument('--cider_df', type=str, default=None, help='the npz document frequency index of the cider rewards, ./dataset/cider_df_{dataset}.npz by default')
     parser.add_argument('--epochs_since_improvement', type=int, default=0)
     parser.add_argument('--ss_prob', type=float, default=0.2, help='the probability to use the model prediction during training instead of teacher force')
     # parser.add_argument('--stepsize', default=[60], nargs='+', type=int,
@@ -57,12 +58,16 @@ def imgcap_adaptive_argument_parser():
     # ************************************************************
     # Miscs
     # ************************************************************
+    parser.add_argument('--metric_workers', type=int, default=4, help='the processes that compute the caption metrics concurrently, 0 computes them one after another')
+    parser.add_argument('--metric_timeout', type=float, default=None, help='the seconds a caption metric may take, it is reported as nan after that')
     parser.add_argument('--save_path', type=str, default='./output/adaptive/')
     parser.add_argument('--print_freq', type=int, default=500)
     parser.add_argument('--eval', type=bool, default=False)
     parser.add_argument('--weight', type=str, default='', help='for evaluation')
     parser.add_argument('--resume', type=str, default='', metavar='PATH')
     parser.add_argument('--gpu-devices', default='0', type=str)
+    parser.add_argument('--device', type=str, default='cuda', help="the device to run on, 'cuda', 'cuda:1' or 'cpu'")
+    parser.add_argument('--num_threads', type=int, default=0, help='the number of intra-op threads on cpu, 0 keeps the torch default')
 
 
     return parser
@@ -108,6 +113,7 @@ def imgcap_gridTD_argument_parser():
     parser.add_argument('--finetune_encoder', type=bool, default=False)
     parser.add_argument('--epochs_since_improvement', type=int, default=0)
     parser.add_argument('--cider_tune', type=bool, default=False)
+    parser.add_argument('--cider_df', type=str, default=None, help='the npz document frequency index of the cider rewards, ./dataset/cider_df_{dataset}.npz by default')
     parser.add_argument('--lrp_tune', type=bool, default=False)
     parser.add_argument('--lrp_cider_tune',type=bool, default=False)
     parser.add_argument('--ss_prob', type=float, default=None, help='the probability to use the model prediction during training instead of teacher force')
@@ -126,12 +132,16 @@ def imgcap_gridTD_argument_parser():
     # ************************************************************
     # Miscs
     # ************************************************************
+    parser.add_argument('--metric_workers', type=int, default=4, help='the processes that compute the caption metrics concurrently, 0 computes them one after another')
+    parser.add_argument('--metric_timeout', type=float, default=None, help='the seconds a caption metric may take, it is reported as nan after that')
     parser.add_argument('--save_path', type=str, default='./output/gridTD/')
     parser.add_argument('--print_freq', type=int, default=500)
     parser.add_argument('--eval', type=bool, default=False)
     parser.add_argument('--weight', type=str, default='', help='for evaluation')
     parser.add_argument('--resume', type=str, default='', metavar='PATH')
     parser.add_argument('--gpu-devices', default='0', type=str)
+    parser.add_argument('--device', type=str, default='cuda', help="the device to run on, 'cuda', 'cuda:1' or 'cpu'")
+    parser.add_argument('--num_threads', type=int, default=0, help='the number of intra-op threads on cpu, 0 keeps the torch default')
 
     return parser
 
@@ -176,6 +186,7 @@ def imgcap_aoa_argument_parser():
     parser.add_argument('--finetune_encoder', type=bool, default=False)
     parser.add_argument('--epochs_since_improvement', type=int, default=0)
     parser.add_argument('--cider_tune', type=bool, default=False)
+    parser.add_argument('--cider_df', type=str, default=None, help='the npz document frequency index of the cider rewards, ./dataset/cider_df_{dataset}.npz by default')
     parser.add_argument('--lrp_tune', type=bool, default=False)
     parser.add_argument('--lrp_cider_tune',type=bool, default=False)
     parser.add_argument('--ss_prob', type=float, default=None, help='the probability to use the model prediction during training instead of teacher force')
@@ -191,11 +202,15 @@ def imgcap_aoa_argument_parser():
     # ************************************************************
     # Miscs
     # ************************************************************
+    parser.add_argument('--metric_workers', type=int, default=4, help='the processes that compute the caption metrics concurrently, 0 computes them one after another')
+    parser.add_argument('--metric_timeout', type=float, default=None, help='the seconds a caption metric may take, it is reported as nan after that')
     parser.add_argument('--save_path', type=str, default='./output/aoa/')
     parser.add_argument('--print_freq', type=int, default=500)
     parser.add_argument('--eval', type=bool, default=False)
     parser.add_argument('--weight', type=str, default='', help='for evaluation')
     parser.add_argument('--resume', type=str, default='', metavar='PATH')
     parser.add_argument('--gpu-devices', default='0', type=str)
+    parser.add_argument('--device', type=str, default='cuda', help="the device to run on, 'cuda', 'cuda:1' or 'cpu'")
+    parser.add_argument('--num_threads', type=int, default=0, help='the number of intra-op threads on cpu, 0 keeps the torch default')
 
     return parser
\ No newline at end of file
@@ -41,6 +41,52 @@ coco_frequent =['clock', 'kitchen', 'picture',  'water', 'food', 'pizza', 'grass
                 'bathroom',  'baseball', 'dog', 'room', 'cat', 'plate', 'train',  'field',  'tennis', 'person', 'table', 'street', 'woman',  'people',  'man'] # 25
 
 
+BBOX_THRESHOLDS = [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+
+def bbox_correctness(relevance_maps, boxes, box_map_idx, thresholds=BBOX_THRESHOLDS):
+    '''
+    The share of the relevance above a threshold that falls into a box, for all the boxes and thresholds at once. Every
+    map is sorted once, the suffix sums of the sorted relevance give the total and the in-box relevance above any
+    threshold
+    :param relevance_maps: (n_map, H, W), e.g. the maps of all the explained words of a caption
+    :param boxes: (n_box, 4) the boxes [x0, y0, x1, y1] in pixels
+    :param box_map_idx: (n_box,) the relevance map of every box
+    :param thresholds: scalars between [0,1], the pixels with relevance <= threshold are ignored
+    :return: (n_box, n_threshold) the scores, 0 when no relevance is above the threshold and at most 1
+    '''
+    n_map, h, w = relevance_maps.shape
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    box_map_idx = np.asarray(box_map_idx, dtype=np.int64)
+    thresholds = np.asarray(thresholds, dtype=relevance_maps.dtype)
+    relevance = relevance_maps.reshape(n_map, h * w)
+    order = np.argsort(relevance, axis=1, kind='stable')
+    sorted_relevance = np.take_along_axis(relevance, order, axis=1)  #(n_map, H*W) ascending
+    # the first sorted pixel above every threshold, H*W when there is none
+    first_above = np.stack([np.searchsorted(sorted_relevance[i], thresholds, side='right') for i in range(n_map)])
+    first_above = first_above[box_map_idx]  #(n_box, n_threshold)
+    # suffix sums with a trailing 0, entry k is the relevance of the sorted pixels k, k+1, ...
+    suffix_total = np.zeros((n_map, h * w + 1), dtype=np.float64)
+    suffix_total[:, :-1] = np.cumsum(sorted_relevance[:, ::-1], axis=1, dtype=np.float64)[:, ::-1]
+    total = np.take_along_axis(suffix_total[box_map_idx], first_above, axis=1)  #(n_box, n_threshold)
+    in_rows = (np.arange(h) >= boxes[:, 1:2]) & (np.arange(h) < boxes[:, 3:4])  #(n_box, H)
+    in_cols = (np.arange(w) >= boxes[:, 0:1]) & (np.arange(w) < boxes[:, 2:3])  #(n_box, W)
+    box_masks = (in_rows[:, :, None] & in_cols[:, None, :]).reshape(-1, h * w)
+    box_relevance = np.take_along_axis(box_masks, order[box_map_idx], axis=1) * sorted_relevance[box_map_idx]
+    suffix_box = np.zeros((box_relevance.shape[0], h * w + 1), dtype=np.float64)
+    suffix_box[:, :-1] = np.cumsum(box_relevance[:, ::-1], axis=1, dtype=np.float64)[:, ::-1]
+    correct = np.take_along_axis(suffix_box, first_above, axis=1)  #(n_box, n_threshold)
+    ratio = np.where(total == 0, 0., correct / np.where(total == 0, 1., total))
+    return np.minimum(ratio, 1.)
+
+
+def update_correctness(correctness, box_keys, scores, thresholds=BBOX_THRESHOLDS):
+    ''' keeps the best score over the boxes of a category, correctness[key][str(threshold)] '''
+    for key, box_scores in zip(box_keys, scores):
+        for threshold, score in zip(thresholds, box_scores):
+            correctness[key][str(threshold)] = max(correctness[key].get(str(threshold), 0), float(score))
+
+
 class EvaluationExperiments(object):
     def __init__(self, explainer):
         '''
@@ -54,31 +100,71 @@ class EvaluationExperiments(object):
         self.rev_word_map = {v: k for k, v in self.word_map.items()}
         self.num_delete_patches= 20
         self.patch_size = 8
+        self.ablation_batch_size = 16  # the masked images decoded together by the image ablation
     def block_image(self, relevance):
-        h, w = relevance.size()
+        '''
+        sets the num_delete_patches most relevant square patches to 0
+        :param relevance: (H, W) or a batch of relevance maps (n, H, W), on any device
+        :return: the mask (H, W) or (n, H, W) with the image device and dtype of the explainer
+        '''
+        single_map = relevance.dim() == 2
+        if single_map:
+            relevance = relevance.unsqueeze(0)
+        n, h, w = relevance.size()
         assert h % self.patch_size == 0
         assert w % self.patch_size == 0
-        relevance = relevance.detach().cpu().numpy()
-        # we generate a mask with square patches
+        # we split the maps into square patches
         n_patch_h = h // self.patch_size  #28
         n_patch_w = w // self.patch_size  #28
         assert self.num_delete_patches <= n_patch_h * n_patch_w
-        mask = np.arange(n_patch_h * n_patch_w)  # 28*28
-        mask = mask.repeat(self.patch_size)  # 28*28*8
-        mask = mask.reshape(n_patch_h, -1)  # (28, 28*8)
-        mask = mask.repeat([self.patch_size], axis=0)
-        patch_relevance = np.zeros(n_patch_h*n_patch_w)
-        for idx in range(n_patch_w * n_patch_h):
-            patch_relevance[idx] = np.sum(relevance[mask==idx])
-        top_k_idx = np.argpartition(-patch_relevance, self.num_delete_patches)[:self.num_delete_patches]
-        mask_return = np.ones_like(mask)
-        for idx in top_k_idx:
-            mask_return[mask==idx] = 0
-        plt.imshow(mask_return)
-        plt.show()
-        mask_return = torch.from_numpy(mask_return).float().cuda()
+        patch_relevance = relevance.detach().float().reshape(n, n_patch_h, self.patch_size, n_patch_w,
+                                                              self.patch_size).sum(dim=(2, 4))  #(n, 28, 28)
+        _, top_k_idx = torch.topk(patch_relevance.view(n, -1), self.num_delete_patches, dim=-1)
+        mask_patch = torch.ones(n, n_patch_h * n_patch_w, device=relevance.device, dtype=self.explainer.dtype)
+        mask_patch.scatter_(1, top_k_idx, 0)
+        mask_return = mask_patch.view(n, n_patch_h, 1, n_patch_w, 1).expand(n, n_patch_h, self.patch_size, n_patch_w,
+                                                                             self.patch_size).reshape(n, h, w)
+        mask_return = mask_return.to(self.explainer.device)
+        if single_map:
+            mask_return = mask_return[0]
         return mask_return
 
+    def image_ablation_batch(self, ablation_variants, ablation_maps):
+        '''
+        masks the image with the top patches of every relevance map and decodes all the masked images with
+        beam_search_batch, ablation_batch_size images at a time. If the target word is still predicted, its score is
+        computed with the teacher forcing of the new caption up to the word
+        :param ablation_variants: a list of (baseline, t, word_t, word_str, original_w_score), baseline is '' for the
+                                  explanation, '_random' or '_att'
+        :param ablation_maps: a list of the spatial relevance (H, W) of every variant
+        '''
+        image = self.explainer.img.detach().clone()  #(1, C, H, W)
+        masks = self.block_image(torch.stack(ablation_maps))  #(n, H, W)
+        images_modified = masks.unsqueeze(1) * image  #(n, C, H, W)
+        new_sentences = []
+        for i in range(0, images_modified.size(0), self.ablation_batch_size):
+            sentences, _ = self.explainer.model.beam_search_batch(images_modified[i: i + self.ablation_batch_size],
+                                                                  self.explainer.word_map)
+            new_sentences.extend(sentences)
+        for i, (baseline, t, word_t, word_str, original_w_score) in enumerate(ablation_variants):
+            new_words = new_sentences[i].split()
+            print(new_words)
+            if word_str in new_words:
+                new_idx = new_words.index(word_str)
+                beam_caption_img = ['<start>'] + new_words[:new_idx]
+                beam_caption_encoded_img = [self.word_map[w] for w in beam_caption_img]
+                new_predicted_scores = self.explainer.teacherforce_forward(images_modified[i: i + 1],
+                                                                           beam_caption_encoded_img)
+                assert new_predicted_scores.size(0) == new_idx + 1
+                new_w_img_score = torch.softmax(new_predicted_scores[-1], dim=-1)[word_t]
+                diff_img = original_w_score - new_w_img_score
+                getattr(self, 'image_category_score_diff' + baseline).append([str(t), word_str, diff_img.item()])
+                print(word_t, word_str, t)
+                print('img_diff' + baseline, diff_img.item(), original_w_score, new_w_img_score)
+            else:
+                getattr(self, 'image_disappear_count' + baseline).append([str(t), word_str])
+                print('img_disappear' + baseline, getattr(self, 'image_disappear_count' + baseline))
+
     def ablation_experiment(self,  data, explanation_type,  save_path_ablation, do_attention=False):
         '''
         words ablation:For words with index larger than 6, we first explain the target word and delete the top-3 relevant words
@@ -111,6 +197,9 @@ class EvaluationExperiments(object):
         sentence_length = len(beam_caption_encoded) - 1  # the first element of beam_caption-encoded is <start>
         # print(sentence_length)
         assert len(relevance_imgs) == sentence_length
+        # the image ablation variants, (baseline, t, word_t, word_str, original_w_score), and their spatial relevance
+        ablation_variants = []
+        ablation_maps = []
         '''============ablation==================='''
         with torch.no_grad():
             for t in range(sentence_length):
@@ -118,9 +207,8 @@ class EvaluationExperiments(object):
                 word_str = self.rev_word_map[word_t]
                 single_key_flag = word_str in object_words_list or word_str.rstrip('s') in object_words_list or word_str.rstrip('es') in object_words_list or word_str.rstrip('ies') + 'y'in object_words_list
                 if t>=1 and single_key_flag:
-                    # here we perform the image ablation experiment
+                    # here we collect the masked images of the image ablation experiment, they are decoded together
                     original_w_score = torch.softmax(predicted_scores[t], dim=-1)[word_t]
-                    image = self.explainer.img.detach().clone()
                     relevance_img = relevance_imgs[t].clone()  # (1,C, H, W)
                     if relevance_img.dim() == 2:
                         cam_size = int(np.sqrt(relevance_img.shape[-1]))
@@ -129,74 +217,19 @@ class EvaluationExperiments(object):
                         relevance_img = skimage.transform.pyramid_expand(relevance_img.detach().cpu().numpy(),
                                                                          upscale=scale,
                                                                          multichannel=False)
-                        spatial_relevance = torch.from_numpy(relevance_img).cuda()
+                        spatial_relevance = torch.from_numpy(relevance_img).to(self.explainer.device)
                     else:
                         spatial_relevance = torch.mean(relevance_img, dim=(0, 1))  # (H,W)
-                    mask = self.block_image(spatial_relevance)
-                    image_modified = mask * image
-                    # plt.imshow(image_modified.permute(0,2,3,1).detach().cpu().numpy()[0])
-                    # plt.show()
-                    new_sentence, _ = self.explainer.model.beam_search(image_modified,self.explainer.word_map)
-                    new_words = new_sentence[0].split()
-                    print(new_words)
-                    if word_str in new_words:
-                        new_idx = new_words.index(word_str)
-                        beam_caption_img = ['<start>']+new_words[:new_idx]
-                        beam_caption_encoded_img = [self.word_map[w] for w in beam_caption_img]
-                        # print(beam_caption_encoded_img)
-                        new_predicted_scores = self.explainer.teacherforce_forward(image_modified, beam_caption_encoded_img)
-                        assert new_predicted_scores.size(0) == new_idx + 1
-                        new_w_img_score = torch.softmax(new_predicted_scores[-1], dim=-1)[word_t]
-                        diff_img = original_w_score - new_w_img_score
-                        self.image_category_score_diff.append([str(t), word_str, diff_img.item()])
-                        print(word_t, word_str, t)
-                        print('img_diff', diff_img.item(), original_w_score, new_w_img_score)
-                    else:
-                        self.image_disappear_count.append([str(t), word_str])
-                        print('img_disappear', self.image_disappear_count)
-
+                    ablation_variants.append(('', t, word_t, word_str, original_w_score))
+                    ablation_maps.append(spatial_relevance.float())
                     if do_attention:
                         # here is the random
-                        image = self.explainer.img.detach().clone()
-                        relevance_img = relevance_imgs[t].clone()  # (1,C, H, W)
-                        if relevance_img.dim() == 2:
-                            cam_size = int(np.sqrt(relevance_img.shape[-1]))
-                            relevance_img = relevance_img[0].reshape(cam_size, cam_size)
-                            scale = int(self.explainer.args.height // cam_size)
-                            relevance_img = skimage.transform.pyramid_expand(
-                                relevance_img.detach().cpu().numpy(), upscale=scale,
-                                multichannel=False)
-                            spatial_relevance = torch.from_numpy(relevance_img).cuda()
-                        else:
-                            spatial_relevance = torch.mean(relevance_img, dim=(0, 1))  # (H,W)
                         h, w = spatial_relevance.size()
                         random_relevance = torch.tensor(random.sample(range(h * w), h * w))
                         random_relevance = random_relevance.view(h,w)
-                        mask = self.block_image(random_relevance)
-                        image_modified_random = mask * image
-                        # plt.imshow(image_modified_random.permute(0,2,3,1).detach().cpu().numpy()[0])
-                        # plt.show()
-                        # caption_length_img = len(beam_caption_encoded[:t])
-                        new_sentence_random, _ = self.explainer.model.beam_search(image_modified_random, self.explainer.word_map)
-                        new_words_random = new_sentence_random[0].split()
-                        print(new_words_random)
-                        if word_str in new_words_random:
-                            new_idx_random = new_words_random.index(word_str)
-                            beam_caption_img_random = ['<start>'] + new_words_random[:new_idx_random]
-                            beam_caption_encoded_img_random = [self.word_map[w] for w in beam_caption_img_random]
-                            new_predicted_scores_random = self.explainer.teacherforce_forward(image_modified_random,
-                                                                                       beam_caption_encoded_img_random)
-                            assert new_predicted_scores_random.size(0) == new_idx_random + 1
-                            new_w_img_score_random = torch.softmax(new_predicted_scores_random[-1], dim=-1)[word_t]
-                            diff_img_random = original_w_score - new_w_img_score_random
-                            self.image_category_score_diff_random.append([str(t), word_str,diff_img_random.item()])
-                            print(word_t, word_str)
-                            print('img_diff_random', diff_img_random.item(), original_w_score, new_w_img_score_random)
-                        else:
-                            self.image_disappear_count_random.append([str(t), word_str])
-                            print('img_disappear_rdm', self.image_disappear_count_random)
+                        ablation_variants.append(('_random', t, word_t, word_str, original_w_score))
+                        ablation_maps.append(random_relevance.to(self.explainer.device).float())
                         #  the attention
-                        image = self.explainer.img.detach().clone()
                         attention = self.explainer.alphas[t].detach().cpu().numpy()
                         if len(attention.shape) == 2:
                             attention = np.mean(attention, axis=0)
@@ -207,30 +240,9 @@ class EvaluationExperiments(object):
                         attention = skimage.transform.pyramid_expand(attention, upscale=scale,
                                                                      multichannel=False)
                         attention = self._project_maxabs(attention)
-                        spatial_relevance = torch.from_numpy(attention).cuda()
-                        mask = self.block_image(spatial_relevance)
-                        image_modified_att = mask * image
-                        # plt.imshow(image_modified_att.permute(0, 2, 3, 1).detach().cpu().numpy()[0])
-                        # plt.show()
-                        # caption_length_img = len(beam_caption_encoded[:t])
-                        new_sentence_att, _ = self.explainer.model.beam_search(image_modified_att, self.explainer.word_map)
-                        new_words_att = new_sentence_att[0].split()
-                        print(new_words_att)
-                        if word_str in new_words_att:
-                            new_idx_att = new_words_att.index(word_str)
-                            beam_caption_img_att = ['<start>'] + new_words_att[:new_idx_att]
-                            beam_caption_encoded_img_att = [self.word_map[w] for w in beam_caption_img_att]
-                            new_predicted_scores_att = self.explainer.teacherforce_forward(image_modified_att,
-                                                                                       beam_caption_encoded_img_att)
-                            assert new_predicted_scores_att.size(0) == new_idx_att + 1
-                            new_w_img_score_att = torch.softmax(new_predicted_scores_att[-1], dim=-1)[word_t]
-                            diff_img_att = original_w_score - new_w_img_score_att
-                            self.image_category_score_diff_att.append([str(t), word_str,diff_img_att.item()])
-                            print(word_t, word_str)
-                            print('img_diff_att', diff_img_att.item(), original_w_score, new_w_img_score_att)
-                        else:
-                            self.image_disappear_count_att.append([str(t), word_str])
-                            print('img_disappear_att', self.image_disappear_count_att)
+                        spatial_relevance = torch.from_numpy(attention).to(self.explainer.device)
+                        ablation_variants.append(('_att', t, word_t, word_str, original_w_score))
+                        ablation_maps.append(spatial_relevance.float())
                 if t >= 6:
                     if word_str in STOP_WORDS or single_key_flag:
                         original_w_score = torch.softmax(predicted_scores[t], dim=-1)[word_t]
@@ -285,6 +297,8 @@ class EvaluationExperiments(object):
                                         self.category_scores_diff_random[t] = []
                                     self.category_scores_diff_random[t].append(diff_rdm.item())
                                 print('word_rdm', diff_rdm.item(), original_w_score, new_w_score_rdm)
+            if len(ablation_variants) > 0:
+                self.image_ablation_batch(ablation_variants, ablation_maps)
         ablation_results = []
         ablation_results.append({'words_ablation': [{'stop_words': self.stop_word_scores_diff}, {'category_words': self.category_scores_diff}],
                                  'image_ablation': [{'stop_words': self.image_disappear_count}, {'category_words': self.image_category_score_diff}]})
@@ -310,31 +324,6 @@ class EvaluationExperiments(object):
                 json.dump(ablation_results_att, f)
         torch.cuda.empty_cache()
 
-    def _calculate_overlaped_pixels(self, bbox, relevance, threshold):
-
-        '''threshold is a scalar between [0,1]'''
-        # img = Image.fromarray(relevance * 255)
-        # draw = ImageDraw.Draw(img)
-        # draw.rectangle([bbox[0], bbox[1], bbox[2], bbox[3]], outline='red')
-        # img.show()
-        # print(bbox)
-        bbox_mask = np.zeros(relevance.shape)
-        bbox_mask[bbox[1]:bbox[3], bbox[0]:bbox[2]] = 1
-        # print(np.sum(bbox_mask>0))
-        relevance_mask = relevance <= threshold
-        if np.sum(relevance_mask>0):
-            relevance[relevance_mask] = 0
-        total_pixel_score = np.sum(relevance)
-        if total_pixel_score == 0:
-            return 0
-        correct_pixel_score = np.sum(np.multiply(bbox_mask, relevance))
-        ratio = 1.0 * correct_pixel_score / total_pixel_score
-        if ratio > 1:
-            return 1.
-        else:
-            return ratio
-        # return correct_pixel_score
-
     def _project_maxabs(self, x):
         absmax = np.max(np.abs(x))
         if absmax == 0:
@@ -367,6 +356,8 @@ class EvaluationExperiments(object):
         # beam_caption_encoded = self.explainer.beam_caption_encode  # this is a list with the encoded label of the predicted caption with <start>
         # sentence_length = len(beam_caption_encoded) - 1
         with torch.no_grad():
+            # the maps of the explained words and the boxes of their categories, scored after the loop
+            relevance_maps, attention_maps, boxes, box_keys, box_map_idx = [], [], [], [], []
             for t in range(sentence_length):
                 word_t = beam_caption_encoded[t + 1]
                 word_str = self.rev_word_map[word_t]
@@ -422,18 +413,19 @@ class EvaluationExperiments(object):
                             new_box[1] = int(box[1] * resize_ratio[1])
                             new_box[2] = int(box[2] * resize_ratio[0])
                             new_box[3] = int(box[3] * resize_ratio[1])
-                            for threshold in [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]:
-                                if str(threshold) not in explanation_correctness[img_filename][key].keys():
-                                    explanation_correctness[img_filename][key][str(threshold)] = 0
-                                correct_score = self._calculate_overlaped_pixels(new_box, relevance_img, threshold)
-                                if correct_score > explanation_correctness[img_filename][key][str(threshold)]:
-                                    explanation_correctness[img_filename][key][str(threshold)] = correct_score
-                                if do_attention:
-                                    if str(threshold) not in attention_correctness[img_filename][key].keys():
-                                        attention_correctness[img_filename][key][str(threshold)] = 0
-                                    attention_score = self._calculate_overlaped_pixels(new_box, attention, threshold)
-                                    if attention_score > attention_correctness[img_filename][key][str(threshold)]:
-                                        attention_correctness[img_filename][key][str(threshold)] = attention_score
+                            boxes.append(new_box)
+                            box_keys.append(key)
+                            box_map_idx.append(len(relevance_maps))
+                        relevance_maps.append(relevance_img)
+                        if do_attention:
+                            attention_maps.append(attention)
+            if len(boxes) > 0:
+                # all the explained words of the caption are scored together
+                update_correctness(explanation_correctness[img_filename], box_keys,
+                                   bbox_correctness(np.stack(relevance_maps), boxes, box_map_idx))
+                if do_attention:
+                    update_correctness(attention_correctness[img_filename], box_keys,
+                                       bbox_correctness(np.stack(attention_maps), boxes, box_map_idx))
             new_predicted_scores_random = self.explainer.teacherforce_forward(self.explainer.img.detach().clone(),
                                                                               beam_caption_encoded)
             print(explanation_correctness[img_filename])
@@ -587,29 +579,6 @@ class EvaluationExperimentsAOA(object):
         self.num_delete_patches= 20
         self.patch_size = 8
 
-    def _calculate_overlaped_pixels(self, bbox, relevance, threshold):
-
-        '''threshold is a scalar between [0,1]'''
-        # img = Image.fromarray(relevance * 255)
-        # draw = ImageDraw.Draw(img)
-        # draw.rectangle([bbox[0], bbox[1], bbox[2], bbox[3]], outline='red')
-        # img.show()
-        # print(bbox)
-        bbox_mask = np.zeros(relevance.shape)
-        bbox_mask[bbox[1]:bbox[3], bbox[0]:bbox[2]] = 1
-        relevance_mask = relevance <= threshold
-        if np.sum(relevance_mask>0):
-            relevance[relevance_mask] = 0
-        total_pixel_score = np.sum(relevance)
-        if total_pixel_score == 0:
-            return 0
-        correct_pixel_score = np.sum(np.multiply(bbox_mask, relevance))
-        ratio = 1.0 * correct_pixel_score / total_pixel_score
-        if ratio > 1:
-            return 1.
-        else:
-            return ratio
-
     def _project_maxabs(self, x):
         absmax = np.max(np.abs(x))
         if absmax == 0:
@@ -640,6 +609,8 @@ class EvaluationExperimentsAOA(object):
         with torch.no_grad():
             beam_caption_encoded = self.explainer.beam_caption_encode  # this is a list with the encoded label of the predicted caption with <start>
             sentence_length = len(beam_caption_encoded) - 1
+            # the maps of the explained words and the boxes of their categories, scored after the loop
+            relevance_maps, attention_maps, boxes, box_keys, box_map_idx = [], [], [], [], []
             for t in range(sentence_length):
                 word_t = beam_caption_encoded[t + 1]
                 word_str = self.rev_word_map[word_t]
@@ -687,18 +658,19 @@ class EvaluationExperimentsAOA(object):
                             new_box[1] = int(box[1] * resize_ratio[1])
                             new_box[2] = int(box[2] * resize_ratio[0])
                             new_box[3] = int(box[3] * resize_ratio[1])
-                            for threshold in [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]:
-                                if str(threshold) not in explanation_correctness[key].keys():
-                                    explanation_correctness[key][str(threshold)] = 0
-                                correct_score = self._calculate_overlaped_pixels(new_box, relevance_img, threshold)
-                                if correct_score > explanation_correctness[key][str(threshold)]:
-                                    explanation_correctness[key][str(threshold)] = correct_score
-                                if do_attention:
-                                    if str(threshold) not in attention_correctness[key].keys():
-                                        attention_correctness[key][str(threshold)] = 0
-                                    attention_score = self._calculate_overlaped_pixels(new_box, attention, threshold)
-                                    if attention_score > attention_correctness[key][str(threshold)]:
-                                        attention_correctness[key][str(threshold)] = attention_score
+                            boxes.append(new_box)
+                            box_keys.append(key)
+                            box_map_idx.append(len(relevance_maps))
+                        relevance_maps.append(relevance_img)
+                        if do_attention:
+                            attention_maps.append(attention)
+            if len(boxes) > 0:
+                # all the explained words of the caption are scored together
+                update_correctness(explanation_correctness, box_keys,
+                                   bbox_correctness(np.stack(relevance_maps), boxes, box_map_idx))
+                if do_attention:
+                    update_correctness(attention_correctness, box_keys,
+                                       bbox_correctness(np.stack(attention_maps), boxes, box_map_idx))
             new_predicted_scores= self.explainer.teacherforce_forward(self.explainer.img.detach().clone(), beam_caption_encoded)
         print('relevance',explanation_correctness)
         if do_attention:
@@ -731,6 +703,8 @@ class EvaluationExperimentsAOA(object):
             self.explainer.get_hidden_parameters(img_filepath)
             beam_caption_encoded = self.explainer.beam_caption_encode  # this is a list with the encoded label of the predicted caption with <start>
             sentence_length = len(beam_caption_encoded) - 1
+            # the maps of the explained words and the boxes of their categories, scored after the loop
+            relevance_maps, attention_maps, boxes, box_keys, box_map_idx = [], [], [], [], []
             for t in range(sentence_length):
                 word_t = beam_caption_encoded[t + 1]
                 word_str = self.rev_word_map[word_t]
@@ -758,12 +732,13 @@ class EvaluationExperimentsAOA(object):
                             new_box[1] = int(box[1] * resize_ratio[1])
                             new_box[2] = int(box[2] * resize_ratio[0])
                             new_box[3] = int(box[3] * resize_ratio[1])
-                            for threshold in [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]:
-                                if str(threshold) not in attention_correctness[key].keys():
-                                    attention_correctness[key][str(threshold)] = 0
-                                attention_score = self._calculate_overlaped_pixels(new_box, attention, threshold)
-                                if attention_score > attention_correctness[key][str(threshold)]:
-                                    attention_correctness[key][str(threshold)] = attention_score
+                            boxes.append(new_box)
+                            box_keys.append(key)
+                            box_map_idx.append(len(attention_maps))
+                        attention_maps.append(attention)
+            if len(boxes) > 0:
+                update_correctness(attention_correctness, box_keys,
+                                   bbox_correctness(np.stack(attention_maps), boxes, box_map_idx))
             new_predicted_scores= self.explainer.teacherforce_forward(self.explainer.img.detach().clone(), beam_caption_encoded)
             print('attention',attention_correctness)
             with open(os.path.join(save_path_bbox, img_filename + '_' + str(head_idx) + 'attention_correctness.json'), 'w') as f:
@@ -772,8 +747,126 @@ class EvaluationExperimentsAOA(object):
 
 
 
-def generate_evaluation_files(model_type='gridTD', explainer_type='lrp', head_idx=None, dataset='flickr30k', do_attention=True):
+def build_explainer(model_type, explainer_type, args, word_map, model=None):
+    '''
+    :param model: an already loaded captioning model to share, None loads the checkpoint args.weight
+    '''
+    if model_type == 'aoa':
+        if 'lrp' in explainer_type:
+            explainer = aoamodel.ExplainAOAAttention(args, word_map, model=model)
+        elif 'GuidedGradCam' in explainer_type:
+            explainer = aoamodel.ExplainAOAGuidedGradCam(args, word_map, model=model)
+        elif explainer_type == 'GradCam':
+            explainer = aoamodel.ExplainAOAGradCam(args, word_map, model=model)
+        elif explainer_type == 'GuidedBackpropagate':
+            explainer = aoamodel.ExplainAOAGuidedGradient(args, word_map, model=model)
+        elif explainer_type == 'gradient':
+            explainer = aoamodel.ExplainAOAGradient(args, word_map, model=model)
+        else:
+            raise NotImplementedError('no such explainer_type')
+    elif model_type == 'gridTD':
+        if 'lrp' in explainer_type:
+            explainer = gridTDmodel.ExplainGridTDAttention(args, word_map, model=model)
+        elif 'GuidedGradCam' in explainer_type:
+            explainer =  gridTDmodel.ExplainGridTDGuidedGradCam(args, word_map, model=model)
+        elif explainer_type == 'GradCam':
+            explainer = gridTDmodel.ExplainGridTDGradCam(args, word_map, model=model)
+        elif explainer_type == 'GuidedBackpropagate':
+            explainer = gridTDmodel.ExplainiGridTDGuidedGradient(args, word_map, model=model)
+        elif explainer_type == 'gradient':
+            explainer = gridTDmodel.ExplainGridTDGradient(args, word_map, model=model)
+        else:
+            raise NotImplementedError('no such explainer_type')
+    else:
+        raise NotImplementedError('no such model type')
+    return explainer
+
 
+class ExplainerSession(object):
+    def __init__(self, model_type, explainer_type, args, word_map, model=None):
+        '''
+        A long-lived explainer and evaluation engine. The checkpoint is loaded once when the session is created, reset
+        drops the per-image state so that the same model is reused for all the images of an evaluation
+        '''
+        self.model_type = model_type
+        self.explainer_type = explainer_type
+        self.explainer = build_explainer(model_type, explainer_type, args, word_map, model=model)
+        if model_type == 'aoa':
+            self.evaluation_engin = EvaluationExperimentsAOA(explainer=self.explainer)
+        else:
+            self.evaluation_engin = EvaluationExperiments(explainer=self.explainer)
+
+    @property
+    def model(self):
+        return self.explainer.model
+
+    def reset(self):
+        self.explainer.reset()
+        torch.cuda.empty_cache()
+
+
+class DecodeCache(object):
+    def __init__(self, beam_size=3, max_cap_length=50):
+        '''
+        The decoding of the current image shared by the explainers of one model: the preprocessed image, the beam search
+        caption and the states recorded by beam_search_with_states, which include the encoder features. An explainer
+        with a decode_cache calls decode instead of running the beam search and the encoder itself
+        '''
+        self.beam_size = beam_size
+        self.max_cap_length = max_cap_length
+        self.img_filepath = None
+        self.decoded = None
+
+    def decode(self, explainer, img_filepath):
+        '''
+        :return: img, beam_caption, beam_caption_encode, states of img_filepath, decoded by the first explainer asking
+        '''
+        if img_filepath != self.img_filepath:
+            img = explainer.preprocess_img(img_filepath)  # (bs, C, H, W)
+            beam_caption, beam_caption_encode, states = explainer.model.beam_search_with_states(
+                img, explainer.word_map, beam_size=self.beam_size, max_cap_length=self.max_cap_length)
+            self.img_filepath = img_filepath
+            self.decoded = (img, beam_caption, beam_caption_encode, states)
+        img, beam_caption, beam_caption_encode, states = self.decoded
+        # the explainers extend the caption lists, the tensors are only read
+        return img, list(beam_caption), list(beam_caption_encode), states
+
+    def clear(self):
+        self.img_filepath = None
+        self.decoded = None
+
+
+class MultiExplainerSession(object):
+    def __init__(self, model_type, explainer_types, args, word_map, model=None, beam_size=3, max_cap_length=50):
+        '''
+        An ExplainerSession for every explainer type, all of them share one model and one DecodeCache. The beam search
+        and the encoder forward of an image run once, then every explainer only replays the decoder and computes its
+        own relevance
+        '''
+        self.model_type = model_type
+        self.explainer_types = list(explainer_types)
+        self.decode_cache = DecodeCache(beam_size, max_cap_length)
+        self.sessions = []
+        for explainer_type in self.explainer_types:
+            session = ExplainerSession(model_type, explainer_type, args, word_map, model=model)
+            session.explainer.decode_cache = self.decode_cache
+            model = session.model  # the checkpoint is only loaded by the first explainer
+            self.sessions.append(session)
+
+    @property
+    def model(self):
+        return self.sessions[0].model
+
+    def reset(self):
+        for session in self.sessions:
+            session.reset()
+        self.decode_cache.clear()
+
+
+def load_evaluation_setup(model_type, dataset):
+    '''
+    :return: the arguments with the checkpoint of the model_type, the word map, the test data and the bbox categories
+    '''
     if model_type == 'gridTD':
         parser = imgcap_gridTD_argument_parser()
         args = parser.parse_args()
@@ -802,68 +895,176 @@ def generate_evaluation_files(model_type='gridTD', explainer_type='lrp', head_id
         category_dict = json.load(open('./dataset/COCOvalEntities.json'))
     else:
         data_file = json.load(open('./dataset/test_imagecap_flickr30k_5_cap_per_img_3_min_word_freq.json', 'r'))
+        category_dict = {}  # there is no bbox annotation for flickr30k
+    return args, word_map, data_file, category_dict
+
+
+def get_evaluation_save_paths(args, explanation_type):
+    save_paths = {}
+    for experiment in ['bbox', 'ablation', 'tpfp']:
+        save_paths[experiment] = os.path.join(args.save_path, args.encoder, args.dataset, 'evaluation/' + experiment + '/',
+                                              explanation_type)
+        if not os.path.isdir(save_paths[experiment]):
+            os.makedirs(save_paths[experiment])
+    return save_paths
+
+
+def evaluate_image(session, data, category_dict, explanation_type, save_paths, head_idx=None, do_attention=True):
+    ''' runs the ablation, bbox and TPFP experiments of one image and resets the session for the next image '''
+    evaluation_engin = session.evaluation_engin
+    img_filename = data['image_path'].split('/')[-1]
+    evaluation_engin.ablation_experiment(data, explanation_type, save_paths['ablation'], do_attention=do_attention)
+    evaluation_engin.explainer.model.zero_grad()
+    if img_filename in category_dict:
+        if session.model_type == 'aoa':
+            evaluation_engin.bbox_experiment(category_dict, data, save_paths['bbox'], head_idx=head_idx)
+        else:
+            evaluation_engin.bbox_experiment(category_dict, data, save_paths['bbox'], explanation_type, do_attention=do_attention)
+    evaluation_engin.explainer.model.zero_grad()
+    evaluation_engin.tpfp_experiment(data, explanation_type, save_paths['tpfp'], flickr_frequent, do_attention=do_attention)
+    session.reset()
+
 
+def generate_evaluation_files(model_type='gridTD', explainer_type='lrp', head_idx=None, dataset='flickr30k', do_attention=True):
+    args, word_map, data_file, category_dict = load_evaluation_setup(model_type, dataset)
+    explanation_type = explainer_type
+    save_paths = get_evaluation_save_paths(args, explanation_type)
+    # the model is loaded once, only the per-image state of the explainer is reset after every image
+    session = ExplainerSession(model_type, explainer_type, args, word_map)
     for i in range(len(data_file)):
         # print(i)
         img_filename = data_file[i]['image_path'].split('/')[-1]
         if img_filename != '000000015746.jpg':
             continue
-        if model_type == 'aoa':
-            if 'lrp' in explainer_type:
-                explainer = aoamodel.ExplainAOAAttention(args, word_map)
-            elif 'GuidedGradCam' in explainer_type:
-                explainer = aoamodel.ExplainAOAGuidedGradCam(args, word_map)
-            elif explainer_type == 'GradCam':
-                explainer = aoamodel.ExplainAOAGradCam(args, word_map)
-            elif explainer_type == 'GuidedBackpropagate':
-                explainer = aoamodel.ExplainAOAGuidedGradient(args, word_map)
-            elif explainer_type == 'gradient':
-                explainer = aoamodel.ExplainAOAGradient(args, word_map)
-            else:
-                raise NotImplementedError('no such explainer_type')
-            evaluation_engin = EvaluationExperimentsAOA(explainer=explainer)
-        elif model_type == 'gridTD':
-            if 'lrp' in explainer_type:
-                explainer = gridTDmodel.ExplainGridTDAttention(args, word_map)
-            elif 'GuidedGradCam' in explainer_type:
-                explainer =  gridTDmodel.ExplainGridTDGuidedGradCam(args, word_map)
-            elif explainer_type == 'GradCam':
-                explainer = gridTDmodel.ExplainGridTDGradCam(args, word_map)
-            elif explainer_type == 'GuidedBackpropagate':
-                explainer = gridTDmodel.ExplainiGridTDGuidedGradient(args, word_map)
-            elif explainer_type == 'gradient':
-                explainer = gridTDmodel.ExplainGridTDGradient(args, word_map)
-            else:
-                raise NotImplementedError('no such explainer_type')
-            evaluation_engin = EvaluationExperiments(explainer=explainer)
-        else:
-            raise NotImplementedError('no such model type')
-        explanation_type = explainer_type
-        save_path_bbox = os.path.join(args.save_path, args.encoder, args.dataset, 'evaluation/bbox/', explanation_type)
-        save_path_ablation = os.path.join(args.save_path, args.encoder, args.dataset, 'evaluation/ablation/', explanation_type)
-        save_path_tpfp = os.path.join(args.save_path, args.encoder, args.dataset, 'evaluation/tpfp/', explanation_type)
-        if not os.path.isdir(save_path_ablation):
-            os.makedirs(save_path_ablation)
-        if not os.path.isdir(save_path_bbox):
-            os.makedirs(save_path_bbox)
-        if not os.path.isdir(save_path_tpfp):
-            os.makedirs(save_path_tpfp)
-        evaluation_engin.ablation_experiment(data_file[i],explanation_type, save_path_ablation,do_attention=do_attention)
-        evaluation_engin.explainer.model.zero_grad()
-        if img_filename in category_dict:
-            if model_type == 'aoa':
-                evaluation_engin.bbox_experiment(category_dict, data_file[i], save_path_bbox, head_idx=head_idx)
-            else:
-                evaluation_engin.bbox_experiment(category_dict, data_file[i], save_path_bbox, explanation_type, do_attention=do_attention)
-        evaluation_engin.explainer.model.zero_grad()
-        evaluation_engin.tpfp_experiment(data_file[i], explanation_type,  save_path_tpfp, flickr_frequent, do_attention=do_attention)
-        evaluation_engin.explainer.model.zero_grad()
-        del evaluation_engin.explainer.model
-        del evaluation_engin.explainer
-        del evaluation_engin
-        del explainer
-        gc.collect()
-        torch.cuda.empty_cache()
+        evaluate_image(session, data_file[i], category_dict, explanation_type, save_paths, head_idx, do_attention)
+
+
+def evaluate_image_multi(multi_session, data, category_dict, save_paths, head_idx=None, do_attention=True):
+    '''
+    runs the experiments of one image for every explainer of the multi_session on the same decoding. The attention
+    baseline does not depend on the explainer, it is only evaluated with the first one
+    :param save_paths: the get_evaluation_save_paths of every explainer type
+    '''
+    for i, session in enumerate(multi_session.sessions):
+        evaluate_image(session, data, category_dict, session.explainer_type, save_paths[session.explainer_type],
+                       head_idx, do_attention and i == 0)
+    multi_session.decode_cache.clear()
+
+
+def generate_evaluation_files_multi(model_type='gridTD', explainer_types=('lrp', 'GuidedGradCam', 'GradCam',
+                                                                          'GuidedBackpropagate', 'gradient'),
+                                    head_idx=None, dataset='flickr30k', do_attention=True):
+    '''
+    generate_evaluation_files for several explainer types in a single pass over the test set, every image is decoded
+    once and explained by all of them before moving on
+    '''
+    args, word_map, data_file, category_dict = load_evaluation_setup(model_type, dataset)
+    save_paths = {explainer_type: get_evaluation_save_paths(args, explainer_type) for explainer_type in explainer_types}
+    multi_session = MultiExplainerSession(model_type, explainer_types, args, word_map)
+    for i in range(len(data_file)):
+        evaluate_image_multi(multi_session, data_file[i], category_dict, save_paths, head_idx, do_attention)
+
+
+def get_progress_path(args, explanation_type, head_idx=None):
+    progress_path = os.path.join(args.save_path, args.encoder, args.dataset, 'evaluation/progress/', explanation_type)
+    if head_idx is not None:
+        progress_path = os.path.join(progress_path, 'head' + str(head_idx))
+    if not os.path.isdir(progress_path):
+        os.makedirs(progress_path)
+    return progress_path
+
+
+def read_progress(progress_path, status='done'):
+    ''' :return: the image filenames recorded by all the shards with the status done or failed '''
+    img_filenames = set()
+    for progress_file in glob.glob(os.path.join(progress_path, 'shard*_' + status + '.txt')):
+        with open(progress_file, 'r') as f:
+            img_filenames.update(line.strip() for line in f if line.strip())
+    return img_filenames
+
+
+def run_evaluation_shard(model_type, explainer_type, shard_idx, num_shards, head_idx=None, dataset='flickr30k',
+                         do_attention=True, num_threads=1):
+    '''
+    evaluates data_file[shard_idx::num_shards] with its own explainer session. Every finished image is appended to the
+    progress file of the shard, so an interrupted shard resumes after the last finished image
+    '''
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    args, word_map, data_file, category_dict = load_evaluation_setup(model_type, dataset)
+    explanation_type = explainer_type
+    save_paths = get_evaluation_save_paths(args, explanation_type)
+    progress_path = get_progress_path(args, explanation_type, head_idx)
+    finished = read_progress(progress_path, 'done')
+    shard = [data for data in data_file[shard_idx::num_shards]
+             if data['image_path'].split('/')[-1] not in finished]
+    print(f'shard {shard_idx}/{num_shards}: {len(shard)} images to evaluate')
+    if len(shard) == 0:
+        return
+    session = ExplainerSession(model_type, explainer_type, args, word_map)
+    done_file = open(os.path.join(progress_path, f'shard{shard_idx}_done.txt'), 'a')
+    failed_file = open(os.path.join(progress_path, f'shard{shard_idx}_failed.txt'), 'a')
+    for data in shard:
+        img_filename = data['image_path'].split('/')[-1]
+        try:
+            evaluate_image(session, data, category_dict, explanation_type, save_paths, head_idx, do_attention)
+        except Exception as e:
+            # a failed image is recorded and retried by the next run, it does not stop the shard
+            print(f'shard {shard_idx}: {img_filename} failed, {e}')
+            session.reset()
+            failed_file.write(img_filename + '\n')
+            failed_file.flush()
+            continue
+        done_file.write(img_filename + '\n')
+        done_file.flush()
+    done_file.close()
+    failed_file.close()
+
+
+def run_evaluation(model_type='gridTD', explainer_type='lrp', head_idx=None, dataset='flickr30k', do_attention=True,
+                   num_workers=4, num_threads=1):
+    '''
+    generate_evaluation_files over the whole test set with num_workers processes, each evaluates one shard. The images
+    already finished by a previous run are skipped. After all the shards are finished, their progress is merged into
+    progress.json. A worker that exits with a non-zero code, e.g. killed by an OOM or failed in load_evaluation_setup, is
+    recorded in the failed_shards of progress.json with the images it left, and a RuntimeError is raised
+    :param num_threads: the torch threads of every worker, num_workers * num_threads should not exceed the cores
+    '''
+    shard_kwargs = dict(head_idx=head_idx, dataset=dataset, do_attention=do_attention, num_threads=num_threads)
+    failed_shards = {}
+    if num_workers <= 1:
+        run_evaluation_shard(model_type, explainer_type, 0, 1, **shard_kwargs)
+    else:
+        # every worker loads its own model, spawn does not share the CUDA or the OpenMP state of the parent
+        ctx = torch.multiprocessing.get_context('spawn')
+        workers = [ctx.Process(target=run_evaluation_shard, args=(model_type, explainer_type, shard_idx, num_workers),
+                               kwargs=shard_kwargs) for shard_idx in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed_shards = {shard_idx: worker.exitcode for shard_idx, worker in enumerate(workers) if worker.exitcode != 0}
+    args, _, data_file, _ = load_evaluation_setup(model_type, dataset)
+    progress_path = get_progress_path(args, explainer_type, head_idx)
+    done = read_progress(progress_path, 'done')
+    failed = read_progress(progress_path, 'failed') - done
+    img_filenames = [data['image_path'].split('/')[-1] for data in data_file]
+    progress = {'total': len(img_filenames),
+                'done': sorted(done),
+                'failed': sorted(failed),
+                'remaining': sorted(set(img_filenames) - done - failed),
+                'failed_shards': [{'shard': shard_idx,
+                                   'exitcode': exitcode,
+                                   'remaining': sorted(set(img_filenames[shard_idx::num_workers]) - done - failed)}
+                                  for shard_idx, exitcode in sorted(failed_shards.items())]}
+    with open(os.path.join(progress_path, 'progress.json'), 'w') as f:
+        json.dump(progress, f)
+    print(f'{len(done)}/{len(img_filenames)} images evaluated, {len(failed)} failed')
+    if failed_shards:
+        raise RuntimeError('evaluation shards ' + ', '.join(f'{shard_idx} (exit code {exitcode})'
+                                                            for shard_idx, exitcode in sorted(failed_shards.items())) +
+                           ' did not finish, see ' + os.path.join(progress_path, 'progress.json'))
+    return progress
 
 
 def analyze_bbox(model_type):
@@ -1549,6 +1750,8 @@ if __name__ == '__main__':
     generate_evaluation_files('gridTD', explainer_type='GuidedGradient', dataset='flickr30k', do_attention=False)
     generate_evaluation_files('gridTD', explainer_type='Gradient', dataset='flickr30k', do_attention=False)
     # generate_evaluation_files('gridTD', explainer_type='lrp', do_attention=True)
+    # run_evaluation('gridTD', explainer_type='lrp', dataset='coco2017', do_attention=True, num_workers=8, num_threads=2)
+    # generate_evaluation_files_multi('gridTD', dataset='flickr30k', do_attention=True)
     # generate_evaluation_files('gridTD', explainer_type='GuidedGradCam', do_attention=False)
     # generate_evaluation_files('gridTD', explainer_type='GradCam', do_attention=False)
     # generate_evaluation_files('gridTD', explainer_type='GuidedGradient', do_attention=False)
@@ -10,8 +10,9 @@ from matplotlib import pyplot as plt
 import torchvision.transforms as transforms
 import copy
 import os
-from LRPtools import lrp_wrapper
+from LRPtools import lrp_engine
 from LRPtools import utils as LRPutil
+from LRPtools import lrp_rules
 import yaml
 import skimage.transform
 
@@ -63,23 +64,28 @@ class AdaptiveAttention(nn.Module):
         self.W_g_proj = nn.Linear(hidden_dim,n_pixel,bias=False)
         self.w_h = nn.Linear(n_pixel, 1, bias=False)
 
-    def forward(self, V, ht, st):
+    def prepare(self, V):
         """
+        The image side of the attention does not change over the decoding steps, so it is computed once per image
         V: the spatial image of size (batch_size,hidden_size,num_pixel)
-        decoder_out: the decoder hidden state of shape (batch_size, hidden_size)
-        st: visual sentinal returned by the Sentinal class, of shape: (batch_size, hidden_size)
+        return: V transposed to (batch_size, num_pixel, hidden_size) and its projection (batch_size, num_pixel, num_pixel)
         """
         V = V.transpose(1,2)  #(bs, num_pixel,hidden_dim)
-        batch_size = ht.size(0)
         img_proj = self.W_v_proj(V) # (bs, num_pixel, num_pixel)
-        # print('img_proj', img_proj.size())
+        return V, img_proj
+
+    def forward(self, V, ht, st):
+        """
+        V: the spatial image of size (batch_size,hidden_size,num_pixel) or the (V, img_proj) tuple returned by prepare
+        decoder_out: the decoder hidden state of shape (batch_size, hidden_size)
+        st: visual sentinal returned by the Sentinal class, of shape: (batch_size, hidden_size)
+        """
+        if not isinstance(V, tuple):
+            V = self.prepare(V)
+        V, img_proj = V
         ht_proj = self.W_g_proj(ht)        # (-1, num_pixel)
         # print('ht_proj', ht_proj.size())
-        one_matrix = torch.ones(batch_size,1, self.num_pixel).cuda() # (bs, 1, num_pixel)
-        # print('one_matrix', one_matrix.size())
-        ht_proj_expand = torch.bmm(ht_proj.unsqueeze(2), one_matrix) #(bs, num_pixel, num_pixel)
-        # print('ht_proj_expand', ht_proj_expand.size())
-        z_t = self.w_h(torch.tanh(img_proj+ht_proj_expand)) #(bs, num_pixel, 1)
+        z_t = self.w_h(torch.tanh(img_proj+ht_proj.unsqueeze(2))) #(bs, num_pixel, 1), ht_proj is broadcast over the last dim
         # print('zt', z_t.size())
         alpha_t = torch.softmax(z_t, dim=1) #(bs, num_pixel,1)
         # print('alpha', alpha_t.size())
@@ -120,16 +126,25 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
         self.fc = nn.Linear(hidden_dim, vocab_size)
         self.relu = nn.ReLU()
 
+    @property
+    def device(self):
+        # the device and dtype follow the parameters, call model.to(device, dtype) to move the model
+        return self.fc.weight.device
+
+    @property
+    def dtype(self):
+        return self.fc.weight.dtype
+
     def init_hidden_state(self, V):
-        h = torch.zeros(V.shape[0], self.hidden_dim).cuda()
-        c = torch.zeros(V.shape[0], self.hidden_dim).cuda()
+        h = torch.zeros(V.shape[0], self.hidden_dim, device=self.device, dtype=self.dtype)
+        c = torch.zeros(V.shape[0], self.hidden_dim, device=self.device, dtype=self.dtype)
         return h, c
 
-    def predict_next_word(self,image_feature_proj, xt, states):
+    def predict_next_word(self, memory, xt, states):
         ht, ct = states
         ht, ct, st = self.AdaLSTM(xt, (ht, ct))
         # print(ht.size(), ct.size(), st.size())
-        context_t_hat, context_t, alpha_t, beta_t = self.AdaAttention(image_feature_proj, ht, st)
+        context_t_hat, context_t, alpha_t, beta_t = self.AdaAttention(memory, ht, st)
         # print(context_t.size(), alpha_t.size(), beta_t.size())
         predict_score_t = self.fc(self.dropout(context_t_hat + ht))  # (bs, vocab_size)
         return predict_score_t, alpha_t, beta_t, (ht, ct)
@@ -154,18 +169,19 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
         image_feature_proj = image_feature_proj.view(batch_size, self.hidden_dim, -1) # (bs, hidden_dim, num_pixel)
         # print(image_feature_proj.size())
 
+        memory = self.AdaAttention.prepare(image_feature_proj)
         state = self.init_hidden_state(image_feature_proj)
         max_length = max(caption_lengths)-1
         # print('maxlength', caption_length)
-        predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
-        alphas = torch.zeros(batch_size, max_length , num_pixels).cuda()
-        betas = torch.zeros(batch_size, max_length,1).cuda()
+        predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        alphas = torch.zeros(batch_size, max_length , num_pixels, device=self.device, dtype=self.dtype)
+        betas = torch.zeros(batch_size, max_length,1, device=self.device, dtype=self.dtype)
         if ss_prob is None:
             ss_flag = False
         else:
             random_num = np.random.uniform(0.0, 1.0, size=(batch_size,))
             ss_mask = random_num < ss_prob
-            ss_mask = torch.from_numpy(ss_mask).long().cuda()
+            ss_mask = torch.from_numpy(ss_mask).long().to(self.device)
             if ss_mask.sum() > 0:
                 ss_flag = True
             else:
@@ -179,7 +195,7 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
             xt = torch.cat((word_embedding, global_img_feature), dim=-1)   # (batch_size, 2*embed_dim)
-            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
             predictions[:, t,:] = predict_score_t
             alphas[:, t, :] = alpha_t
             betas[:, t, :] = beta_t
@@ -205,17 +221,18 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
         # print(global_img_feature.size())
         image_feature_proj = image_feature_proj.contiguous()
         image_feature_proj = image_feature_proj.view(batch_size, self.hidden_dim, -1)  # (bs, hidden_dim, num_pixel)
+        memory = self.AdaAttention.prepare(image_feature_proj)
         state = self.init_hidden_state(image_feature_proj)
-        seq = torch.zeros(batch_size,max_length).long().cuda()
-        seq_logprobs = torch.zeros(batch_size, max_length).cuda()
+        seq = torch.zeros(batch_size,max_length, device=self.device, dtype=torch.long)
+        seq_logprobs = torch.zeros(batch_size, max_length, device=self.device, dtype=self.dtype)
         for t in range(max_length):
             if t == 0:
-                it = torch.ones(batch_size).long().cuda() * word_map['<start>']
+                it = torch.ones(batch_size, device=self.device, dtype=torch.long) * word_map['<start>']
             word_embedding = self.embedding(it)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
             xt = torch.cat((word_embedding, global_img_feature), dim=-1)  # (batch_size, 2*embed_dim)
-            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
             predict_score_t = torch.log_softmax(predict_score_t,dim=-1)
             it, sampleLpgprobs = self.sample_next_word(predict_score_t, sample_method, temperature)
             # sample the next word
@@ -239,7 +256,7 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
             it = it.view(-1).long()
         elif sample_method == 'gumbel': # gumbel softmax
             def sample_gumbel(shape, eps=1e-20):
-                U = torch.rand(shape).cuda()
+                U = torch.rand(shape, device=self.device, dtype=self.dtype)
                 return -torch.log(-torch.log(U + eps) + eps)
             def gumbel_softmax_sample(logits, temperature):
                 y = logits + sample_gumbel(logits.size())
@@ -292,18 +309,19 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
         with torch.no_grad():
             complete_seqs = [[] for g in range(num_group)]
             complete_seqs_scores = [[] for g in range(num_group)]
-            k_prev_words = [torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() for g in range(num_group)] # (beam_size,)
-            top_k_scores = [torch.zeros(beam_size, 1).cuda() for g in range(num_group)] # (beam_size, 1)
-            seqs = [torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() for g in range(num_group)]   # (unfinished_num, )
+            k_prev_words = [torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) for g in range(num_group)] # (beam_size,)
+            top_k_scores = [torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) for g in range(num_group)] # (beam_size, 1)
+            seqs = [torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) for g in range(num_group)]   # (unfinished_num, )
             image_features, avg_feature = self.img_encoder(imgs) #
             image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
             image_feature_proj = image_feature_proj.view(batch_size, image_feature_proj.size(1), -1) # batch_size, hidden_dim, H*W
             global_img_feature = self.relu(self.global_img_feature_proj(avg_feature))
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
-            image_feature_proj = [image_feature_proj.expand(beam_size, *image_feature_proj.size()[1:]) for g in range(num_group)] # beam_size, hidden_dim, H*W
+            memory = self.AdaAttention.prepare(image_feature_proj)
+            memory = [tuple(m.expand(beam_size, *m.size()[1:]) for m in memory) for g in range(num_group)] # (V, img_proj) beam_size, H*W, hidden_dim / H*W
             global_img_feature = [global_img_feature.expand(beam_size, global_img_feature.size(-1)) for g in range(num_group)] #  beam_size, hidden_dim,
-            init_state = self.init_hidden_state(image_feature_proj[0])
+            init_state = self.init_hidden_state(memory[0][0])
             state = [init_state for g in range(num_group)]  #(ht, ct)
             unfinished_num = [beam_size for g in range(num_group)]
             for step in range(max_cap_length):
@@ -313,7 +331,7 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
                         continue
                     word_embedding = self.embedding(k_prev_words[g]).squeeze(1)  # unfinished_num, embedding_dim
                     xt = torch.cat((word_embedding, global_img_feature[g]), dim=-1)  # unfinished_num , 2 * embedding_dim
-                    predict_score_t, alpha_t, beta_t, state[g] = self.predict_next_word(image_feature_proj[g], xt, state[g])
+                    predict_score_t, alpha_t, beta_t, state[g] = self.predict_next_word(memory[g], xt, state[g])
                     predict_score_t = torch.log_softmax(predict_score_t, dim=-1)  # (unfinished_num, vocab_size)
                     for i, v in enumerate(previous_idx):
                         predict_score_t[:,int(v)] = predict_score_t[:, int(v)] - diversity_prob
@@ -343,7 +361,7 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
                     for s_idx in range(len(state[g])):
                         new_state.append(state[g][s_idx][beam_idx[incomplete_inds]])
                     state[g] = tuple(new_state)
-                    image_feature_proj[g] = image_feature_proj[g][beam_idx[incomplete_inds]]
+                    memory[g] = tuple(m[beam_idx[incomplete_inds]] for m in memory[g])
                     global_img_feature[g] = global_img_feature[g][beam_idx[incomplete_inds]]
                     top_k_scores[g] = top_k_scores[g][incomplete_inds].unsqueeze(1)
                     if g < 2:
@@ -385,9 +403,9 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
         complete_seqs =[]
         complete_seqs_scores=[]
         with torch.no_grad():
-            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() # (beam_size,)
-            top_k_scores = torch.zeros(beam_size, 1).cuda() # (beam_size, 1)
-            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).cuda()  # (unfinished_num, )
+            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) # (beam_size,)
+            top_k_scores = torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) # (beam_size, 1)
+            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device)  # (unfinished_num, )
             image_features, avg_feature = self.img_encoder(imgs) #
             image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
             # print(image_feature_proj.size())
@@ -396,14 +414,15 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
             # print(global_img_feature.size())
-            image_feature_proj = image_feature_proj.expand(beam_size, *image_feature_proj.size()[1:]) # beam_size, hidden_dim, H*W
+            memory = self.AdaAttention.prepare(image_feature_proj)
+            memory = tuple(m.expand(beam_size, *m.size()[1:]) for m in memory) # (V, img_proj) beam_size, H*W, hidden_dim / H*W
             global_img_feature = global_img_feature.expand(beam_size, global_img_feature.size(-1)) #  beam_size, hidden_dim,
-            state = self.init_hidden_state(image_feature_proj)  #(ht, ct)
+            state = self.init_hidden_state(memory[0])  #(ht, ct)
             unfinished_num = beam_size
             for step in range(max_cap_length):
                 word_embedding = self.embedding(k_prev_words).squeeze(1) # unfinished_num, embedding_dim
                 xt = torch.cat((word_embedding, global_img_feature), dim=-1) # unfinished_num , 2 * embedding_dim
-                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
                 predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(unfinished_num, vocab_size)
                 top_k_scores_exp = top_k_scores.expand((unfinished_num, vocab_size))
                 scores = top_k_scores_exp + predict_score_t
@@ -431,7 +450,7 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
                 for s_idx in range(len(state)):
                     new_state.append(state[s_idx][beam_idx[incomplete_inds]])
                 state = tuple(new_state)
-                image_feature_proj = image_feature_proj[beam_idx[incomplete_inds]]
+                memory = tuple(m[beam_idx[incomplete_inds]] for m in memory)
                 global_img_feature = global_img_feature[beam_idx[incomplete_inds]]
                 top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
                 k_prev_words = next_word_idx[incomplete_inds].unsqueeze(1)
@@ -446,26 +465,216 @@ class AdaptiveAttentionCaptioningModel(nn.Module):
             sentence = [' '.join([rev_word_map[sen_idx[i]] for i in range(len(sen_idx))])]
             return sentence, sen_idx
 
+    def beam_search_batch(self, imgs, word_map, beam_size=3, max_cap_length=20):
+        '''
+        The batched version of beam_search. The beams are kept in a (batch_size, beam_size) layout and reordered with
+        gather, each image gets the same output as calling beam_search on it alone
+        :param imgs: (batch_size, C, H, W)
+        :param word_map:
+        :param beam_size:
+        :param max_cap_length:
+        :return: a list of sentences and a list of encoded sentences, one for each image
+        '''
+        self.eval()
+        batch_size = imgs.size(0)
+        rev_word_map = {v: k for k, v in word_map.items()}
+        vocab_size = len(word_map)
+        complete_seqs = [[] for _ in range(batch_size)]
+        complete_seqs_scores = [[] for _ in range(batch_size)]
+        with torch.no_grad():
+            image_features, avg_feature = self.img_encoder(imgs) #
+            image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
+            image_feature_proj = image_feature_proj.view(batch_size, image_feature_proj.size(1), -1) # batch_size, hidden_dim, H*W
+            global_img_feature = self.relu(self.global_img_feature_proj(avg_feature))
+            if global_img_feature.dim() == 1:
+                global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
+            # the beams of image b are the rows b*beam_size ... (b+1)*beam_size-1, they share the same image features
+            memory = self.AdaAttention.prepare(image_feature_proj)
+            memory = tuple(m.repeat_interleave(beam_size, dim=0) for m in memory) # (V, img_proj) batch_size*beam_size, H*W, hidden_dim / H*W
+            global_img_feature = global_img_feature.repeat_interleave(beam_size, dim=0) # batch_size*beam_size, hidden_dim
+            state = self.init_hidden_state(memory[0])  #(ht, ct)
+            k_prev_words = torch.LongTensor([word_map['<start>']] * (batch_size * beam_size)).to(self.device) # (batch_size*beam_size,)
+            seqs = k_prev_words.view(batch_size, beam_size, 1) # (batch_size, beam_size, step+1)
+            # only the first beam is expanded at the first step, the dead beams are marked with -inf
+            top_k_scores = torch.full((batch_size, beam_size), float('-inf'), device=self.device, dtype=self.dtype)
+            top_k_scores[:, 0] = 0
+            unfinished_num = torch.LongTensor([beam_size] * batch_size).to(self.device) # (batch_size,)
+            beam_range = torch.arange(beam_size, device=self.device)
+            beam_offset = (torch.arange(batch_size, device=self.device) * beam_size).unsqueeze(1) # (batch_size, 1)
+            for step in range(max_cap_length):
+                word_embedding = self.embedding(k_prev_words) # batch_size*beam_size, embedding_dim
+                xt = torch.cat((word_embedding, global_img_feature), dim=-1) # batch_size*beam_size , 2 * embedding_dim
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
+                predict_score_t = torch.log_softmax(predict_score_t,dim=-1).view(batch_size, beam_size, vocab_size)
+                scores = top_k_scores.unsqueeze(2) + predict_score_t # (batch_size, beam_size, vocab_size)
+                top_k_scores, top_words = scores.view(batch_size, -1).topk(beam_size, -1, True, True) # (batch_size, beam_size)
+                beam_idx = top_words // vocab_size  # (batch_size, beam_size)
+                next_word_idx = top_words % vocab_size  # (batch_size, beam_size)
+                seqs = seqs.gather(1, beam_idx.unsqueeze(2).expand(-1, -1, seqs.size(2)))
+                seqs = torch.cat([seqs, next_word_idx.unsqueeze(2)], dim=2)
+                # as in beam_search, only the best unfinished_num candidates of each image are kept
+                selected = beam_range.unsqueeze(0) < unfinished_num.unsqueeze(1)
+                complete = selected & (next_word_idx == word_map['<end>'])
+                if complete.any():
+                    for b, k in complete.nonzero().tolist():
+                        complete_seqs[b].append(seqs[b, k].tolist())
+                        complete_seqs_scores[b].append(top_k_scores[b, k].item())
+                    unfinished_num = unfinished_num - complete.sum(1)
+                if unfinished_num.sum() == 0:
+                    break
+                top_k_scores = top_k_scores.masked_fill(~(selected & ~complete), float('-inf'))
+                #  update state
+                state_idx = (beam_idx + beam_offset).view(-1)
+                state = tuple(s.index_select(0, state_idx) for s in state)
+                k_prev_words = next_word_idx.view(-1)
+            sentences = []
+            sen_idxs = []
+            for b in range(batch_size):
+                if len(complete_seqs[b]) > 0:
+                    i = complete_seqs_scores[b].index(max(complete_seqs_scores[b]))
+                    seq = complete_seqs[b][i]
+                else:
+                    seq = seqs[b, top_k_scores[b].argmax()][:20].tolist()
+                sen_idx = [w for w in seq if w not in {word_map['<start>'], word_map['<end>'], word_map['<unk>'],word_map['<pad>']}]
+                sentences.append(' '.join([rev_word_map[sen_idx[i]] for i in range(len(sen_idx))]))
+                sen_idxs.append(sen_idx)
+            return sentences, sen_idxs
+
+    def lstm_forward(self, cell, xt, ht_m1, ct_m1):
+        '''
+        The same computation as cell(xt, (ht_m1, ct_m1)), the candidate cell input and the gates are returned as well
+        :param cell: nn.LSTMCell
+        :return: ht, ct, gt (before tanh), it, ft each with shape bs, hidden_dim
+        '''
+        z = torch.matmul(xt, cell.weight_ih.transpose(0, 1))  # (bs, 4*hidden_size)
+        z = z + torch.matmul(ht_m1, cell.weight_hh.transpose(0, 1))  # (bs, 4*hidden_size)
+        z = z + cell.bias_ih + cell.bias_hh
+        z0, z1, z2, z3 = z.chunk(4, dim=1)
+        i = torch.sigmoid(z0)
+        f = torch.sigmoid(z1)
+        c = f * ct_m1 + i * torch.tanh(z2)
+        o = torch.sigmoid(z3)
+        h = o * torch.tanh(c)
+        return h, c, z2, i, f
+
+    def beam_search_with_states(self, imgs, word_map, beam_size=3, max_cap_length=20):
+        '''
+        beam_search that also records the decoder intermediates of the winning hypothesis, the explainers use them
+        instead of running the encoder and the decoder a second time. Only suits for batch_size 1
+        :param imgs: (1, C, H, W)
+        :param word_map:
+        :param beam_size:
+        :param max_cap_length:
+        :return: sentence, sen_idx and a dict of the image features and the per-step states. The per-step states have
+                 one row for every step of the hypothesis (including the <end> step), seq holds the predicted words
+        '''
+        self.eval()
+        assert imgs.size(0) == 1
+        batch_size = imgs.size(0)
+        rev_word_map = {v: k for k, v in word_map.items()}
+        vocab_size = len(word_map)
+        complete_seqs =[]
+        complete_seqs_scores=[]
+        complete_rows = []
+        steps = []  # the intermediates of every step, each with shape (unfinished_num, ...)
+        with torch.no_grad():
+            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) # (beam_size,)
+            top_k_scores = torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) # (beam_size, 1)
+            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device)  # (unfinished_num, )
+            rows = torch.zeros(beam_size, 0, device=self.device, dtype=torch.long)  # the back pointers into steps
+            image_features, avg_feature = self.img_encoder(imgs) #
+            image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
+            image_feature_proj = image_feature_proj.view(batch_size, image_feature_proj.size(1), -1) # batch_size, hidden_dim, H*W
+            global_img_feature = self.relu(self.global_img_feature_proj(avg_feature))
+            if global_img_feature.dim() == 1:
+                global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
+            states = {'image_features': image_features,
+                      'avg_feature': avg_feature,
+                      'image_feature_proj': image_feature_proj,
+                      'global_img_feature': global_img_feature}
+            memory = self.AdaAttention.prepare(image_feature_proj)
+            memory = tuple(m.expand(beam_size, *m.size()[1:]) for m in memory) # (V, img_proj) beam_size, H*W, hidden_dim / H*W
+            global_img_feature = global_img_feature.expand(beam_size, global_img_feature.size(-1)) #  beam_size, hidden_dim,
+            state = self.init_hidden_state(memory[0])  #(ht, ct)
+            unfinished_num = beam_size
+            for step in range(max_cap_length):
+                word_embedding = self.embedding(k_prev_words).squeeze(1) # unfinished_num, embedding_dim
+                xt = torch.cat((word_embedding, global_img_feature), dim=-1) # unfinished_num , 2 * embedding_dim
+                ht, ct, gt, it_act, ft_act = self.lstm_forward(self.AdaLSTM.lstm_cell, xt, state[0], state[1])
+                sen_gate = torch.sigmoid(self.AdaLSTM.x_gate(xt) + self.AdaLSTM.h_gate(state[0]))
+                st = sen_gate * torch.tanh(ct)
+                context_t_hat, context_t, alpha_t, beta_t = self.AdaAttention(memory, ht, st) #(unfinished_num, hidden_dim), (unfinished_num, num_pixel), (unfinished_num,1)
+                predict_score_t = self.fc(context_t_hat + ht)  # (unfinished_num, vocab_size)
+                state = (ht, ct)
+                steps.append({'xt': xt, 'predictions': predict_score_t, 'alphas': alpha_t, 'betas': beta_t.squeeze(1),
+                              'ht': ht, 'ct': ct, 'gt': gt, 'it_act': it_act, 'ft_act': ft_act, 'st': st,
+                              'context': context_t, 'context_hat': context_t_hat})
+                predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(unfinished_num, vocab_size)
+                top_k_scores_exp = top_k_scores.expand((unfinished_num, vocab_size))
+                scores = top_k_scores_exp + predict_score_t
+                if step == 0:
+                    top_k_scores, top_words = scores[0].topk(beam_size, -1, True, True)  # (unfinished_num, beam_size)
+                else:
+                    top_k_scores, top_words = scores.view(-1).topk(unfinished_num, -1, True, True) # (unfinished_num, beam_size)
+                beam_idx = top_words // vocab_size  # (unfinished_num, )
+                next_word_idx = top_words % vocab_size  # (unfinished_num, )
+                seqs = torch.cat([seqs[beam_idx], next_word_idx.unsqueeze(1)], dim=1)
+                rows = torch.cat([rows[beam_idx], beam_idx.unsqueeze(1)], dim=1)
+                incomplete_inds = [ind for ind, next_word in enumerate(next_word_idx) if next_word != word_map['<end>']]
+                complete_inds = list(set(range(len(next_word_idx))) - set(incomplete_inds))
+                # Set aside complete sequences
+                if len(complete_inds) > 0:
+                    complete_seqs.extend(seqs[complete_inds].tolist())
+                    complete_seqs_scores.extend(top_k_scores[complete_inds])
+                    complete_rows.extend(rows[complete_inds].tolist())
+                unfinished_num = unfinished_num - len(complete_inds)  # reduce beam length accordingly
+                if unfinished_num == 0:
+                    break
+                # updata sequences
+                seqs = seqs[incomplete_inds]
+                rows = rows[incomplete_inds]
+                #  update state
+                state = tuple(s[beam_idx[incomplete_inds]] for s in state)
+                memory = tuple(m[beam_idx[incomplete_inds]] for m in memory)
+                global_img_feature = global_img_feature[beam_idx[incomplete_inds]]
+                top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
+                k_prev_words = next_word_idx[incomplete_inds].unsqueeze(1)
+            if len(complete_seqs) > 0:
+                i = complete_seqs_scores.index(max(complete_seqs_scores))
+                seq = complete_seqs[i]
+                seq_rows = complete_rows[i]
+            else:
+                seq = seqs[0][:20].tolist()
+                seq_rows = rows[0][:19].tolist()
+            # follow the back pointers to collect the states of the winning hypothesis
+            for name in steps[0]:
+                states[name] = torch.stack([steps[s][name][r] for s, r in enumerate(seq_rows)])
+            states['seq'] = seq[1:]
+            sen_idx = [w for w in seq if w not in {word_map['<start>'], word_map['<end>'], word_map['<unk>'],word_map['<pad>']}]
+            sentence = [' '.join([rev_word_map[sen_idx[i]] for i in range(len(sen_idx))])]
+            return sentence, sen_idx, states
+
     def greedy_search(self, imgs,  word_map, max_cap_length=20):
         self.eval()
         batch_size = imgs.size(0)
         rev_word_map = {v: k for k, v in word_map.items()}
         complete_sentences =[]
         with torch.no_grad():
-            k_prev_words = torch.zeros(batch_size, max_cap_length).long().cuda() # (batch_size, caption_length)
+            k_prev_words = torch.zeros(batch_size, max_cap_length, device=self.device, dtype=torch.long) # (batch_size, caption_length)
             k_prev_words[:, 0] = word_map['<start>'] # the first word is '<start>'
             seqs_temp = [[word_map['<start>']] for _ in range(batch_size)]
             image_features, avg_feature = self.img_encoder(imgs) #
             image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
             image_feature_proj = image_feature_proj.view(batch_size, image_feature_proj.size(1), -1)
             global_img_feature = self.relu(self.global_img_feature_proj(avg_feature))  # batch_size, hidden_dim
+            memory = self.AdaAttention.prepare(image_feature_proj)
             state = self.init_hidden_state(image_feature_proj)  #(ht, ct)
             for step in range(max_cap_length-1):
                 word_embedding = self.embedding(k_prev_words[:, step]) # batch_size, embedding_dim
                 if global_img_feature.dim() == 1:
                     global_img_feature = global_img_feature.unsqueeze(0)
                 xt = torch.cat((word_embedding, global_img_feature), dim=-1) # batch_size , 2 * embedding_dim
-                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
                 predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(batch_size, vocab_size)
                 top_scores, top_words = predict_score_t.topk(1, -1, True, True)
                 if step == 0:
@@ -500,10 +709,12 @@ class ExplainAdaptiveAttention(object):
             self.model = model
         else:
             self.model = AdaptiveAttentionCaptioningModel(args.embed_dim, args.hidden_dim, len(word_map), args.encoder)
-            checkpoint = torch.load(args.weight)
+            checkpoint = torch.load(args.weight, map_location=args.device)
             self.model.load_state_dict(checkpoint['state_dict'])
-            self.model.cuda()
+            self.model.to(args.device)
         self.model.eval()
+        self.device = self.model.device
+        self.dtype = self.model.dtype
 
         self.mean = [0.485, 0.456, 0.406]
         self.std = [0.229, 0.224, 0.225]
@@ -522,6 +733,20 @@ class ExplainAdaptiveAttention(object):
         if not os.path.isdir(self.visualizatioin_save_path):
             os.makedirs(self.visualizatioin_save_path)
 
+        # a DecodeCache shared with the other explainers of the model, None decodes every image here
+        self.decode_cache = None
+        # everything set so far lives as long as the explainer, the rest is per-image state dropped by reset
+        self.session_attributes = set(self.__dict__) | {'session_attributes'}
+
+    def reset(self):
+        '''
+        drops the per-image state (the image, the caption, the hidden states and the relevance), the model is kept so
+        that the explainer can be reused for the next image
+        '''
+        for name in set(self.__dict__) - self.session_attributes:
+            delattr(self, name)
+        self.model.zero_grad()
+
     def lrp_linear_eps(self, r_out, forward_input, forward_output, weight):
         '''
 
@@ -531,24 +756,12 @@ class ExplainAdaptiveAttention(object):
         :param weight:  weight tensor shape (out_feature, in_feature)
         :return: r_in (in_feature,)
         '''
-        attribution = weight * forward_input #(out_feature, in_feature)
-        # print(attribution.size())
-        if type(forward_output) == bool:
-            forward_output = torch.matmul(forward_input, weight.transpose(0,1))
-        forward_output_eps = self.EPS * forward_output.sign() + forward_output  # Z.sign() returns -1 or 0 or 1
-
-        forward_output_eps.masked_fill_(forward_output_eps == 0, self.EPS)  #(out_feature,)
-        # print(forward_output_eps.size())
-        attribution_norm = attribution.transpose(0,1) / forward_output_eps #(in_feature, out_feature)
-        # print(attribution_norm.size())
-        relevance_input = torch.sum(attribution_norm * r_out, dim=1) #(in_feature,)
-        torch.cuda.empty_cache()
-        return relevance_input
+        return lrp_rules.lrp_linear_eps(r_out, forward_input, forward_output, weight, self.EPS)
 
     def preprocess_img(self, img_filepath):
         image_data = Image.open(img_filepath).convert('RGB')
         img = self.img_transform(image_data)
-        img = img.unsqueeze(0).cuda()
+        img = img.unsqueeze(0).to(self.device, self.dtype)
         return img
 
     def adalstm_forward(self, xt, ht_m1, ct_m1):
@@ -578,21 +791,22 @@ class ExplainAdaptiveAttention(object):
         self.image_feature_proj = self.image_feature_proj.contiguous()
         self.image_feature_proj = self.image_feature_proj.view(1, self.model.hidden_dim, -1)  # (bs, hidden_dim, num_pixel)
         self.caption_length = len(self.beam_caption_encode) - 1
-        self.predictions = torch.zeros(self.caption_length, self.vocab_size).cuda()
-        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim).cuda()
-        self.betas = torch.zeros(self.caption_length).cuda()
-        self.alphas = torch.zeros(self.caption_length, self.num_pixels).cuda()
-        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.st = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
+        self.predictions = torch.zeros(self.caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.betas = torch.zeros(self.caption_length, device=self.device, dtype=self.dtype)
+        self.alphas = torch.zeros(self.caption_length, self.num_pixels, device=self.device, dtype=self.dtype)
+        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.st = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         caption = [self.word_map['<start>']]
+        memory = self.model.AdaAttention.prepare(self.image_feature_proj)
         for t in range(50):
-            it = torch.LongTensor([caption[t]]).cuda()
+            it = torch.LongTensor([caption[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if self.global_img_feature.dim() == 1:
                 self.global_img_feature = self.global_img_feature.unsqueeze(0)
@@ -602,7 +816,7 @@ class ExplainAdaptiveAttention(object):
             h_t, c_t, g_t, i_t_act, f_t_act = self.adalstm_forward(x_t, ht_m1, ct_m1)
             sen_gate = torch.sigmoid(self.model.AdaLSTM.x_gate(x_t) + self.model.AdaLSTM.h_gate(ht_m1))
             s_t = sen_gate * torch.tanh(c_t)
-            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(self.image_feature_proj, h_t.unsqueeze(0), s_t) #(1, hidden_dim), (1, num_pixel), (1,1)
+            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(memory, h_t.unsqueeze(0), s_t) #(1, hidden_dim), (1, num_pixel), (1,1)
             predict_score_t = self.model.fc(context_t_hat + h_t) #(1, vocab_size)
             label = torch.argmax(predict_score_t)
             if label == self.word_map['<end>']:
@@ -623,11 +837,40 @@ class ExplainAdaptiveAttention(object):
             self.context[t] = context_t[0]
             self.context_hat[t] = context_t_hat[0]
 
+    def decode(self, img_filepath, beam_size, max_cap_length):
+        '''
+        preprocesses the image and runs beam_search_with_states. With a decode_cache the image is decoded only once for
+        all the explainers sharing it, and they all explain the same caption
+        :return: img, beam_caption, beam_caption_encode, states
+        '''
+        if self.decode_cache is not None:
+            return self.decode_cache.decode(self, img_filepath)
+        img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
+        beam_caption, beam_caption_encode, states = self.model.beam_search_with_states(img, self.word_map,
+                                                                                       beam_size=beam_size,
+                                                                                       max_cap_length=max_cap_length)
+        return img, beam_caption, beam_caption_encode, states
+
     def get_hidden_parameters(self, img_filepath ):
-        self.img = self.preprocess_img(img_filepath) #(bs, C, H, W)
-        self.beam_caption, self.beam_caption_encode = self.model.beam_search(self.img, self.word_map, beam_size=3, max_cap_length=20)
+        self.img, self.beam_caption, self.beam_caption_encode, states = self.decode(img_filepath, beam_size=3, max_cap_length=20)
         self.beam_caption_encode = [self.word_map['<start>']] + self.beam_caption_encode
         print(f'the predicted caption of {img_filepath} is "{self.beam_caption[0]}"')
+        self.caption_length = len(self.beam_caption_encode) - 1
+        if states['seq'][:self.caption_length] != self.beam_caption_encode[1:]:
+            # a word such as <unk> was dropped from the caption, the recorded states do not match it
+            self.replay_hidden_parameters()
+            return
+        # the intermediate variables recorded by the beam search
+        for name in ['image_features', 'avg_feature', 'image_feature_proj', 'global_img_feature']:
+            setattr(self, name, states[name])
+        self.num_pixels = self.image_features.size(-1) * self.image_features.size(-2)
+        for name in ['xt', 'predictions', 'alphas', 'betas', 'gt', 'it_act', 'ft_act', 'st', 'context', 'context_hat']:
+            setattr(self, name, states[name][:self.caption_length])
+        init_state = torch.zeros(1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        for name in ['ht', 'ct']:
+            setattr(self, name, torch.cat((init_state, states[name][:self.caption_length]), dim=0))  # (caption_length+1, hidden_dim)
+
+    def replay_hidden_parameters(self):
         # perform the forward pass and save the intermediate variables
         self.image_features, self.avg_feature = self.model.img_encoder(self.img)  # (bs, fea_dim, H, W), (bs, fea_dim)
         self.num_pixels = self.image_features.size(-1) * self.image_features.size(-2)
@@ -636,20 +879,21 @@ class ExplainAdaptiveAttention(object):
         self.image_feature_proj = self.image_feature_proj.contiguous()
         self.image_feature_proj = self.image_feature_proj.view(1, self.model.hidden_dim, -1)  # (bs, hidden_dim, num_pixel)
         self.caption_length = len(self.beam_caption_encode) - 1
-        self.predictions = torch.zeros(self.caption_length, self.vocab_size).cuda()
-        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim).cuda()
-        self.betas = torch.zeros(self.caption_length).cuda()
-        self.alphas = torch.zeros(self.caption_length, self.num_pixels).cuda()
-        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.st = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
+        self.predictions = torch.zeros(self.caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.betas = torch.zeros(self.caption_length, device=self.device, dtype=self.dtype)
+        self.alphas = torch.zeros(self.caption_length, self.num_pixels, device=self.device, dtype=self.dtype)
+        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.st = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        memory = self.model.AdaAttention.prepare(self.image_feature_proj)
         for t in range(self.caption_length):
-            it = torch.LongTensor([self.beam_caption_encode[t]]).cuda()
+            it = torch.LongTensor([self.beam_caption_encode[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if self.global_img_feature.dim() == 1:
                 self.global_img_feature = self.global_img_feature.unsqueeze(0)
@@ -659,7 +903,7 @@ class ExplainAdaptiveAttention(object):
             h_t, c_t, g_t, i_t_act, f_t_act = self.adalstm_forward(x_t, ht_m1, ct_m1)
             sen_gate = torch.sigmoid(self.model.AdaLSTM.x_gate(x_t) + self.model.AdaLSTM.h_gate(ht_m1))
             s_t = sen_gate * torch.tanh(c_t)
-            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(self.image_feature_proj, h_t.unsqueeze(0), s_t) #(1, hidden_dim), (1, num_pixel), (1,1)
+            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(memory, h_t.unsqueeze(0), s_t) #(1, hidden_dim), (1, num_pixel), (1,1)
             predict_score_t = self.model.fc(context_t_hat + h_t) #(1, vocab_size)
             # here we save the intermediate states for further relevance backpropagation
             # print(x_t.size(), predict_score_t.size(), alpha_t.size(), beta_t.size(), h_t.size(), c_t.size(), g_t.size(), i_t_act.size(), f_t_act.size(),s_t.size(),context_t.size(),context_t_hat.size())
@@ -687,51 +931,49 @@ class ExplainAdaptiveAttention(object):
         weight_g = torch.cat((weight_ig, weight_hg), dim=1) #(hidden_dim, 2 * hidden_dim+embed_dim)
         xht = torch.cat((self.xt[:preceeding_cap_length], self.ht[:preceeding_cap_length]), dim=1) #(preceeding_length, 2*hidden_dim+embed_dim)
         predict_score_t = self.predictions[t] #(vocat_size,)
-        word_relevance = torch.zeros(1, self.vocab_size).cuda()
-        word_relevance[0, target_word_encode] = predict_score_t[target_word_encode]
-        self.r_ht = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        self.r_ct = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
+        word_relevance = torch.zeros(self.vocab_size, device=self.device, dtype=self.dtype)
+        word_relevance[target_word_encode] = predict_score_t[target_word_encode]
+        self.r_ht = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_ct = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         # r_gt = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        self.r_xht = torch.zeros(preceeding_cap_length, self.model.hidden_dim+ 2 * self.model.embed_dim).cuda()
-        self.r_global_img_feature = torch.zeros(self.model.embed_dim).cuda()
-        self.r_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim).cuda()
-        self.r_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim).cuda()
-        self.r_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim).cuda()
+        self.r_xht = torch.zeros(preceeding_cap_length, self.model.hidden_dim+ 2 * self.model.embed_dim, device=self.device, dtype=self.dtype)
+        self.r_global_img_feature = torch.zeros(self.model.embed_dim, device=self.device, dtype=self.dtype)
+        self.r_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim, device=self.device, dtype=self.dtype)
         r_ht_context = self.lrp_linear_eps(r_out=word_relevance,
                                            forward_input=self.ht[t+1]+self.context_hat[t],
                                            forward_output=predict_score_t,
                                            weight=self.output_weight)
         # print('r_ht_context',r_ht_context.size())
-        self.r_ht[t+1] = self.lrp_linear_eps(r_out=r_ht_context,
-                                             forward_input=self.ht[t+1],
-                                             forward_output=self.ht[t+1]+self.context_hat[t],
-                                             weight=torch.eye(self.model.hidden_dim).cuda())
-
-        r_context_hat = self.lrp_linear_eps(r_out=r_ht_context,
-                                            forward_input=self.context_hat[t],
-                                            forward_output=self.ht[t+1]+self.context_hat[t],
-                                            weight=torch.eye(self.model.hidden_dim).cuda())
-        r_context = self.lrp_linear_eps(r_out=r_context_hat,
-                                        forward_input=(1-self.betas[t])*self.context[t],
-                                        forward_output=self.context_hat[t],
-                                        weight=torch.eye(self.model.hidden_dim).cuda())
+        self.r_ht[t+1] = lrp_rules.lrp_elementwise_eps(r_out=r_ht_context,
+                                                       forward_input=self.ht[t+1],
+                                                       forward_output=self.ht[t+1]+self.context_hat[t],
+                                                       eps=self.EPS)
+
+        r_context_hat = lrp_rules.lrp_elementwise_eps(r_out=r_ht_context,
+                                                      forward_input=self.context_hat[t],
+                                                      forward_output=self.ht[t+1]+self.context_hat[t],
+                                                      eps=self.EPS)
+        r_context = lrp_rules.lrp_elementwise_eps(r_out=r_context_hat,
+                                                  forward_input=(1-self.betas[t])*self.context[t],
+                                                  forward_output=self.context_hat[t],
+                                                  eps=self.EPS)
         # print('r_context',r_context.size())
-        r_st = self.lrp_linear_eps(r_out=r_context_hat,
-                                   forward_input=self.betas[t]*self.st[t],
-                                   forward_output=self.context_hat[t],
-                                   weight=torch.eye(self.model.hidden_dim).cuda())
+        r_st = lrp_rules.lrp_elementwise_eps(r_out=r_context_hat,
+                                             forward_input=self.betas[t]*self.st[t],
+                                             forward_output=self.context_hat[t],
+                                             eps=self.EPS)
         # print('r_st', r_st.size())
         self.r_ct[t+1] = r_st
         for i in range(preceeding_cap_length)[::-1]:
             self.r_ct[i+1] = self.r_ct[i+1] + self.r_ht[i+1]
-            r_gt = self.lrp_linear_eps(r_out=self.r_ct[i + 1],
-                                       forward_input=self.it_act[i] * torch.tanh(self.gt[i]),
-                                       forward_output=self.ct[i+1],
-                                       weight=torch.eye(self.model.hidden_dim).cuda())
-            self.r_ct[i] = self.lrp_linear_eps(r_out=self.r_ct[i + 1],
-                                               forward_input=self.ft_act[i] * self.ct[i],
-                                               forward_output=self.ct[i+1],
-                                               weight=torch.eye(self.model.hidden_dim).cuda())
+            r_gt = lrp_rules.lrp_elementwise_eps(r_out=self.r_ct[i + 1],
+                                                 forward_input=self.it_act[i] * torch.tanh(self.gt[i]),
+                                                 forward_output=self.ct[i+1],
+                                                 eps=self.EPS)
+            self.r_ct[i] = lrp_rules.lrp_elementwise_eps(r_out=self.r_ct[i + 1],
+                                                         forward_input=self.ft_act[i] * self.ct[i],
+                                                         forward_output=self.ct[i+1],
+                                                         eps=self.EPS)
             self.r_xht[i] = self.lrp_linear_eps(r_out=r_gt,
                                                 forward_input=xht[i],
                                                 forward_output=torch.tanh(self.gt[i]),
@@ -748,19 +990,20 @@ class ExplainAdaptiveAttention(object):
         image_feature = self.image_features.view(1, self.model.encoder_raw_dim, self.num_pixels)
         image_feature = image_feature.transpose(1,2).squeeze(0) #(num_pixel, encode_raw_dim)
         image_feature_proj = self.image_feature_proj.transpose(1,2).squeeze(0) #(num_pixel, hidden_dim)
-        for i in range(self.num_pixels):
-            self.r_img_feature[i] = self.lrp_linear_eps(r_out=r_average_img_feature,
-                                                        forward_input=image_feature[i]/self.num_pixels,
-                                                        forward_output=self.avg_feature,
-                                                        weight=torch.eye(self.model.encoder_raw_dim).cuda())
-            self.r_img_feature_proj[i] = self.lrp_linear_eps(r_out=r_context,
-                                                             forward_input=image_feature_proj[i] * self.alphas[t][i],
-                                                             forward_output=self.context[t],
-                                                             weight=torch.eye(self.model.hidden_dim).cuda())
-            self.r_img_feature[i] = self.r_img_feature[i] + self.lrp_linear_eps(r_out=self.r_img_feature_proj[i],
-                                                                                forward_input=image_feature[i],
-                                                                                forward_output=False,
-                                                                                weight=self.model.img_projector.weight.squeeze(-1).squeeze(-1))
+        # all the pixels are explained at once, the rules are applied row-wise
+        self.r_img_feature = lrp_rules.lrp_elementwise_eps(r_out=r_average_img_feature,
+                                                           forward_input=image_feature/self.num_pixels,
+                                                           forward_output=self.avg_feature,
+                                                           eps=self.EPS)  #(num_pixel, encode_raw_dim)
+        self.r_img_feature_proj = lrp_rules.lrp_elementwise_eps(r_out=r_context,
+                                                                forward_input=image_feature_proj * self.alphas[t].unsqueeze(1),
+                                                                forward_output=self.context[t],
+                                                                eps=self.EPS)  #(num_pixel, hidden_dim)
+        self.r_img_feature = self.r_img_feature + lrp_rules.lrp_linear_eps(r_out=self.r_img_feature_proj,
+                                                                           forward_input=image_feature,
+                                                                           forward_output=False,
+                                                                           weight=self.model.img_projector.weight.squeeze(-1).squeeze(-1),
+                                                                           eps=self.EPS)
         r_words = torch.sum(self.r_word_embedding, dim=-1)
         max_abs_r_words = torch.max(torch.abs(r_words))
         if max_abs_r_words > 0:
@@ -772,22 +1015,23 @@ class ExplainAdaptiveAttention(object):
 
     def explain_cnn(self, r_img_feature):
         # cnn_encoder = copy.deepcopy(self.model.img_encoder.encoder)
-        relevance_img = self.model.img_encoder.encoder.compute_lrp(self.img, target=r_img_feature)
+        # r_img_feature can stack the relevance of several words, they are explained in one batch
+        relevance_img = lrp_engine.compute_lrp(self.model.img_encoder.encoder, self.img, r_img_feature)
         print(torch.sum(relevance_img > 0), torch.sum(relevance_img == 0), torch.sum(relevance_img < 0))
         return relevance_img
 
     def explain_caption(self, img_filepath, t_list=None):
         self.img_filepath = img_filepath
         self.get_hidden_parameters(img_filepath)
-        relevance_imgs = []
+        relevance_img_features = []
         relevance_preceeding_words = []
-        lrp_wrapper.add_lrp(self.model.img_encoder.encoder)
         for t in range(self.caption_length):
             with torch.no_grad():
                 relevance_img_feature, r_words = self.explain_caption_wordt(t)
-            relevance_img = self.explain_cnn(relevance_img_feature)
-            relevance_imgs.append(relevance_img)
+            relevance_img_features.append(relevance_img_feature)
             relevance_preceeding_words.append(r_words)
+        relevance_img = self.explain_cnn(torch.cat(relevance_img_features, dim=0)) #(caption_length, 3, H, W)
+        relevance_imgs = list(relevance_img.split(1))
         assert len(relevance_imgs) == self.caption_length
         self.visualize_explanations(relevance_imgs, t=t_list)
         self.save_linguistic_explanation(relevance_preceeding_words)
@@ -850,16 +1094,21 @@ class ExplainAdaptiveAttention(object):
 
 class ExplainAdaptiveGradient(object):
     EX_TYPE = 'gradient'
-    def __init__(self, args, word_map):
+    def __init__(self, args, word_map, model=None):
         super(ExplainAdaptiveGradient, self).__init__()
         self.args = args
         self.word_map = word_map
         self.vocab_size = len(word_map)
-        self.model = AdaptiveAttentionCaptioningModel(args.embed_dim, args.hidden_dim, len(word_map), args.encoder)
-        checkpoint = torch.load(args.weight)
-        self.model.load_state_dict(checkpoint['state_dict'])
-        self.model.cuda()
+        if model is not None:
+            self.model = model
+        else:
+            self.model = AdaptiveAttentionCaptioningModel(args.embed_dim, args.hidden_dim, len(word_map), args.encoder)
+            checkpoint = torch.load(args.weight, map_location=args.device)
+            self.model.load_state_dict(checkpoint['state_dict'])
+            self.model.to(args.device)
         self.model.eval()
+        self.device = self.model.device
+        self.dtype = self.model.dtype
         self.mean = [0.485, 0.456, 0.406]
         self.std = [0.229, 0.224, 0.225]
         self.img_transform = transforms.Compose([transforms.Resize(size=(args.height, args.width)),
@@ -877,6 +1126,20 @@ class ExplainAdaptiveGradient(object):
         if not os.path.isdir(self.visualizatioin_save_path):
             os.makedirs(self.visualizatioin_save_path)
 
+        # a DecodeCache shared with the other explainers of the model, None decodes every image here
+        self.decode_cache = None
+        # everything set so far lives as long as the explainer, the rest is per-image state dropped by reset
+        self.session_attributes = set(self.__dict__) | {'session_attributes'}
+
+    def reset(self):
+        '''
+        drops the per-image state (the image, the caption, the hidden states and the relevance), the model is kept so
+        that the explainer can be reused for the next image
+        '''
+        for name in set(self.__dict__) - self.session_attributes:
+            delattr(self, name)
+        self.model.zero_grad()
+
     def adalstm_forward(self, xt, ht_m1, ct_m1):
         z = torch.matmul(self.adalstm_weight_i, xt.squeeze(0))  #(4*hidden_size, )
         z = z + torch.matmul(self.adalstm_weight_h, ht_m1) #(4*hidden_size,)
@@ -894,43 +1157,58 @@ class ExplainAdaptiveGradient(object):
     def preprocess_img(self, img_filepath):
         image_data = Image.open(img_filepath).convert('RGB')
         img = self.img_transform(image_data)
-        img = img.unsqueeze(0).cuda()
+        img = img.unsqueeze(0).to(self.device, self.dtype)
         return img
 
+    def decode(self, img_filepath, beam_size, max_cap_length):
+        '''
+        preprocesses the image, runs the beam search and the encoder. With a decode_cache the image is decoded only once
+        for all the explainers sharing it, and they all explain the same caption
+        :return: img, beam_caption, beam_caption_encode and a dict of the image_features and the avg_feature
+        '''
+        if self.decode_cache is not None:
+            return self.decode_cache.decode(self, img_filepath)
+        img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
+        beam_caption, beam_caption_encode = self.model.beam_search(img, self.word_map, beam_size=beam_size,
+                                                                   max_cap_length=max_cap_length)
+        image_features, avg_feature = self.model.img_encoder(img)  # (bs, fea_dim, H, W), (bs, fea_dim)
+        return img, beam_caption, beam_caption_encode, {'image_features': image_features, 'avg_feature': avg_feature}
+
     def get_hidden_parameters(self, img_filepath):
-        self.img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
-        self.beam_caption, self.beam_caption_encode = self.model.beam_search(self.img, self.word_map, beam_size=3,
-                                                                             max_cap_length=20)
+        self.img, self.beam_caption, self.beam_caption_encode, states = self.decode(img_filepath, beam_size=3,
+                                                                                    max_cap_length=20)
         self.beam_caption_encode = [self.word_map['<start>']] + self.beam_caption_encode
         print(f'the predicted caption of {img_filepath} is "{self.beam_caption[0]}"')
         # perform the forward pass and save the intermediate variables
-        self.image_features, self.avg_feature = self.model.img_encoder(self.img)  # (bs, fea_dim, H, W), (bs, fea_dim)
+        self.image_features = states['image_features']  # (bs, fea_dim, H, W)
+        self.avg_feature = states['avg_feature']  # (bs, fea_dim)
         self.num_pixels = self.image_features.size(-1) * self.image_features.size(-2)
         self.image_feature_proj = self.model.relu(self.model.img_projector(self.image_features))  # (bs, hiddendim, H, W)
         self.global_img_feature = self.model.relu(self.model.global_img_feature_proj(self.avg_feature))  # (bs, embedding_dim)
         self.image_feature_proj = self.image_feature_proj.contiguous()
         self.image_feature_proj = self.image_feature_proj.view(1, self.model.hidden_dim, -1)  # (bs, hidden_dim, num_pixel)
         self.caption_length = len(self.beam_caption_encode) - 1
-        self.predictions = torch.zeros(self.caption_length, self.vocab_size).cuda()
-        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim).cuda()
-        self.betas = torch.zeros(self.caption_length).cuda()
-        self.alphas = torch.zeros(self.caption_length, self.num_pixels).cuda()
-        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.it = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ft = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ot = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.gt_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ot_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.st = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.sen_gate = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
+        self.predictions = torch.zeros(self.caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.betas = torch.zeros(self.caption_length, device=self.device, dtype=self.dtype)
+        self.alphas = torch.zeros(self.caption_length, self.num_pixels, device=self.device, dtype=self.dtype)
+        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.it = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ft = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ot = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.gt_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ot_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.st = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.sen_gate = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        memory = self.model.AdaAttention.prepare(self.image_feature_proj)
         for t in range(self.caption_length):
-            it = torch.LongTensor([self.beam_caption_encode[t]]).cuda()
+            it = torch.LongTensor([self.beam_caption_encode[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if self.global_img_feature.dim() == 1:
                 self.global_img_feature = self.global_img_feature.unsqueeze(0)
@@ -940,7 +1218,7 @@ class ExplainAdaptiveGradient(object):
             h_t, c_t, i_t, f_t, g_t, o_t, i_t_act, f_t_act, g_t_act, o_t_act = self.adalstm_forward(x_t, ht_m1, ct_m1)
             sen_gate_t = torch.sigmoid(self.model.AdaLSTM.x_gate(x_t) + self.model.AdaLSTM.h_gate(ht_m1))
             s_t = sen_gate_t * torch.tanh(c_t)
-            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(self.image_feature_proj, h_t.unsqueeze(0), s_t)  # (1, hidden_dim), (1, num_pixel), (1,1)
+            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(memory, h_t.unsqueeze(0), s_t)  # (1, hidden_dim), (1, num_pixel), (1,1)
             predict_score_t = self.model.fc(context_t_hat + h_t)  # (1, vocab_size)
             # here we save the intermediate states for further relevance backpropagation
             self.sen_gate[t] = sen_gate_t[0]
@@ -966,23 +1244,23 @@ class ExplainAdaptiveGradient(object):
         assert t < self.caption_length  #(t starts from 0)
         preceeding_cap_length = t+1
         target_word_encode = self.beam_caption_encode[t+1]
-        d_word_pred = torch.zeros(1, self.vocab_size).cuda()
+        d_word_pred = torch.zeros(1, self.vocab_size, device=self.device, dtype=self.dtype)
         d_word_pred[0, target_word_encode] = 1  #(1, vocab_size)
-        d_ht = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_ct = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_it = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ft = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_gt = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ot = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_it_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ft_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_gt_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ot_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_xt = torch.zeros(preceeding_cap_length, 2* self.model.embed_dim).cuda()
-        d_global_img_feature = torch.zeros(self.model.embed_dim).cuda()
-        d_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim).cuda()
-        d_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim).cuda()
-        d_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim).cuda()
+        d_ht = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ct = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_it = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ft = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_gt = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ot = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_it_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ft_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_gt_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ot_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_xt = torch.zeros(preceeding_cap_length, 2* self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_global_img_feature = torch.zeros(self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim, device=self.device, dtype=self.dtype)
+        d_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         #backward starts
         d_ht_context = torch.matmul(d_word_pred, self.output_weight).squeeze()
         d_c_hat = d_ht_context * 1
@@ -1101,23 +1379,23 @@ class ExplainiAdaptiveGuidedGradient(ExplainAdaptiveGradient):
         assert t < self.caption_length  #(t starts from 0)
         preceeding_cap_length = t+1
         target_word_encode = self.beam_caption_encode[t+1]
-        d_word_pred = torch.zeros(1, self.vocab_size).cuda()
+        d_word_pred = torch.zeros(1, self.vocab_size, device=self.device, dtype=self.dtype)
         d_word_pred[0, target_word_encode] = 1  #(1, vocab_size)
-        d_ht = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_ct = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_it = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ft = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_gt = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ot = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_it_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ft_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_gt_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ot_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_xt = torch.zeros(preceeding_cap_length, self.model.hidden_dim + self.model.embed_dim).cuda()
-        d_global_img_feature = torch.zeros(self.model.embed_dim).cuda()
-        d_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim).cuda()
-        d_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim).cuda()
-        d_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim).cuda()
+        d_ht = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ct = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_it = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ft = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_gt = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ot = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_it_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ft_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_gt_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ot_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_xt = torch.zeros(preceeding_cap_length, self.model.hidden_dim + self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_global_img_feature = torch.zeros(self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim, device=self.device, dtype=self.dtype)
+        d_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         #backward starts
         d_ht_context = torch.matmul(d_word_pred, self.output_weight).squeeze()
         d_c_hat = d_ht_context * 1
@@ -1287,7 +1565,7 @@ class ExplainAdaptiveGuidedGradCam(ExplainiAdaptiveGuidedGradient):
         cam = self.grad_cam(self.image_features, d_img_feature)
         # cam = F.interpolate(cam.unsqueeze(0).unsqueeze(0), size=(self.img.size(2), self.img.size(3)), mode='bilinear', align_corners=True)
         cam = skimage.transform.pyramid_expand(cam.detach().cpu().numpy(), upscale=32,multichannel=False)
-        guided_results = guided_gradient * torch.from_numpy(cam).cuda().float().expand_as(guided_gradient)
+        guided_results = guided_gradient * torch.from_numpy(cam).to(self.device, self.dtype).expand_as(guided_gradient)
         del cnn_encoder
         return guided_results
 
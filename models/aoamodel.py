@@ -11,8 +11,9 @@ from matplotlib import pyplot as plt
 import torchvision.transforms as transforms
 import gc
 import os
-from LRPtools import lrp_wrapper
+from LRPtools import lrp_engine
 from LRPtools import utils as LRPutil
+from LRPtools import lrp_rules
 import yaml
 import skimage.transform
 from nltk.corpus import stopwords
@@ -139,22 +140,40 @@ class AOAModel(nn.Module):
         self.relu = nn.ReLU()
         # self.refiner_batchnorm = nn.BatchNorm1d(hidden_dim, track_running_stats=True)
 
+    @property
+    def device(self):
+        # the device and dtype follow the parameters, call model.to(device, dtype) to move the model
+        return self.fc.weight.device
+
+    @property
+    def dtype(self):
+        return self.fc.weight.dtype
+
     def init_hidden_state(self, V):
-        h = torch.zeros(V.shape[0], self.hidden_dim).cuda()
-        c = torch.zeros(V.shape[0], self.hidden_dim).cuda()
+        h = torch.zeros(V.shape[0], self.hidden_dim, device=self.device, dtype=self.dtype)
+        c = torch.zeros(V.shape[0], self.hidden_dim, device=self.device, dtype=self.dtype)
         return h, c
 
-    def predict_next_word(self,image_feature_proj, xt, states):
+    def project_memory(self, image_feature_proj):
+        '''
+        The projected keys and values only depend on the image, they are computed once per image and reused at every step
+        :param image_feature_proj: bs, num_pixel, hidden_dim
+        :return: (key, value) each with shape bs, num_pixel, hidden_dim
+        '''
+        key = self.decoder_k_proj(image_feature_proj)
+        value = self.decoder_v_proj(image_feature_proj)
+        return key, value
+
+    def predict_next_word(self, memory, xt, states):
         '''
-        :param image_feature_proj:  bs, num_pixel, hidden_dim
+        :param memory: (key, value) returned by project_memory, each with shape bs, num_pixel, hidden_dim
         :param xt: bs, hidden_dim + embedding dim
         :param states: (ht, ct, context) each with shape bs, hidden_dim
         :return:
         '''
         htm1, ctm1 = states  # (bs, hidden_dim, )
         ht, ct = self.LanguageLSTM(xt, (htm1, ctm1))
-        key = self.decoder_k_proj(image_feature_proj) # batch_size, num_pixel, 2 * hiddendim this is the concatenated key and value
-        value = self.decoder_v_proj(image_feature_proj)
+        key, value = memory
         context, alpha_t = self.decoder_multihead_attention(ht, key, value) #(bs, hidden_dim) alpha: (bs, num_pixel)
         context_aoa_gate = self.decoder_aoa_linear_gate(ht)
         context_aoa_linear = self.decoder_aoa_linear(context)
@@ -180,15 +199,16 @@ class AOAModel(nn.Module):
         image_feature_proj = image_feature_proj.transpose(1,2) #(bs, num_pixel, hidden_dim)
         global_img_feature = torch.mean(image_feature_proj, dim=1) #(bs, hidden_dim)
         h, c = self.init_hidden_state(image_feature_proj)
+        memory = self.project_memory(image_feature_proj)
         state = (h, c)
         max_length = max(caption_lengths)-1
-        predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
+        predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
         if ss_prob is None:
             ss_flag = False
         else:
             random_num = np.random.uniform(0.0, 1.0, size=(batch_size,))
             ss_mask = random_num < ss_prob
-            ss_mask = torch.from_numpy(ss_mask).long().cuda()
+            ss_mask = torch.from_numpy(ss_mask).long().to(self.device)
             if ss_mask.sum() > 0:
                 ss_flag = True
             else:
@@ -203,7 +223,7 @@ class AOAModel(nn.Module):
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
             xt = torch.cat((word_embedding, global_img_feature), dim=-1)   # (batch_size, hidden_dim + embed_dim)
-            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
             predictions[:, t,:] = predict_score_t
             last_scores = torch.log_softmax(predict_score_t,-1)
             # print(last_scores.size())
@@ -224,17 +244,18 @@ class AOAModel(nn.Module):
         image_feature_proj = image_feature_proj.transpose(1, 2)  # (bs, num_pixel, hidden_dim)
         global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
         h, c = self.init_hidden_state(image_feature_proj)
+        memory = self.project_memory(image_feature_proj)
         state = (h, c)
-        seq = torch.zeros(batch_size,max_length).long().cuda()
-        seq_logprobs = torch.zeros(batch_size, max_length).cuda()
+        seq = torch.zeros(batch_size,max_length, device=self.device, dtype=torch.long)
+        seq_logprobs = torch.zeros(batch_size, max_length, device=self.device, dtype=self.dtype)
         for t in range(max_length):
             if t == 0:
-                it = torch.ones(batch_size).long().cuda() * word_map['<start>']
+                it = torch.ones(batch_size, device=self.device, dtype=torch.long) * word_map['<start>']
             word_embedding = self.embedding(it)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
             xt = torch.cat((word_embedding,  global_img_feature), dim=-1)  # (batch_size, 2*embed_dim)
-            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
             predict_score_t = torch.log_softmax(predict_score_t,dim=-1)
             it, sampleLpgprobs = self.sample_next_word(predict_score_t, sample_method, temperature)
             # sample the next word
@@ -258,7 +279,7 @@ class AOAModel(nn.Module):
             it = it.view(-1).long()
         elif sample_method == 'gumbel': # gumbel softmax
             def sample_gumbel(shape, eps=1e-20):
-                U = torch.rand(shape).cuda()
+                U = torch.rand(shape, device=self.device, dtype=self.dtype)
                 return -torch.log(-torch.log(U + eps) + eps)
             def gumbel_softmax_sample(logits, temperature):
                 y = logits + sample_gumbel(logits.size())
@@ -321,9 +342,9 @@ class AOAModel(nn.Module):
         with torch.no_grad():
             complete_seqs = [[] for g in range(num_group)]
             complete_seqs_scores = [[] for g in range(num_group)]
-            k_prev_words = [torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() for g in range(num_group)] # (beam_size,)
-            top_k_scores = [torch.zeros(beam_size, 1).cuda() for g in range(num_group)] # (beam_size, 1)
-            seqs = [torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() for g in range(num_group)]   # (unfinished_num, )
+            k_prev_words = [torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) for g in range(num_group)] # (beam_size,)
+            top_k_scores = [torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) for g in range(num_group)] # (beam_size, 1)
+            seqs = [torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) for g in range(num_group)]   # (unfinished_num, )
             image_features, avg_feature = self.img_encoder(imgs) #
             image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
             image_feature_proj = image_feature_proj.contiguous()
@@ -333,9 +354,10 @@ class AOAModel(nn.Module):
 
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
-            image_feature_proj = [image_feature_proj.expand(beam_size, *image_feature_proj.size()[1:]) for g in range(num_group)]  # batch_size, H*W, hidden_dim
+            memory = self.project_memory(image_feature_proj)
+            memory = [tuple(m.expand(beam_size, *m.size()[1:]) for m in memory) for g in range(num_group)]  # (key, value) beam_size, H*W, hidden_dim
             global_img_feature = [global_img_feature.expand(beam_size, global_img_feature.size(-1)) for g in range(num_group)] #  beam_size, hidden_dim,
-            h, c = self.init_hidden_state(image_feature_proj[0])
+            h, c = self.init_hidden_state(memory[0][0])
             init_state = (h, c)
             state = [init_state for g in range(num_group)]  #(ht, ct)
             unfinished_num = [beam_size for g in range(num_group)]
@@ -347,7 +369,7 @@ class AOAModel(nn.Module):
                     word_embedding = self.embedding(k_prev_words[g]).squeeze(1)  # unfinished_num, embedding_dim
                     xt = torch.cat((word_embedding,  global_img_feature[g]), dim=-1)  # (batch_size, embed_dim + hidden_dim)
                     # print(image_feature_proj[g].size(), xt.size(), state[g])
-                    predict_score_t, alpha_t, beta_t, state[g] = self.predict_next_word(image_feature_proj[g], xt, state[g])
+                    predict_score_t, alpha_t, beta_t, state[g] = self.predict_next_word(memory[g], xt, state[g])
                     predict_score_t = torch.log_softmax(predict_score_t, dim=-1)  # (unfinished_num, vocab_size)
                     for i, v in enumerate(previous_idx):
                         predict_score_t[:,int(v)] = predict_score_t[:, int(v)] - diversity_prob
@@ -377,7 +399,7 @@ class AOAModel(nn.Module):
                     for s_idx in range(len(state[g])):
                         new_state.append(state[g][s_idx][beam_idx[incomplete_inds]])
                     state[g] = tuple(new_state)
-                    image_feature_proj[g] = image_feature_proj[g][beam_idx[incomplete_inds]]
+                    memory[g] = tuple(m[beam_idx[incomplete_inds]] for m in memory[g])
                     global_img_feature[g] = global_img_feature[g][beam_idx[incomplete_inds]]
                     top_k_scores[g] = top_k_scores[g][incomplete_inds].unsqueeze(1)
                     if g < 2:
@@ -420,9 +442,9 @@ class AOAModel(nn.Module):
         complete_seqs =[]
         complete_seqs_scores=[]
         with torch.no_grad():
-            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() # (beam_size,)
-            top_k_scores = torch.zeros(beam_size, 1).cuda() # (beam_size, 1)
-            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).cuda()  # (unfinished_num, )
+            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) # (beam_size,)
+            top_k_scores = torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) # (beam_size, 1)
+            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device)  # (unfinished_num, )
             image_features, avg_feature = self.img_encoder(imgs) #
             image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
             image_feature_proj = image_feature_proj.contiguous()
@@ -432,15 +454,16 @@ class AOAModel(nn.Module):
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
             # print(global_img_feature.size())
-            image_feature_proj = image_feature_proj.expand(beam_size, *image_feature_proj.size()[1:])  # batch_size, H*W, hidden_dim
+            memory = self.project_memory(image_feature_proj)
+            memory = tuple(m.expand(beam_size, *m.size()[1:]) for m in memory)  # (key, value) beam_size, H*W, hidden_dim
             global_img_feature = global_img_feature.expand(beam_size, global_img_feature.size(-1)) #  beam_size, hidden_dim,
-            h, c = self.init_hidden_state(image_feature_proj)
+            h, c = self.init_hidden_state(memory[0])
             state = (h, c)
             unfinished_num = beam_size
             for step in range(max_cap_length):
                 word_embedding = self.embedding(k_prev_words).squeeze(1) # unfinished_num, embedding_dim
                 xt = torch.cat((word_embedding, global_img_feature), dim=-1) # (batch_size, 2*embed_dim + hidden_dim)
-                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
                 predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(unfinished_num, vocab_size)
                 top_k_scores_exp = top_k_scores.expand((unfinished_num, vocab_size))
                 scores = top_k_scores_exp + predict_score_t
@@ -468,7 +491,7 @@ class AOAModel(nn.Module):
                 for s_idx in range(len(state)):
                     new_state.append(state[s_idx][beam_idx[incomplete_inds]])
                 state = tuple(new_state)
-                image_feature_proj = image_feature_proj[beam_idx[incomplete_inds]]
+                memory = tuple(m[beam_idx[incomplete_inds]] for m in memory)
                 global_img_feature = global_img_feature[beam_idx[incomplete_inds]]
                 top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
                 k_prev_words = next_word_idx[incomplete_inds].unsqueeze(1)
@@ -484,13 +507,210 @@ class AOAModel(nn.Module):
             sentence = self.remove_bad_endings(sentence)
             return sentence, sen_idx
 
+    def beam_search_batch(self, imgs, word_map, beam_size=3, max_cap_length=30):
+        '''
+        The batched version of beam_search. The beams are kept in a (batch_size, beam_size) layout and reordered with
+        gather, each image gets the same output as calling beam_search on it alone
+        :param imgs: (batch_size, C, H, W)
+        :param word_map:
+        :param beam_size:
+        :param max_cap_length:
+        :return: a list of sentences and a list of encoded sentences, one for each image
+        '''
+        self.eval()
+        batch_size = imgs.size(0)
+        rev_word_map = {v: k for k, v in word_map.items()}
+        vocab_size = len(word_map)
+        complete_seqs = [[] for _ in range(batch_size)]
+        complete_seqs_scores = [[] for _ in range(batch_size)]
+        with torch.no_grad():
+            image_features, avg_feature = self.img_encoder(imgs) #
+            image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
+            image_feature_proj = image_feature_proj.contiguous()
+            image_feature_proj = image_feature_proj.view(batch_size, self.hidden_dim, -1)  # (bs, hidden_dim, num_pixel)
+            image_feature_proj = image_feature_proj.transpose(1, 2)  # (bs, num_pixel, hidden_dim)
+            global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
+            # the beams of image b are the rows b*beam_size ... (b+1)*beam_size-1, they share the same image features
+            memory = self.project_memory(image_feature_proj)
+            memory = tuple(m.repeat_interleave(beam_size, dim=0) for m in memory)  # (key, value) batch_size*beam_size, H*W, hidden_dim
+            global_img_feature = global_img_feature.repeat_interleave(beam_size, dim=0) # batch_size*beam_size, hidden_dim
+            state = self.init_hidden_state(memory[0]) #(ht, ct)
+            k_prev_words = torch.LongTensor([word_map['<start>']] * (batch_size * beam_size)).to(self.device) # (batch_size*beam_size,)
+            seqs = k_prev_words.view(batch_size, beam_size, 1) # (batch_size, beam_size, step+1)
+            # only the first beam is expanded at the first step, the dead beams are marked with -inf
+            top_k_scores = torch.full((batch_size, beam_size), float('-inf'), device=self.device, dtype=self.dtype)
+            top_k_scores[:, 0] = 0
+            unfinished_num = torch.LongTensor([beam_size] * batch_size).to(self.device) # (batch_size,)
+            beam_range = torch.arange(beam_size, device=self.device)
+            beam_offset = (torch.arange(batch_size, device=self.device) * beam_size).unsqueeze(1) # (batch_size, 1)
+            for step in range(max_cap_length):
+                word_embedding = self.embedding(k_prev_words) # batch_size*beam_size, embedding_dim
+                xt = torch.cat((word_embedding, global_img_feature), dim=-1) # (batch_size*beam_size, embed_dim + hidden_dim)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
+                predict_score_t = torch.log_softmax(predict_score_t,dim=-1).view(batch_size, beam_size, vocab_size)
+                scores = top_k_scores.unsqueeze(2) + predict_score_t # (batch_size, beam_size, vocab_size)
+                top_k_scores, top_words = scores.view(batch_size, -1).topk(beam_size, -1, True, True) # (batch_size, beam_size)
+                beam_idx = top_words // vocab_size  # (batch_size, beam_size)
+                next_word_idx = top_words % vocab_size  # (batch_size, beam_size)
+                seqs = seqs.gather(1, beam_idx.unsqueeze(2).expand(-1, -1, seqs.size(2)))
+                seqs = torch.cat([seqs, next_word_idx.unsqueeze(2)], dim=2)
+                # as in beam_search, only the best unfinished_num candidates of each image are kept
+                selected = beam_range.unsqueeze(0) < unfinished_num.unsqueeze(1)
+                complete = selected & (next_word_idx == word_map['<end>'])
+                if complete.any():
+                    for b, k in complete.nonzero().tolist():
+                        complete_seqs[b].append(seqs[b, k].tolist())
+                        complete_seqs_scores[b].append(top_k_scores[b, k].item())
+                    unfinished_num = unfinished_num - complete.sum(1)
+                if unfinished_num.sum() == 0:
+                    break
+                top_k_scores = top_k_scores.masked_fill(~(selected & ~complete), float('-inf'))
+                #  update state
+                state_idx = (beam_idx + beam_offset).view(-1)
+                state = tuple(s.index_select(0, state_idx) for s in state)
+                k_prev_words = next_word_idx.view(-1)
+            sentences = []
+            sen_idxs = []
+            for b in range(batch_size):
+                if len(complete_seqs[b]) > 0:
+                    i = complete_seqs_scores[b].index(max(complete_seqs_scores[b]))
+                    seq = complete_seqs[b][i]
+                else:
+                    seq = seqs[b, top_k_scores[b].argmax()][:20].tolist()
+                sen_idx = [w for w in seq if w not in {word_map['<start>'], word_map['<end>'], word_map['<unk>'], word_map['<pad>']}]
+                sentence = [' '.join([rev_word_map[sen_idx[i]] for i in range(len(sen_idx))])]
+                sentences.extend(self.remove_bad_endings(sentence))
+                sen_idxs.append(sen_idx)
+            return sentences, sen_idxs
+
+    def lstm_forward(self, cell, xt, ht_m1, ct_m1):
+        '''
+        The same computation as cell(xt, (ht_m1, ct_m1)), the candidate cell input and the gates are returned as well
+        :param cell: nn.LSTMCell
+        :return: ht, ct, gt (before tanh), it, ft each with shape bs, hidden_dim
+        '''
+        z = torch.matmul(xt, cell.weight_ih.transpose(0, 1))  # (bs, 4*hidden_size)
+        z = z + torch.matmul(ht_m1, cell.weight_hh.transpose(0, 1))  # (bs, 4*hidden_size)
+        z = z + cell.bias_ih + cell.bias_hh
+        z0, z1, z2, z3 = z.chunk(4, dim=1)
+        i = torch.sigmoid(z0)
+        f = torch.sigmoid(z1)
+        c = f * ct_m1 + i * torch.tanh(z2)
+        o = torch.sigmoid(z3)
+        h = o * torch.tanh(c)
+        return h, c, z2, i, f
+
+    def beam_search_with_states(self, imgs, word_map, beam_size=3, max_cap_length=30):
+        '''
+        beam_search that also records the decoder intermediates of the winning hypothesis, the explainers use them
+        instead of running the encoder and the decoder a second time. Only suits for batch_size 1
+        :param imgs: (1, C, H, W)
+        :param word_map:
+        :param beam_size:
+        :param max_cap_length:
+        :return: sentence, sen_idx and a dict of the image features and the per-step states. The per-step states have
+                 one row for every step of the hypothesis (including the <end> step), seq holds the predicted words
+        '''
+        self.eval()
+        assert imgs.size(0) == 1
+        batch_size = imgs.size(0)
+        rev_word_map = {v: k for k, v in word_map.items()}
+        vocab_size = len(word_map)
+        complete_seqs =[]
+        complete_seqs_scores=[]
+        complete_rows = []
+        steps = []  # the intermediates of every step, each with shape (unfinished_num, ...)
+        with torch.no_grad():
+            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) # (beam_size,)
+            top_k_scores = torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) # (beam_size, 1)
+            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device)  # (unfinished_num, )
+            rows = torch.zeros(beam_size, 0, device=self.device, dtype=torch.long)  # the back pointers into steps
+            image_features, avg_feature = self.img_encoder(imgs) #
+            image_feature_proj_before_act = self.img_projector(image_features)
+            image_feature_proj = self.relu(image_feature_proj_before_act) # batch_size, hidden_dim, H, W
+            image_feature_proj = image_feature_proj.contiguous()
+            image_feature_proj = image_feature_proj.view(batch_size, self.hidden_dim, -1)  # (bs, hidden_dim, num_pixel)
+            image_feature_proj = image_feature_proj.transpose(1, 2)  # (bs, num_pixel, hidden_dim)
+            global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
+            memory = self.project_memory(image_feature_proj)
+            states = {'image_features': image_features,
+                      'avg_feature': avg_feature,
+                      'image_feature_proj_before_act': image_feature_proj_before_act.contiguous().view(batch_size, self.hidden_dim, -1).transpose(1, 2),
+                      'image_feature_proj': image_feature_proj,
+                      'global_img_feature': global_img_feature,
+                      'key': memory[0],
+                      'value': memory[1]}
+            memory = tuple(m.expand(beam_size, *m.size()[1:]) for m in memory)  # (key, value) beam_size, H*W, hidden_dim
+            global_img_feature = global_img_feature.expand(beam_size, global_img_feature.size(-1)) #  beam_size, hidden_dim,
+            state = self.init_hidden_state(memory[0])
+            unfinished_num = beam_size
+            for step in range(max_cap_length):
+                word_embedding = self.embedding(k_prev_words).squeeze(1) # unfinished_num, embedding_dim
+                xt = torch.cat((word_embedding, global_img_feature), dim=-1) # (unfinished_num, embed_dim + hidden_dim)
+                ht, ct, gt, it_act, ft_act = self.lstm_forward(self.LanguageLSTM, xt, state[0], state[1])
+                context, alpha_t = self.decoder_multihead_attention(ht, memory[0], memory[1]) #(unfinished_num, hidden_dim) alpha: (unfinished_num, num_head, num_pixel)
+                context_aoa_gate = self.decoder_aoa_linear_gate(ht)
+                context_aoa_linear = self.decoder_aoa_linear(context)
+                context_aoa = torch.sigmoid(context_aoa_gate) * context_aoa_linear #(unfinished_num, hiddendim)
+                predict_score_t = self.fc(context_aoa + ht)  # (unfinished_num, vocab_size)
+                state = (ht, ct)
+                steps.append({'xt': xt, 'predictions': predict_score_t, 'alphas': alpha_t, 'ht': ht, 'ct': ct,
+                              'gt': gt, 'it_act': it_act, 'ft_act': ft_act, 'context': context,
+                              'context_aoa': context_aoa, 'context_aoa_gate': context_aoa_gate,
+                              'context_aoa_linear': context_aoa_linear})
+                predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(unfinished_num, vocab_size)
+                top_k_scores_exp = top_k_scores.expand((unfinished_num, vocab_size))
+                scores = top_k_scores_exp + predict_score_t
+                if step == 0:
+                    top_k_scores, top_words = scores[0].topk(beam_size, -1, True, True)  # (unfinished_num, beam_size)
+                else:
+                    top_k_scores, top_words = scores.view(-1).topk(unfinished_num, -1, True, True) # (unfinished_num, beam_size)
+                beam_idx = top_words // vocab_size  # (unfinished_num, )
+                next_word_idx = top_words % vocab_size  # (unfinished_num, )
+                seqs = torch.cat([seqs[beam_idx], next_word_idx.unsqueeze(1)], dim=1)
+                rows = torch.cat([rows[beam_idx], beam_idx.unsqueeze(1)], dim=1)
+                incomplete_inds = [ind for ind, next_word in enumerate(next_word_idx) if next_word != word_map['<end>']]
+                complete_inds = list(set(range(len(next_word_idx))) - set(incomplete_inds))
+                # Set aside complete sequences
+                if len(complete_inds) > 0:
+                    complete_seqs.extend(seqs[complete_inds].tolist())
+                    complete_seqs_scores.extend(top_k_scores[complete_inds])
+                    complete_rows.extend(rows[complete_inds].tolist())
+                unfinished_num = unfinished_num - len(complete_inds)  # reduce beam length accordingly
+                if unfinished_num == 0:
+                    break
+                # updata sequences
+                seqs = seqs[incomplete_inds]
+                rows = rows[incomplete_inds]
+                #  update state
+                state = tuple(s[beam_idx[incomplete_inds]] for s in state)
+                memory = tuple(m[beam_idx[incomplete_inds]] for m in memory)
+                global_img_feature = global_img_feature[beam_idx[incomplete_inds]]
+                top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
+                k_prev_words = next_word_idx[incomplete_inds].unsqueeze(1)
+            if len(complete_seqs) > 0:
+                i = complete_seqs_scores.index(max(complete_seqs_scores))
+                seq = complete_seqs[i]
+                seq_rows = complete_rows[i]
+            else:
+                seq = seqs[0][:20].tolist()
+                seq_rows = rows[0][:19].tolist()
+            # follow the back pointers to collect the states of the winning hypothesis
+            for name in steps[0]:
+                states[name] = torch.stack([steps[s][name][r] for s, r in enumerate(seq_rows)])
+            states['seq'] = seq[1:]
+            sen_idx = [w for w in seq if w not in {word_map['<start>'], word_map['<end>'], word_map['<unk>'], word_map['<pad>']}]
+            sentence = [' '.join([rev_word_map[sen_idx[i]] for i in range(len(sen_idx))])]
+            sentence = self.remove_bad_endings(sentence)
+            return sentence, sen_idx, states
+
     def greedy_search(self,imgs,  word_map, max_cap_length=20):
         self.eval()
         batch_size = imgs.size(0)
         rev_word_map = {v: k for k, v in word_map.items()}
         complete_seq =[]
         with torch.no_grad():
-            k_prev_words = torch.zeros(batch_size, max_cap_length).long().cuda() # (batch_size, caption_length)
+            k_prev_words = torch.zeros(batch_size, max_cap_length, device=self.device, dtype=torch.long) # (batch_size, caption_length)
             k_prev_words[:, 0] = word_map['<start>'] # the first word is '<start>'
             seqs_temp = [[word_map['<start>']] for _ in range(batch_size)]
             image_features, avg_feature = self.img_encoder(imgs) #
@@ -500,13 +720,14 @@ class AOAModel(nn.Module):
             image_feature_proj = image_feature_proj.transpose(1, 2)  # (bs, num_pixel, hidden_dim)
             global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
             h, c = self.init_hidden_state(image_feature_proj)
+            memory = self.project_memory(image_feature_proj)
             state = (h, c)
             for step in range(max_cap_length-1):
                 word_embedding = self.embedding(k_prev_words[:, step]) # batch_size, embedding_dim
                 if global_img_feature.dim() == 1:
                     global_img_feature = global_img_feature.unsqueeze(0)
                 xt = torch.cat((word_embedding,  global_img_feature), dim=-1) # (batch_size, embed_dim + hidden_dim)
-                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
                 predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(batch_size, vocab_size)
                 top_scores, top_words = predict_score_t.topk(1, -1, True, True)
                 if step == 0:
@@ -541,20 +762,7 @@ class AOAModel(nn.Module):
         assert r_out.dim() == 1
         assert forward_input.dim() == 1
         assert weight.dim() == 2
-        attribution = weight * forward_input #(out_feature, in_feature)
-        if type(forward_output) == bool:
-            forward_output = torch.matmul(forward_input, weight.transpose(0,1))
-            # print('matml', forward_output.size())
-        forward_output_eps = self.EPS * forward_output.sign() + forward_output  # Z.sign() returns -1 or 0 or 1
-
-        forward_output_eps.masked_fill_(forward_output_eps == 0, self.EPS)  #(out_feature,)
-        # print(forward_output_eps.size())
-        attribution_norm = attribution.transpose(0,1) / forward_output_eps #(in_feature, out_feature)
-        # print(attribution_norm.size())
-        relevance_input = torch.sum(attribution_norm * r_out, dim=-1) #(in_feature,)
-        assert relevance_input.size() == forward_input.size()
-        torch.cuda.empty_cache()
-        return relevance_input
+        return lrp_rules.lrp_linear_eps(r_out, forward_input, forward_output, weight, self.EPS)
 
     def lrp_mha(self, alpha, value, r_context, context):
         '''
@@ -563,63 +771,37 @@ class AOAModel(nn.Module):
         :param value: shape is  num_pixel hiddendim
         :param r_context: shape is  1, hiddendim
         :param context shape is 1, hiddendim
-        :return:
+        :return: the value relevance summed over the heads, num_pixel, hiddendim
         '''
-        num_head = alpha.size(0)
-        num_pixel = alpha.size(1)
-        num_query = r_context.size(0)  #(should be 1 if we use ht ad the query)
-        '''using mean'''
-        # r_value = torch.zeros_like(value).cuda()
-        # attention_weight = alpha.mean(0)
-        # for i in range(num_pixel):
-        #     r_value[i] = self.lrp_linear_eps(r_out=r_context.squeeze(),
-        #                                      forward_input=value[i]*attention_weight[i],
-        #                                      forward_output=context.squeeze(),
-        #                                      weight=torch.eye(self.model.hidden_dim).cuda())
-        '''spread single head'''
-        d_k = self.model.hidden_dim//num_head #(should be 64 if using vgg and 8 heads)
-        r_context = r_context.clone().contiguous().view(num_query, num_head, d_k).transpose(0, 1) #(num_head, num_query, d_k)
-        context = context.clone().contiguous().view(num_query, num_head, d_k).transpose(0,1)  #(num_head, num_query, d_k)
-        value = value.clone().contiguous().view(num_pixel, num_head, d_k).transpose(0, 1) #(num_head, num_pixel, d_k)
-        r_value = value.clone()
-        for h in range(num_head):
-            for i in range(num_pixel):
-                r = self.lrp_linear_eps(r_out=r_context[h,0],
-                                                forward_input=value[h,i]*alpha[h,i],
-                                                forward_output=context[h,0],
-                                                weight=torch.eye(d_k).cuda())
-                r_value[h, i] = r
-        # print(r_value[:, 0].squeeze())
-        r_value = r_value.transpose(0, 1).contiguous().view(num_pixel, self.model.hidden_dim)
-        # print(r_value[0])
+        _, r_value = lrp_rules.lrp_mha_eps(alpha, value, r_context, context, self.EPS)
         return r_value
 
     def get_lrp_weight_step(self, predictions_t, rev_word_map, ht_, context_aoa):
         batch_size, vocab_size = predictions_t.size()
         with torch.no_grad():
-            weight_of_context_aoa = torch.zeros(batch_size, self.hidden_dim).cuda()
-            weight_of_ht = torch.zeros(batch_size, self.hidden_dim).cuda()
+            weight_of_context_aoa = torch.zeros(batch_size, self.hidden_dim, device=self.device, dtype=self.dtype)
+            weight_of_ht = torch.zeros(batch_size, self.hidden_dim, device=self.device, dtype=self.dtype)
             for b in range(batch_size):
                 predicted_labels = torch.argmax(predictions_t[b], dim=-1)  # (the predicted label of image b)  (max_length)
                 word_t = predicted_labels.item()
                 if rev_word_map[word_t] in STOP_WORDS + ['<start>','<end>','<pad>','<unk>']:
                     continue
                 else:
-                    word_relevance = torch.zeros(self.vocab_size).cuda()
+                    word_relevance = torch.zeros(self.vocab_size, device=self.device, dtype=self.dtype)
                     word_relevance[word_t] = predictions_t[b][word_t]
                     r_h2t_context_aoa = self.lrp_linear_eps(r_out=word_relevance,
                                                             forward_input=ht_[b] + context_aoa[b],
                                                             forward_output=predictions_t[b],
                                                             weight=self.fc.weight)
-                    r_h2t = self.lrp_linear_eps(r_out=r_h2t_context_aoa,
-                                                forward_input=ht_[b],
-                                                forward_output=ht_[b] + context_aoa[b],
-                                                weight=torch.eye(self.hidden_dim).cuda())
+                    r_h2t = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_aoa,
+                                                          forward_input=ht_[b],
+                                                          forward_output=ht_[b] + context_aoa[b],
+                                                          eps=self.EPS)
                     weight_of_ht[b] = r_h2t
-                    r_context_aoa = self.lrp_linear_eps(r_out=r_h2t_context_aoa,
-                                                        forward_input=context_aoa[b],
-                                                        forward_output=ht_[b] + context_aoa[b],
-                                                        weight=torch.eye(self.hidden_dim).cuda())
+                    r_context_aoa = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_aoa,
+                                                                  forward_input=context_aoa[b],
+                                                                  forward_output=ht_[b] + context_aoa[b],
+                                                                  eps=self.EPS)
                     weight_of_context_aoa[b] = r_context_aoa
             weight_of_context_aoa = LRPutil.normalize_relevance(weight_of_context_aoa, dim=-1)
             weight_of_ht = LRPutil.normalize_relevance(weight_of_ht, dim=-1)
@@ -651,11 +833,10 @@ class AOAModel(nn.Module):
         h, c = self.init_hidden_state(image_feature_proj)
         state = (h, c)
         global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
-        key = self.decoder_k_proj(image_feature_proj)
-        value = self.decoder_v_proj(image_feature_proj)
+        key, value = self.project_memory(image_feature_proj)
         max_length = max(caption_lengths) - 1
-        predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
-        weighted_predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
+        predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        weighted_predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
         for t in range(max_length):
             word_embedding = self.embedding(encoded_captions[:, t])
             if global_img_feature.dim() == 1:
@@ -699,15 +880,14 @@ class AOAModel(nn.Module):
         image_feature_proj = image_feature_proj.view(batch_size, self.hidden_dim, -1)  # (bs, hidden_dim, num_pixel)
         image_feature_proj = image_feature_proj.transpose(1, 2)  # (bs, num_pixel, hidden_dim)
         global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
-        key = self.decoder_k_proj(image_feature_proj)
-        value = self.decoder_v_proj(image_feature_proj)
+        key, value = self.project_memory(image_feature_proj)
         h, c = self.init_hidden_state(image_feature_proj)
         state = (h, c)
-        seq = torch.zeros(batch_size,max_length).long().cuda()
-        seq_logprobs = torch.zeros(batch_size, max_length).cuda()
+        seq = torch.zeros(batch_size,max_length, device=self.device, dtype=torch.long)
+        seq_logprobs = torch.zeros(batch_size, max_length, device=self.device, dtype=self.dtype)
         for t in range(max_length):
             if t == 0:
-                it = torch.ones(batch_size).long().cuda() * word_map['<start>']
+                it = torch.ones(batch_size, device=self.device, dtype=torch.long) * word_map['<start>']
             word_embedding = self.embedding(it)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
@@ -759,10 +939,12 @@ class ExplainAOAAttention(object):
             self.model = model
         else:
             self.model = AOAModel(args.embed_dim, args.hidden_dim, args.num_head, len(word_map), args.encoder)
-            checkpoint = torch.load(args.weight)
+            checkpoint = torch.load(args.weight, map_location=args.device)
             self.model.load_state_dict(checkpoint['state_dict'])
-            self.model.cuda()
+            self.model.to(args.device)
         self.model.eval()
+        self.device = self.model.device
+        self.dtype = self.model.dtype
         self.model.decoder_multihead_attention.eval()
 
         self.mean = [0.485, 0.456, 0.406]
@@ -782,6 +964,20 @@ class ExplainAOAAttention(object):
         if not os.path.isdir(self.visualizatioin_save_path):
             os.makedirs(self.visualizatioin_save_path)
 
+        # a DecodeCache shared with the other explainers of the model, None decodes every image here
+        self.decode_cache = None
+        # everything set so far lives as long as the explainer, the rest is per-image state dropped by reset
+        self.session_attributes = set(self.__dict__) | {'session_attributes'}
+
+    def reset(self):
+        '''
+        drops the per-image state (the image, the caption, the hidden states and the relevance), the model is kept so
+        that the explainer can be reused for the next image
+        '''
+        for name in set(self.__dict__) - self.session_attributes:
+            delattr(self, name)
+        self.model.zero_grad()
+
     def lrp_linear_eps(self, r_out, forward_input, forward_output, weight):
         '''
 
@@ -794,83 +990,30 @@ class ExplainAOAAttention(object):
         assert r_out.dim() == 1
         assert forward_input.dim() == 1
         assert weight.dim() == 2
-        attribution = weight * forward_input #(out_feature, in_feature)
-        if type(forward_output) == bool:
-            forward_output = torch.matmul(forward_input, weight.transpose(0,1))
-            # print('matml', forward_output.size())
-        forward_output_eps = self.EPS * forward_output.sign() + forward_output  # Z.sign() returns -1 or 0 or 1
-
-        forward_output_eps.masked_fill_(forward_output_eps == 0, self.EPS)  #(out_feature,)
-        # print(forward_output_eps.size())
-        attribution_norm = attribution.transpose(0,1) / forward_output_eps #(in_feature, out_feature)
-        # print(attribution_norm.size())
-        relevance_input = torch.sum(attribution_norm * r_out, dim=-1) #(in_feature,)
-        assert relevance_input.size() == forward_input.size()
-        torch.cuda.empty_cache()
-        return relevance_input
+        return lrp_rules.lrp_linear_eps(r_out, forward_input, forward_output, weight, self.EPS)
 
-    def lrp_mha(self, alpha, value, r_context, context, head_idx):
+    def lrp_mha(self, alpha, value, r_context, context):
         '''
-
-        :param alpha:  shape is num_head, num_pixel
+        spread every head in one pass
+        :param alpha:  shape is num_head, num_pixel, or caption_length, num_head, num_pixel for all the steps
         :param value: shape is  num_pixel hiddendim
-        :param r_context: shape is  1, hiddendim
-        :param context shape is 1, hiddendim
-        :return:
+        :param r_context: shape is  1, hiddendim, or caption_length, hiddendim
+        :param context shape is 1, hiddendim, or caption_length, hiddendim
+        :return: the value relevance of every head (..., num_head, num_pixel, hiddendim) and the head-summed value
+                 relevance (..., num_pixel, hiddendim)
         '''
-        num_head = alpha.size(0)
-        num_pixel = alpha.size(1)
-        num_query = r_context.size(0)  #(should be 1 if we use ht ad the query)
-        '''using attention for full dimension'''
-        # r_value = torch.zeros_like(value).cuda()
-        # attention_weight = alpha[head_idx]
-        # for i in range(num_pixel):
-        #     r_value[i] = self.lrp_linear_eps(r_out=r_context.squeeze(),
-        #                                      forward_input=value[i]*attention_weight[i],
-        #                                      forward_output=context.squeeze(),
-        #                                      weight=torch.eye(self.model.hidden_dim).cuda())
-        '''whole heads'''
-        # d_k = self.model.hidden_dim//num_head #(should be 64 if using vgg and 8 heads)
-        # r_context = r_context.clone().contiguous().view(num_query, num_head, d_k).transpose(0, 1) #(num_head, num_query, d_k)
-        # context = context.clone().contiguous().view(num_query, num_head, d_k).transpose(0,1)  #(num_head, num_query, d_k)
-        # value = value.clone().contiguous().view(num_pixel, num_head, d_k).transpose(0, 1) #(num_head, num_pixel, d_k)
-        # r_value = torch.zeros_like(value)
-        # # print(r_context.size(), context.size(), value.size())
-        # for h in range(8):
-        #     for i in range(num_pixel):
-        #         r = self.lrp_linear_eps(r_out=r_context[h,0],
-        #                                         forward_input=value[h,i]*alpha[h,i],
-        #                                         forward_output=context[h,0],
-        #                                         weight=torch.eye(d_k).cuda())
-        #         r_value[h, i] = r
-        # r_value = r_value.transpose(0, 1).contiguous().view(num_pixel, self.model.hidden_dim)
-        '''spread single head'''
-        d_k = self.model.hidden_dim//num_head #(should be 64 if using vgg and 8 heads)
-        r_context = r_context.clone().contiguous().view(num_query, num_head, d_k).transpose(0, 1) #(num_head, num_query, d_k)
-        context = context.clone().contiguous().view(num_query, num_head, d_k).transpose(0,1)  #(num_head, num_query, d_k)
-        value = value.clone().contiguous().view(num_pixel, num_head, d_k).transpose(0, 1) #(num_head, num_pixel, d_k)
-        r_value = torch.zeros_like(value)
-        # print(r_context.size(), context.size(), value.size())
-        for i in range(num_pixel):
-            r = self.lrp_linear_eps(r_out=r_context[head_idx,0],
-                                            forward_input=value[head_idx,i]*alpha[head_idx,i],
-                                            forward_output=context[head_idx,0],
-                                            weight=torch.eye(d_k).cuda())
-            r_value[head_idx, i] = r
-        r_value = r_value.transpose(0, 1).contiguous().view(num_pixel, self.model.hidden_dim)
-        # print(r_value[0])
-        return r_value
+        return lrp_rules.lrp_mha_eps(alpha, value, r_context, context, self.EPS)
 
     def preprocess_img(self, img_filepath):
         image_data = Image.open(img_filepath).convert('RGB')
         img = self.img_transform(image_data)
-        img = img.unsqueeze(0).cuda()
+        img = img.unsqueeze(0).to(self.device, self.dtype)
         return img
 
     def language_lstm_forward(self, xt, ht_m1, ct_m1):
         z = torch.matmul(self.language_weight_i, xt.squeeze())  #(4*hidden_size, 1)
         z = z + torch.matmul(self.language_weight_h, ht_m1) #(4*hidden_size,1)
-        z = z + self.language_bias_i + self.language_bias_i
+        z = z + self.language_bias_h + self.language_bias_i
         z0, z1, z2, z3 = z.chunk(4)
         i = torch.sigmoid(z0)
         f = torch.sigmoid(z1)
@@ -895,23 +1038,23 @@ class ExplainAOAAttention(object):
         self.image_feature_proj = self.image_feature_proj.transpose(1,2) #(bs, num_pixel, hidden_dim)
         self.global_img_feature = self.image_feature_proj.mean(1) #(bs, hidden_dim)
         self.caption_length = 50
-        self.predictions = torch.zeros(self.caption_length, self.vocab_size).cuda()
-        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim).cuda()
-        self.alphas = torch.zeros(self.caption_length, self.num_head, self.num_pixels).cuda()
-        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_aoa_gate = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_aoa_linear = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_aoa = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
+        self.predictions = torch.zeros(self.caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.alphas = torch.zeros(self.caption_length, self.num_head, self.num_pixels, device=self.device, dtype=self.dtype)
+        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_aoa_gate = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_aoa_linear = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_aoa = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         self.key = self.model.decoder_k_proj(self.image_feature_proj)  # batch_size, num_pixel, hiddendim
         self.value = self.model.decoder_v_proj(self.image_feature_proj)
         caption = [self.word_map['<start>']]
         for t in range(50):
-            it = torch.LongTensor([caption[t]]).cuda()
+            it = torch.LongTensor([caption[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if self.global_img_feature.dim() == 1:
                 self.global_img_feature = self.global_img_feature.unsqueeze(0)
@@ -960,13 +1103,13 @@ class ExplainAOAAttention(object):
         image_feature_proj = image_feature_proj.transpose(1, 2)  # (bs, num_pixel, hidden_dim)
         global_img_feature = image_feature_proj.mean(1)  # (bs, hidden_dim)
         caption_length = len(beam_caption_encode)
-        predictions = torch.zeros(caption_length, self.vocab_size).cuda()
-        ht = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
-        ct = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
+        predictions = torch.zeros(caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        ht = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        ct = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         key = self.model.decoder_k_proj(image_feature_proj)  # batch_size, num_pixel, hiddendim
         value = self.model.decoder_v_proj(image_feature_proj)
         for t in range(len(beam_caption_encode)):
-            it = torch.LongTensor([beam_caption_encode[t]]).cuda()
+            it = torch.LongTensor([beam_caption_encode[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
@@ -987,14 +1130,44 @@ class ExplainAOAAttention(object):
             ct[t + 1] = c_t
         return predictions
 
+    def decode(self, img_filepath, beam_size, max_cap_length):
+        '''
+        preprocesses the image and runs beam_search_with_states. With a decode_cache the image is decoded only once for
+        all the explainers sharing it, and they all explain the same caption
+        :return: img, beam_caption, beam_caption_encode, states
+        '''
+        if self.decode_cache is not None:
+            return self.decode_cache.decode(self, img_filepath)
+        img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
+        beam_caption, beam_caption_encode, states = self.model.beam_search_with_states(img, self.word_map,
+                                                                                       beam_size=beam_size,
+                                                                                       max_cap_length=max_cap_length)
+        return img, beam_caption, beam_caption_encode, states
+
     def get_hidden_parameters(self, img_filepath):
-        self.img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
-        self.beam_caption, self.beam_caption_encode = self.model.beam_search(self.img, self.word_map, beam_size=3,
-                                                                             max_cap_length=20) # pure sentence without <start> <end>
+        self.img, self.beam_caption, self.beam_caption_encode, states = self.decode(img_filepath, beam_size=3,
+                                                                                    max_cap_length=20) # pure sentence without <start> <end>
         self.caption_length = len(self.beam_caption_encode)
         self.beam_caption_encode = [self.word_map['<start>']] + self.beam_caption_encode  # add the start simbol
         print(f'the predicted caption of {img_filepath} is "{self.beam_caption[0]}"')
         print(self.beam_caption_encode)
+        if states['seq'][:self.caption_length] != self.beam_caption_encode[1:]:
+            # a word such as <unk> was dropped from the caption, the recorded states do not match it
+            self.replay_hidden_parameters()
+            return
+        # the intermediate variables recorded by the beam search
+        for name in ['image_features', 'avg_feature', 'image_feature_proj_before_act', 'image_feature_proj',
+                     'global_img_feature', 'key', 'value']:
+            setattr(self, name, states[name])
+        self.num_pixels = self.image_features.size(-1) * self.image_features.size(-2)
+        for name in ['xt', 'predictions', 'alphas', 'gt', 'it_act', 'ft_act', 'context', 'context_aoa',
+                     'context_aoa_gate', 'context_aoa_linear']:
+            setattr(self, name, states[name][:self.caption_length])
+        init_state = torch.zeros(1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        for name in ['ht', 'ct']:
+            setattr(self, name, torch.cat((init_state, states[name][:self.caption_length]), dim=0))  # (caption_length+1, hidden_dim)
+
+    def replay_hidden_parameters(self):
         # perform the forward pass and save the intermediate variables
         self.image_features, self.avg_feature = self.model.img_encoder(self.img)  # (bs, fea_dim, H, W), (bs, fea_dim)
         self.num_pixels = self.image_features.size(-1) * self.image_features.size(-2)
@@ -1007,21 +1180,21 @@ class ExplainAOAAttention(object):
         self.global_img_feature = self.image_feature_proj.mean(1)  # (bs, hidden_dim)
         self.key = self.model.decoder_k_proj(self.image_feature_proj)  # batch_size, num_pixel, hiddendim
         self.value = self.model.decoder_v_proj(self.image_feature_proj)
-        self.predictions = torch.zeros(self.caption_length, self.vocab_size).cuda()
-        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim).cuda()  #(start, word_0....word_{capLength-1})
-        self.alphas = torch.zeros(self.caption_length, self.num_head, self.num_pixels).cuda()
-        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_aoa = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_aoa_gate = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_aoa_linear = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
+        self.predictions = torch.zeros(self.caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim, device=self.device, dtype=self.dtype)  #(start, word_0....word_{capLength-1})
+        self.alphas = torch.zeros(self.caption_length, self.num_head, self.num_pixels, device=self.device, dtype=self.dtype)
+        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_aoa = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_aoa_gate = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_aoa_linear = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
 
         for t in range(self.caption_length):
-            it = torch.LongTensor([self.beam_caption_encode[t]]).cuda()
+            it = torch.LongTensor([self.beam_caption_encode[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if self.global_img_feature.dim() == 1:
                 self.global_img_feature = self.global_img_feature.unsqueeze(0)
@@ -1062,7 +1235,12 @@ class ExplainAOAAttention(object):
             self.context_aoa_gate[t] = context_aoa_gate_t.squeeze()
 
     def explain_caption_wordt(self, t, head_idx):
-
+        '''
+        :param t: the index of the word to explain
+        :param head_idx: the attention head to explain, None explains every head. The decoder part of the relevance does
+                         not depend on the head, only the value relevance is split per head
+        :return: the relevance of the image feature (num_explained_head, fea_dim, H, W) and of the preceeding words
+        '''
         assert t < self.caption_length  #(t starts from 0)
         preceeding_cap_length = t+1
         # print(t)
@@ -1078,30 +1256,28 @@ class ExplainAOAAttention(object):
         # print(target_word_encode, words[t], t + 1, torch.argmax(predict_score_t), predict_score_t[target_word_encode])
         image_feature = self.image_features.view(1, self.model.encoder_raw_dim, self.num_pixels)
         image_feature = image_feature.transpose(1,2).squeeze(0) #(num_pixel, encode_raw_dim)
-        word_relevance = torch.zeros(self.vocab_size).cuda()
+        word_relevance = torch.zeros(self.vocab_size, device=self.device, dtype=self.dtype)
         word_relevance[target_word_encode] = predict_score_t[target_word_encode]
-        self.r_ht = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        self.r_ct = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        self.r_xht = torch.zeros(preceeding_cap_length, self.model.embed_dim + 2 * self.model.hidden_dim).cuda()
-        self.r_global_img_feature = torch.zeros(self.model.hidden_dim).cuda()
-        self.r_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim).cuda()
-        self.r_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim).cuda()
-        self.r_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim).cuda()
-        self.r_context = torch.zeros(self.model.hidden_dim).cuda()
-        self.r_context_aoa = torch.zeros(self.model.hidden_dim).cuda()
+        self.r_ht = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_ct = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_xht = torch.zeros(preceeding_cap_length, self.model.embed_dim + 2 * self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_global_img_feature = torch.zeros(self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim, device=self.device, dtype=self.dtype)
+        self.r_context = torch.zeros(self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_context_aoa = torch.zeros(self.model.hidden_dim, device=self.device, dtype=self.dtype)
         r_h2t_context_aoa = self.lrp_linear_eps(r_out=word_relevance,
                                            forward_input=self.ht[t+1]+self.context_aoa[t],
                                            forward_output=predict_score_t,
                                            weight=self.output_weight)
-        self.r_ht[t+1] = self.lrp_linear_eps(r_out=r_h2t_context_aoa,
-                                             forward_input=self.ht[t+1],
-                                             forward_output=self.ht[t+1]+self.context_aoa[t],
-                                             weight=torch.eye(self.model.hidden_dim).cuda())
+        self.r_ht[t+1] = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_aoa,
+                                                       forward_input=self.ht[t+1],
+                                                       forward_output=self.ht[t+1]+self.context_aoa[t],
+                                                       eps=self.EPS)
 
-        self.r_context_aoa += self.lrp_linear_eps(r_out=r_h2t_context_aoa,
-                                                    forward_input=self.context_aoa[t],
-                                                    forward_output=self.ht[t+1]+self.context_aoa[t],
-                                                    weight=torch.eye(self.model.hidden_dim).cuda())
+        self.r_context_aoa += lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_aoa,
+                                                            forward_input=self.context_aoa[t],
+                                                            forward_output=self.ht[t+1]+self.context_aoa[t],
+                                                            eps=self.EPS)
 
 
         self.r_context = self.lrp_linear_eps(r_out=self.r_context_aoa,
@@ -1109,19 +1285,23 @@ class ExplainAOAAttention(object):
                                            forward_output=self.context_aoa_linear[t],
                                            weight=self.model.decoder_aoa_linear.weight)
 
-        self.r_value = self.lrp_mha(self.alphas[t], self.value.squeeze(), self.r_context.unsqueeze(0),
-                                     self.context[t].unsqueeze(0), head_idx)
+        r_value_heads, _ = self.lrp_mha(self.alphas[t], self.value.squeeze(0), self.r_context.unsqueeze(0),
+                                        self.context[t].unsqueeze(0))
+        if head_idx is None:
+            self.r_value = r_value_heads #(num_head, num_pixel, hidden_dim)
+        else:
+            self.r_value = r_value_heads[head_idx].unsqueeze(0) #(1, num_pixel, hidden_dim)
 
         for i in range(t+1)[::-1]:
             self.r_ct[i + 1] = self.r_ht[i + 1]
-            r_gt = self.lrp_linear_eps(r_out=self.r_ct[i + 1],
-                                       forward_input=self.it_act[i] * torch.tanh(self.gt[i]),
-                                       forward_output=self.ct[i+1],
-                                       weight=torch.eye(self.model.hidden_dim).cuda())
-            self.r_ct[i] = self.lrp_linear_eps(r_out=self.r_ct[i + 1],
-                                                forward_input=self.ft_act[i] * self.ct[i],
-                                                forward_output=self.ct[i+1],
-                                                weight=torch.eye(self.model.hidden_dim).cuda())
+            r_gt = lrp_rules.lrp_elementwise_eps(r_out=self.r_ct[i + 1],
+                                                 forward_input=self.it_act[i] * torch.tanh(self.gt[i]),
+                                                 forward_output=self.ct[i+1],
+                                                 eps=self.EPS)
+            self.r_ct[i] = lrp_rules.lrp_elementwise_eps(r_out=self.r_ct[i + 1],
+                                                         forward_input=self.ft_act[i] * self.ct[i],
+                                                         forward_output=self.ct[i+1],
+                                                         eps=self.EPS)
             self.r_xht[i] = self.lrp_linear_eps(r_out=r_gt,
                                                 forward_input=xht[i],
                                                 forward_output=self.gt[i],
@@ -1132,22 +1312,24 @@ class ExplainAOAAttention(object):
             #     self.r_global_img_feature += self.r_xht[i][self.model.embed_dim:self.model.embed_dim+self.model.hidden_dim]
             self.r_global_img_feature += self.r_xht[i][self.model.embed_dim:self.model.embed_dim + self.model.hidden_dim]
 
-        for i in range(self.num_pixels):
-            self.r_img_feature_proj[i] = self.lrp_linear_eps(r_out=self.r_global_img_feature,
-                                                        forward_input=self.image_feature_proj.squeeze()[i]/self.num_pixels,
-                                                        forward_output=self.global_img_feature.squeeze(),
-                                                        weight=torch.eye(self.model.hidden_dim).cuda())
-            # print(self.value.size())
-            self.r_img_feature_proj[i] += self.lrp_linear_eps(r_out=self.r_value[i],
-                                                              forward_input=self.image_feature_proj.squeeze()[i],
-                                                              forward_output=self.value.squeeze()[i],
-                                                              weight=self.model.decoder_v_proj.weight)
-            self.r_img_feature[i] = self.r_img_feature[i] + self.lrp_linear_eps(r_out=self.r_img_feature_proj[i],
-                                                                                forward_input=image_feature[i],
-                                                                                forward_output=self.image_feature_proj_before_act.squeeze()[i],
-                                                                                weight=self.model.img_projector.weight.squeeze(-1).squeeze(-1))
+        # all the pixels (and heads) are explained at once, the rules are applied row-wise
+        image_feature_proj = self.image_feature_proj.squeeze(0) #(num_pixel, hidden_dim)
+        self.r_img_feature_proj = lrp_rules.lrp_elementwise_eps(r_out=self.r_global_img_feature,
+                                                                forward_input=image_feature_proj/self.num_pixels,
+                                                                forward_output=self.global_img_feature.squeeze(0),
+                                                                eps=self.EPS)
+        self.r_img_feature_proj = self.r_img_feature_proj + lrp_rules.lrp_linear_eps(r_out=self.r_value,
+                                                                                     forward_input=image_feature_proj,
+                                                                                     forward_output=self.value.squeeze(0),
+                                                                                     weight=self.model.decoder_v_proj.weight,
+                                                                                     eps=self.EPS)
+        self.r_img_feature = lrp_rules.lrp_linear_eps(r_out=self.r_img_feature_proj,
+                                                      forward_input=image_feature,
+                                                      forward_output=self.image_feature_proj_before_act.squeeze(0),
+                                                      weight=self.model.img_projector.weight.squeeze(-1).squeeze(-1),
+                                                      eps=self.EPS)  #(num_explained_head, num_pixel, encode_raw_dim)
         r_words = torch.sum(self.r_word_embedding, dim=-1)
-        r_img_feature = self.r_img_feature.unsqueeze(0).transpose(1,2).view(self.image_features.size())
+        r_img_feature = self.r_img_feature.transpose(1,2).contiguous().view(-1, *self.image_features.size()[1:])
         # print(torch.sum(r_img_feature>0), torch.sum(r_img_feature==0), torch.sum(r_img_feature<0))
         max_abs_r_words = torch.max(torch.abs(r_words))
         if max_abs_r_words > 0:
@@ -1155,40 +1337,155 @@ class ExplainAOAAttention(object):
         torch.cuda.empty_cache()
         return r_img_feature, r_words
 
+    def explain_caption_allwords(self, head_idx):
+        '''
+        explain every word of the caption in one backward sweep. The relevance of all the words is carried through the
+        recurrence along a target axis, the relevance of word t enters at step t, so the result of every word is the same
+        as explain_caption_wordt
+        :param head_idx: the attention head to explain, None explains every head
+        :return: the relevance of the image feature (caption_length, num_explained_head, fea_dim, H, W) and the list of
+                 the relevance of the preceeding words of every word
+        '''
+        T = self.caption_length
+        steps = torch.arange(T, device=self.device)
+        target_word_encode = torch.tensor(self.beam_caption_encode[1:], device=self.device)
+        language_weight_ig = self.language_weight_i.chunk(4,0)[2]  #(hidden_dim, embed_dim + hidden_dim)
+        language_weight_hg = self.language_weight_h.chunk(4,0)[2]  #(hidden_dim, hidden_dim)
+        language_weight_g = torch.cat((language_weight_ig, language_weight_hg), dim=-1) #(hidden_dim, 2 * hidden_dim + embed_dim)
+        xht = torch.cat((self.xt[:T], self.ht[:T]), dim=1) #(caption_length, 3*hidden_dim)
+        image_feature = self.image_features.view(1, self.model.encoder_raw_dim, self.num_pixels)
+        image_feature = image_feature.transpose(1,2).squeeze(0) #(num_pixel, encode_raw_dim)
+        word_relevance = torch.zeros(T, self.vocab_size, device=self.device, dtype=self.dtype)
+        word_relevance[steps, target_word_encode] = self.predictions[steps, target_word_encode]
+
+        # the output layer of every word, row t is the word t
+        ht_context_aoa = self.ht[1:T+1] + self.context_aoa[:T] #(caption_length, hidden_dim)
+        r_h2t_context_aoa = lrp_rules.lrp_linear_eps(r_out=word_relevance,
+                                                     forward_input=ht_context_aoa,
+                                                     forward_output=self.predictions[:T],
+                                                     weight=self.output_weight,
+                                                     eps=self.EPS)
+        r_ht_out = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_aoa,
+                                                 forward_input=self.ht[1:T+1],
+                                                 forward_output=ht_context_aoa,
+                                                 eps=self.EPS)
+        self.r_context_aoa = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_aoa,
+                                                           forward_input=self.context_aoa[:T],
+                                                           forward_output=ht_context_aoa,
+                                                           eps=self.EPS)
+        self.r_context = lrp_rules.lrp_linear_eps(r_out=self.r_context_aoa,
+                                                  forward_input=self.context[:T],
+                                                  forward_output=self.context_aoa_linear[:T],
+                                                  weight=self.model.decoder_aoa_linear.weight,
+                                                  eps=self.EPS)
+        r_value_heads, _ = self.lrp_mha(self.alphas[:T], self.value.squeeze(0), self.r_context, self.context[:T])
+        if head_idx is None:
+            self.r_value = r_value_heads #(caption_length, num_head, num_pixel, hidden_dim)
+        else:
+            self.r_value = r_value_heads[:, head_idx].unsqueeze(1) #(caption_length, 1, num_pixel, hidden_dim)
+
+        # the relevance buffers are (step, target word, feature)
+        self.r_ht = torch.zeros(T+1, T, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_ct = torch.zeros(T+1, T, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_xht = torch.zeros(T, T, self.model.embed_dim + 2 * self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_global_img_feature = torch.zeros(T, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_word_embedding = torch.zeros(T, T, self.model.embed_dim, device=self.device, dtype=self.dtype)
+        for i in range(T)[::-1]:
+            # the words after i have overwritten r_ht[i+1] with their own relevance, word i starts here
+            self.r_ht[i + 1, i] += r_ht_out[i]
+            self.r_ct[i + 1] = self.r_ht[i + 1]
+            r_gt = lrp_rules.lrp_elementwise_eps(r_out=self.r_ct[i + 1],
+                                                 forward_input=self.it_act[i] * torch.tanh(self.gt[i]),
+                                                 forward_output=self.ct[i+1],
+                                                 eps=self.EPS)
+            self.r_ct[i] = lrp_rules.lrp_elementwise_eps(r_out=self.r_ct[i + 1],
+                                                         forward_input=self.ft_act[i] * self.ct[i],
+                                                         forward_output=self.ct[i+1],
+                                                         eps=self.EPS)
+            self.r_xht[i] = lrp_rules.lrp_linear_eps(r_out=r_gt,
+                                                     forward_input=xht[i],
+                                                     forward_output=self.gt[i],
+                                                     weight=language_weight_g,
+                                                     eps=self.EPS)  #(caption_length, 2 * hidden_dim + embed_dim)
+            self.r_ht[i] = self.r_xht[i][:, self.model.hidden_dim+self.model.embed_dim:]
+            self.r_word_embedding[i] = self.r_xht[i][:, :self.model.embed_dim]
+            self.r_global_img_feature += self.r_xht[i][:, self.model.embed_dim:self.model.embed_dim + self.model.hidden_dim]
+
+        # all the words, heads and pixels at once
+        image_feature_proj = self.image_feature_proj.squeeze(0) #(num_pixel, hidden_dim)
+        self.r_img_feature_proj = lrp_rules.lrp_elementwise_eps(r_out=self.r_global_img_feature.view(T, 1, 1, -1),
+                                                                forward_input=image_feature_proj/self.num_pixels,
+                                                                forward_output=self.global_img_feature.squeeze(0),
+                                                                eps=self.EPS)
+        self.r_img_feature_proj = self.r_img_feature_proj + lrp_rules.lrp_linear_eps(r_out=self.r_value,
+                                                                                     forward_input=image_feature_proj,
+                                                                                     forward_output=self.value.squeeze(0),
+                                                                                     weight=self.model.decoder_v_proj.weight,
+                                                                                     eps=self.EPS)
+        self.r_img_feature = lrp_rules.lrp_linear_eps(r_out=self.r_img_feature_proj,
+                                                      forward_input=image_feature,
+                                                      forward_output=self.image_feature_proj_before_act.squeeze(0),
+                                                      weight=self.model.img_projector.weight.squeeze(-1).squeeze(-1),
+                                                      eps=self.EPS)  #(caption_length, num_explained_head, num_pixel, encode_raw_dim)
+        r_img_feature = self.r_img_feature.transpose(2,3).contiguous().view(T, self.r_img_feature.size(1),
+                                                                           *self.image_features.size()[1:])
+        r_words_all = torch.sum(self.r_word_embedding, dim=-1) #(step, target word)
+        relevance_preceeding_words = []
+        for t in range(T):
+            r_words = r_words_all[:t+1, t]
+            max_abs_r_words = torch.max(torch.abs(r_words))
+            if max_abs_r_words > 0:
+                r_words = r_words / max_abs_r_words
+            relevance_preceeding_words.append(r_words)
+        torch.cuda.empty_cache()
+        return r_img_feature, relevance_preceeding_words
+
     def explain_cnn(self, r_img_feature):
         # cnn_encoder = copy.deepcopy(self.model.img_encoder.encoder)
-        relevance_img = self.model.img_encoder.encoder.compute_lrp(self.img, target=r_img_feature)
+        # r_img_feature can stack the relevance of several words or heads, they are explained in one batch
+        relevance_img = lrp_engine.compute_lrp(self.model.img_encoder.encoder, self.img, r_img_feature)
         # print(torch.sum(relevance_img > 0), torch.sum(relevance_img == 0), torch.sum(relevance_img < 0))
-        self.model.img_encoder.encoder.zero_grad()
         return relevance_img
 
     def explain_caption(self, img_filepath, head_idx, t_list=None):
         self.img_filepath = img_filepath
         self.get_hidden_parameters(img_filepath)
-        relevance_imgs = []
-        relevance_preceeding_words = []
-        lrp_wrapper.add_lrp(self.model.img_encoder.encoder)
-        for t in range(self.caption_length):
-            with torch.no_grad():
-                relevance_img_feature, r_words = self.explain_caption_wordt(t, head_idx)
-            relevance_img = self.explain_cnn(relevance_img_feature)
-            relevance_imgs.append(relevance_img)
-            relevance_preceeding_words.append(r_words)
+        with torch.no_grad():
+            relevance_img_features, relevance_preceeding_words = self.explain_caption_allwords(head_idx)
+        relevance_img = self.explain_cnn(relevance_img_features.flatten(0, 1)) #(caption_length, 3, H, W)
+        relevance_imgs = list(relevance_img.split(1))
         assert len(relevance_imgs) == self.caption_length
         self.visualize_explanations(relevance_imgs, head_idx, t=t_list)
         self.save_linguistic_explanation(relevance_preceeding_words)
         torch.cuda.empty_cache()
         return relevance_imgs, relevance_preceeding_words
 
-    def explain_caption_words(self, img_filepath):
+    def explain_caption_heads(self, img_filepath, t_list=None):
+        '''
+        explain_caption for all the heads, the beam search, the decoder backward and the CNN LRP are shared by the heads
+        :return: relevance_imgs[h][t] is the relevance of word t through head h with shape (1, 3, H, W), and the relevance
+                 of the preceeding words
+        '''
         self.img_filepath = img_filepath
         self.get_hidden_parameters(img_filepath)
-        relevance_preceeding_words = []
-        lrp_wrapper.add_lrp(self.model.img_encoder.encoder)
+        relevance_imgs = [[] for _ in range(self.num_head)]
+        with torch.no_grad():
+            relevance_img_features, relevance_preceeding_words = self.explain_caption_allwords(None)
         for t in range(self.caption_length):
-            with torch.no_grad():
-                relevance_img_feature, r_words = self.explain_caption_wordt(t, 0)
-            relevance_preceeding_words.append(r_words)
+            relevance_img = self.explain_cnn(relevance_img_features[t]) #(num_head, 3, H, W)
+            for h in range(self.num_head):
+                relevance_imgs[h].append(relevance_img[h:h+1])
+        for h in range(self.num_head):
+            self.visualize_explanations(relevance_imgs[h], h, t=t_list)
+        self.save_linguistic_explanation(relevance_preceeding_words)
+        torch.cuda.empty_cache()
+        return relevance_imgs, relevance_preceeding_words
+
+    def explain_caption_words(self, img_filepath):
+        self.img_filepath = img_filepath
+        self.get_hidden_parameters(img_filepath)
+        with torch.no_grad():
+            _, relevance_preceeding_words = self.explain_caption_allwords(0)
         assert len(relevance_preceeding_words) == self.caption_length
         torch.cuda.empty_cache()
         return relevance_preceeding_words
@@ -1256,18 +1553,23 @@ class ExplainAOAAttention(object):
 
 class ExplainAOAGradient(object):
     EX_TYPE = 'gradient'
-    def __init__(self, args, word_map):
+    def __init__(self, args, word_map, model=None):
         super(ExplainAOAGradient, self).__init__()
         self.args = args
         self.word_map = word_map
         self.rev_word_map = {v: k for k, v in word_map.items()}
         self.vocab_size = len(word_map)
         self.num_head = args.num_head
-        self.model = AOAModel(args.embed_dim, args.hidden_dim, args.num_head, len(word_map), args.encoder)
-        checkpoint = torch.load(args.weight)
-        self.model.load_state_dict(checkpoint['state_dict'])
-        self.model.cuda()
+        if model is not None:
+            self.model = model
+        else:
+            self.model = AOAModel(args.embed_dim, args.hidden_dim, args.num_head, len(word_map), args.encoder)
+            checkpoint = torch.load(args.weight, map_location=args.device)
+            self.model.load_state_dict(checkpoint['state_dict'])
+            self.model.to(args.device)
         self.model.eval()
+        self.device = self.model.device
+        self.dtype = self.model.dtype
 
         self.mean = [0.485, 0.456, 0.406]
         self.std = [0.229, 0.224, 0.225]
@@ -1286,10 +1588,24 @@ class ExplainAOAGradient(object):
         if not os.path.isdir(self.visualizatioin_save_path):
             os.makedirs(self.visualizatioin_save_path)
 
+        # a DecodeCache shared with the other explainers of the model, None decodes every image here
+        self.decode_cache = None
+        # everything set so far lives as long as the explainer, the rest is per-image state dropped by reset
+        self.session_attributes = set(self.__dict__) | {'session_attributes'}
+
+    def reset(self):
+        '''
+        drops the per-image state (the image, the caption, the hidden states and the relevance), the model is kept so
+        that the explainer can be reused for the next image
+        '''
+        for name in set(self.__dict__) - self.session_attributes:
+            delattr(self, name)
+        self.model.zero_grad()
+
     def preprocess_img(self, img_filepath):
         image_data = Image.open(img_filepath).convert('RGB')
         img = self.img_transform(image_data)
-        img = img.unsqueeze(0).cuda()
+        img = img.unsqueeze(0).to(self.device, self.dtype)
         return img
 
     def language_lstm_forward(self, xt, ht_m1, ct_m1):
@@ -1306,15 +1622,29 @@ class ExplainAOAGradient(object):
         ct = c
         return ht, ct, z0, z1, z2, z3, i, f, g, o
 
+    def decode(self, img_filepath, beam_size, max_cap_length):
+        '''
+        preprocesses the image, runs the beam search and the encoder. With a decode_cache the image is decoded only once
+        for all the explainers sharing it, and they all explain the same caption
+        :return: img, beam_caption, beam_caption_encode and a dict of the image_features and the avg_feature
+        '''
+        if self.decode_cache is not None:
+            return self.decode_cache.decode(self, img_filepath)
+        img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
+        beam_caption, beam_caption_encode = self.model.beam_search(img, self.word_map, beam_size=beam_size,
+                                                                   max_cap_length=max_cap_length)
+        image_features, avg_feature = self.model.img_encoder(img)  # (bs, fea_dim, H, W), (bs, fea_dim)
+        return img, beam_caption, beam_caption_encode, {'image_features': image_features, 'avg_feature': avg_feature}
+
     def get_hidden_parameters(self, img_filepath):
-        self.img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
-        self.beam_caption, self.beam_caption_encode = self.model.beam_search(self.img, self.word_map, beam_size=3,
-                                                                             max_cap_length=20)
+        self.img, self.beam_caption, self.beam_caption_encode, states = self.decode(img_filepath, beam_size=3,
+                                                                                    max_cap_length=20)
         self.beam_caption_encode = [self.word_map['<start>']] + self.beam_caption_encode
         print(f'the predicted caption of {img_filepath} is "{self.beam_caption[0]}"')
         print(self.beam_caption_encode)
         # perform the forward pass and save the intermediate variables
-        self.image_features, self.avg_feature = self.model.img_encoder(self.img)  # (bs, fea_dim, H, W), (bs, fea_dim)
+        self.image_features = states['image_features']  # (bs, fea_dim, H, W)
+        self.avg_feature = states['avg_feature']  # (bs, fea_dim)
         self.num_pixels = self.image_features.size(-1) * self.image_features.size(-2)
         self.image_feature_proj = self.model.relu(self.model.img_projector(self.image_features))  # (bs, hiddendim, H, W)
         self.image_feature_proj = self.image_feature_proj.contiguous()
@@ -1322,27 +1652,27 @@ class ExplainAOAGradient(object):
         self.image_feature_proj = self.image_feature_proj.transpose(1, 2)  # (bs, num_pixel, hidden_dim)
         self.global_img_feature = self.image_feature_proj.mean(1)  # (bs, hidden_dim)
         self.caption_length = len(self.beam_caption_encode) -1
-        self.predictions = torch.zeros(self.caption_length, self.vocab_size).cuda()
-        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim).cuda()
-        self.alphas = torch.zeros(self.caption_length, self.num_head, self.num_pixels).cuda()
-        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.it = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ft = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ot = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.gt_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.ot_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_aoa_gate = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_aoa_linear = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_aoa = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
+        self.predictions = torch.zeros(self.caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        self.xt = torch.zeros(self.caption_length, self.model.embed_dim + self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.alphas = torch.zeros(self.caption_length, self.num_head, self.num_pixels, device=self.device, dtype=self.dtype)
+        self.ht = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ct = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.it = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ft = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.gt = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ot = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.it_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ft_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.gt_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.ot_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_aoa_gate = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_aoa_linear = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_aoa = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         self.key = self.model.decoder_k_proj(self.image_feature_proj)  # batch_size, num_pixel, hiddendim
         self.value = self.model.decoder_v_proj(self.image_feature_proj)
         for t in range(self.caption_length):
-            it = torch.LongTensor([self.beam_caption_encode[t]]).cuda()
+            it = torch.LongTensor([self.beam_caption_encode[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if self.global_img_feature.dim() == 1:
                 self.global_img_feature = self.global_img_feature.unsqueeze(0)
@@ -1385,13 +1715,13 @@ class ExplainAOAGradient(object):
         image_feature_proj = image_feature_proj.transpose(1, 2)  # (bs, num_pixel, hidden_dim)
         global_img_feature = image_feature_proj.mean(1)  # (bs, hidden_dim)
         caption_length = len(beam_caption_encode)
-        predictions = torch.zeros(caption_length, self.vocab_size).cuda()
-        ht = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
-        ct = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
+        predictions = torch.zeros(caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        ht = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        ct = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         key = self.model.decoder_k_proj(image_feature_proj)  # batch_size, num_pixel, hiddendim
         value = self.model.decoder_v_proj(image_feature_proj)
         for t in range(len(beam_caption_encode)):
-            it = torch.LongTensor([beam_caption_encode[t]]).cuda()
+            it = torch.LongTensor([beam_caption_encode[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
@@ -1425,7 +1755,7 @@ class ExplainAOAGradient(object):
         d_k = self.model.hidden_dim // num_head  # (should be 64 if using vgg and 8 heads)
         d_context = d_context.clone().contiguous().view(num_query, num_head, d_k).transpose(0, 1)  # (num_head, num_query, d_k)
         alpha = alpha.unsqueeze(1)  # (num_head, num_query, num_pixel)
-        d_value = torch.zeros(num_head, num_pixel, d_k).cuda()
+        d_value = torch.zeros(num_head, num_pixel, d_k, device=self.device, dtype=self.dtype)
         for i in range(head_idx, head_idx+1):
             for j in range(num_pixel):
                 d_value[i,j] = d_context[i,0]*alpha[i,0,j]
@@ -1436,27 +1766,27 @@ class ExplainAOAGradient(object):
         assert t < self.caption_length  #(t starts from 0)
         preceeding_cap_length = t+1
         target_word_encode = self.beam_caption_encode[t+1]
-        d_word_pred = torch.zeros(1, self.vocab_size).cuda()
+        d_word_pred = torch.zeros(1, self.vocab_size, device=self.device, dtype=self.dtype)
         d_word_pred[0, target_word_encode] = 1.  #(1, vocab_size)
 
-        d_ht = torch.zeros(preceeding_cap_length + 1, self.model.hidden_dim).cuda()
-        d_ct = torch.zeros(preceeding_cap_length + 1, self.model.hidden_dim).cuda()
-        d_it = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ft = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_gt = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ot = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_it_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ft_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_gt_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_ot_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_xt = torch.zeros(preceeding_cap_length, self.model.hidden_dim + self.model.embed_dim).cuda()
-        d_global_img_feature = torch.zeros(self.model.hidden_dim).cuda()
-        d_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim).cuda()
-        d_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim).cuda()
-        d_context_aoa = torch.zeros(self.model.hidden_dim).cuda()
-        d_decoder_A = torch.zeros(self.model.hidden_dim).cuda()
-        d_decoder_B = torch.zeros(self.model.hidden_dim).cuda()
-        d_value = torch.zeros(self.num_pixels, self.model.hidden_dim).cuda()
+        d_ht = torch.zeros(preceeding_cap_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ct = torch.zeros(preceeding_cap_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_it = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ft = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_gt = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ot = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_it_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ft_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_gt_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_ot_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_xt = torch.zeros(preceeding_cap_length, self.model.hidden_dim + self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_global_img_feature = torch.zeros(self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim, device=self.device, dtype=self.dtype)
+        d_context_aoa = torch.zeros(self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_decoder_A = torch.zeros(self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_decoder_B = torch.zeros(self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_value = torch.zeros(self.num_pixels, self.model.hidden_dim, device=self.device, dtype=self.dtype)
 
         # here we start the backward
         d_context_aoa_ht = torch.matmul(d_word_pred, self.output_weight).squeeze()
@@ -1742,7 +2072,7 @@ class ExplainAOAGuidedGradCam(ExplainAOAGuidedGradient):
         # cam = F.interpolate(cam.unsqueeze(0).unsqueeze(0), size=(self.img.size(2), self.img.size(3)), mode='bilinear', align_corners=True)
         cam = skimage.transform.pyramid_expand(cam.detach().cpu().numpy(), upscale=16,multichannel=False)
         with torch.no_grad():
-            guided_results = guided_gradient * torch.from_numpy(cam).cuda().float().expand_as(guided_gradient)
+            guided_results = guided_gradient * torch.from_numpy(cam).to(self.device, self.dtype).expand_as(guided_gradient)
         cnn_encoder.zero_grad()
         sample.grad.zero_()
         self.delete_hooks(cnn_encoder)
@@ -1806,22 +2136,40 @@ class AOAModelBU(nn.Module):
         self.relu = nn.ReLU()
         # self.refiner_batchnorm = nn.BatchNorm1d(hidden_dim, track_running_stats=True)
 
+    @property
+    def device(self):
+        # the device and dtype follow the parameters, call model.to(device, dtype) to move the model
+        return self.fc.weight.device
+
+    @property
+    def dtype(self):
+        return self.fc.weight.dtype
+
     def init_hidden_state(self, V):
-        h = torch.zeros(V.shape[0], self.hidden_dim).cuda()
-        c = torch.zeros(V.shape[0], self.hidden_dim).cuda()
+        h = torch.zeros(V.shape[0], self.hidden_dim, device=self.device, dtype=self.dtype)
+        c = torch.zeros(V.shape[0], self.hidden_dim, device=self.device, dtype=self.dtype)
         return h, c
 
-    def predict_next_word(self,image_feature_proj, xt, states):
+    def project_memory(self, image_feature_proj):
+        '''
+        The projected keys and values only depend on the image, they are computed once per image and reused at every step
+        :param image_feature_proj: bs, num_pixel, hidden_dim
+        :return: (key, value) each with shape bs, num_pixel, hidden_dim
+        '''
+        key = self.decoder_k_proj(image_feature_proj)
+        value = self.decoder_v_proj(image_feature_proj)
+        return key, value
+
+    def predict_next_word(self, memory, xt, states):
         '''
-        :param image_feature_proj:  bs, num_pixel, hidden_dim
+        :param memory: (key, value) returned by project_memory, each with shape bs, num_pixel, hidden_dim
         :param xt: bs, hidden_dim + embedding dim
         :param states: (ht, ct, context) each with shape bs, hidden_dim
         :return:
         '''
         htm1, ctm1 = states  # (bs, hidden_dim, )
         ht, ct = self.LanguageLSTM(xt, (htm1, ctm1))
-        key = self.decoder_k_proj(image_feature_proj) # batch_size, num_pixel, 2 * hiddendim this is the concatenated key and value
-        value = self.decoder_v_proj(image_feature_proj)
+        key, value = memory
         context, alpha_t = self.decoder_multihead_attention(ht, key, value) #(bs, hidden_dim) alpha: (bs, num_pixel)
         context_aoa_gate = self.decoder_aoa_linear_gate(ht)
         context_aoa_linear = self.decoder_aoa_linear(context)
@@ -1842,15 +2190,16 @@ class AOAModelBU(nn.Module):
         image_feature_proj = image_feature_proj.contiguous() #(bs, num_pixel, hidden_dim)
         global_img_feature = torch.mean(image_feature_proj, dim=1) #(bs, hidden_dim)
         h, c = self.init_hidden_state(image_feature_proj)
+        memory = self.project_memory(image_feature_proj)
         state = (h, c)
         max_length = max(caption_lengths)-1
-        predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
+        predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
         if ss_prob is None:
             ss_flag = False
         else:
             random_num = np.random.uniform(0.0, 1.0, size=(batch_size,))
             ss_mask = random_num < ss_prob
-            ss_mask = torch.from_numpy(ss_mask).long().cuda()
+            ss_mask = torch.from_numpy(ss_mask).long().to(self.device)
             if ss_mask.sum() > 0:
                 ss_flag = True
             else:
@@ -1865,7 +2214,7 @@ class AOAModelBU(nn.Module):
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
             xt = torch.cat((word_embedding, global_img_feature), dim=-1)   # (batch_size, hidden_dim + embed_dim)
-            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
             predictions[:, t,:] = predict_score_t
             last_scores = torch.log_softmax(predict_score_t,-1)
             # print(last_scores.size())
@@ -1882,17 +2231,18 @@ class AOAModelBU(nn.Module):
         image_feature_proj = self.relu(self.img_projector(images_features))  # (bs, 36, hiddendim)
         global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
         h, c = self.init_hidden_state(image_feature_proj)
+        memory = self.project_memory(image_feature_proj)
         state = (h, c)
-        seq = torch.zeros(batch_size,max_length).long().cuda()
-        seq_logprobs = torch.zeros(batch_size, max_length).cuda()
+        seq = torch.zeros(batch_size,max_length, device=self.device, dtype=torch.long)
+        seq_logprobs = torch.zeros(batch_size, max_length, device=self.device, dtype=self.dtype)
         for t in range(max_length):
             if t == 0:
-                it = torch.ones(batch_size).long().cuda() * word_map['<start>']
+                it = torch.ones(batch_size, device=self.device, dtype=torch.long) * word_map['<start>']
             word_embedding = self.embedding(it)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
             xt = torch.cat((word_embedding,  global_img_feature), dim=-1)  # (batch_size, 2*embed_dim)
-            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
             predict_score_t = torch.log_softmax(predict_score_t,dim=-1)
             it, sampleLpgprobs = self.sample_next_word(predict_score_t, sample_method, temperature)
             # sample the next word
@@ -1916,7 +2266,7 @@ class AOAModelBU(nn.Module):
             it = it.view(-1).long()
         elif sample_method == 'gumbel': # gumbel softmax
             def sample_gumbel(shape, eps=1e-20):
-                U = torch.rand(shape).cuda()
+                U = torch.rand(shape, device=self.device, dtype=self.dtype)
                 return -torch.log(-torch.log(U + eps) + eps)
             def gumbel_softmax_sample(logits, temperature):
                 y = logits + sample_gumbel(logits.size())
@@ -1979,17 +2329,18 @@ class AOAModelBU(nn.Module):
         with torch.no_grad():
             complete_seqs = [[] for g in range(num_group)]
             complete_seqs_scores = [[] for g in range(num_group)]
-            k_prev_words = [torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() for g in range(num_group)] # (beam_size,)
-            top_k_scores = [torch.zeros(beam_size, 1).cuda() for g in range(num_group)] # (beam_size, 1)
-            seqs = [torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() for g in range(num_group)]   # (unfinished_num, )
+            k_prev_words = [torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) for g in range(num_group)] # (beam_size,)
+            top_k_scores = [torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) for g in range(num_group)] # (beam_size, 1)
+            seqs = [torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) for g in range(num_group)]   # (unfinished_num, )
             image_feature_proj = self.relu(self.img_projector(images_features)) # batch_size, 36, hidden_dim
             global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
 
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
-            image_feature_proj = [image_feature_proj.expand(beam_size, *image_feature_proj.size()[1:]) for g in range(num_group)]  # batch_size, H*W, hidden_dim
+            memory = self.project_memory(image_feature_proj)
+            memory = [tuple(m.expand(beam_size, *m.size()[1:]) for m in memory) for g in range(num_group)]  # (key, value) beam_size, H*W, hidden_dim
             global_img_feature = [global_img_feature.expand(beam_size, global_img_feature.size(-1)) for g in range(num_group)] #  beam_size, hidden_dim,
-            h, c = self.init_hidden_state(image_feature_proj[0])
+            h, c = self.init_hidden_state(memory[0][0])
             init_state = (h, c)
             state = [init_state for g in range(num_group)]  #(ht, ct)
             unfinished_num = [beam_size for g in range(num_group)]
@@ -2001,7 +2352,7 @@ class AOAModelBU(nn.Module):
                     word_embedding = self.embedding(k_prev_words[g]).squeeze(1)  # unfinished_num, embedding_dim
                     xt = torch.cat((word_embedding,  global_img_feature[g]), dim=-1)  # (batch_size, embed_dim + hidden_dim)
                     # print(image_feature_proj[g].size(), xt.size(), state[g])
-                    predict_score_t, alpha_t, beta_t, state[g] = self.predict_next_word(image_feature_proj[g], xt, state[g])
+                    predict_score_t, alpha_t, beta_t, state[g] = self.predict_next_word(memory[g], xt, state[g])
                     predict_score_t = torch.log_softmax(predict_score_t, dim=-1)  # (unfinished_num, vocab_size)
                     for i, v in enumerate(previous_idx):
                         predict_score_t[:,int(v)] = predict_score_t[:, int(v)] - diversity_prob
@@ -2031,7 +2382,7 @@ class AOAModelBU(nn.Module):
                     for s_idx in range(len(state[g])):
                         new_state.append(state[g][s_idx][beam_idx[incomplete_inds]])
                     state[g] = tuple(new_state)
-                    image_feature_proj[g] = image_feature_proj[g][beam_idx[incomplete_inds]]
+                    memory[g] = tuple(m[beam_idx[incomplete_inds]] for m in memory[g])
                     global_img_feature[g] = global_img_feature[g][beam_idx[incomplete_inds]]
                     top_k_scores[g] = top_k_scores[g][incomplete_inds].unsqueeze(1)
                     if g < 2:
@@ -2074,23 +2425,24 @@ class AOAModelBU(nn.Module):
         complete_seqs =[]
         complete_seqs_scores=[]
         with torch.no_grad():
-            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() # (beam_size,)
-            top_k_scores = torch.zeros(beam_size, 1).cuda() # (beam_size, 1)
-            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).cuda()  # (unfinished_num, )
+            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) # (beam_size,)
+            top_k_scores = torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) # (beam_size, 1)
+            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device)  # (unfinished_num, )
             image_feature_proj = self.relu(self.img_projector(images_features)) # batch_size, 36, hidden_dim
             global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
             # print(global_img_feature.size())
-            image_feature_proj = image_feature_proj.expand(beam_size, *image_feature_proj.size()[1:])  # batch_size, H*W, hidden_dim
+            memory = self.project_memory(image_feature_proj)
+            memory = tuple(m.expand(beam_size, *m.size()[1:]) for m in memory)  # (key, value) beam_size, H*W, hidden_dim
             global_img_feature = global_img_feature.expand(beam_size, global_img_feature.size(-1)) #  beam_size, hidden_dim,
-            h, c = self.init_hidden_state(image_feature_proj)
+            h, c = self.init_hidden_state(memory[0])
             state = (h, c)
             unfinished_num = beam_size
             for step in range(max_cap_length):
                 word_embedding = self.embedding(k_prev_words).squeeze(1) # unfinished_num, embedding_dim
                 xt = torch.cat((word_embedding, global_img_feature), dim=-1) # (batch_size, 2*embed_dim + hidden_dim)
-                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
                 predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(unfinished_num, vocab_size)
                 top_k_scores_exp = top_k_scores.expand((unfinished_num, vocab_size))
                 scores = top_k_scores_exp + predict_score_t
@@ -2118,7 +2470,7 @@ class AOAModelBU(nn.Module):
                 for s_idx in range(len(state)):
                     new_state.append(state[s_idx][beam_idx[incomplete_inds]])
                 state = tuple(new_state)
-                image_feature_proj = image_feature_proj[beam_idx[incomplete_inds]]
+                memory = tuple(m[beam_idx[incomplete_inds]] for m in memory)
                 global_img_feature = global_img_feature[beam_idx[incomplete_inds]]
                 top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
                 k_prev_words = next_word_idx[incomplete_inds].unsqueeze(1)
@@ -2140,19 +2492,20 @@ class AOAModelBU(nn.Module):
         rev_word_map = {v: k for k, v in word_map.items()}
         complete_seq =[]
         with torch.no_grad():
-            k_prev_words = torch.zeros(batch_size, max_cap_length).long().cuda() # (batch_size, caption_length)
+            k_prev_words = torch.zeros(batch_size, max_cap_length, device=self.device, dtype=torch.long) # (batch_size, caption_length)
             k_prev_words[:, 0] = word_map['<start>'] # the first word is '<start>'
             seqs_temp = [[word_map['<start>']] for _ in range(batch_size)]
             image_feature_proj = self.relu(self.img_projector(images_features)) # batch_size, hidden_dim, H, W
             global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
             h, c = self.init_hidden_state(image_feature_proj)
+            memory = self.project_memory(image_feature_proj)
             state = (h, c)
             for step in range(max_cap_length-1):
                 word_embedding = self.embedding(k_prev_words[:, step]) # batch_size, embedding_dim
                 if global_img_feature.dim() == 1:
                     global_img_feature = global_img_feature.unsqueeze(0)
                 xt = torch.cat((word_embedding,  global_img_feature), dim=-1) # (batch_size, embed_dim + hidden_dim)
-                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
                 predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(batch_size, vocab_size)
                 top_scores, top_words = predict_score_t.topk(1, -1, True, True)
                 if step == 0:
@@ -2187,20 +2540,7 @@ class AOAModelBU(nn.Module):
         assert r_out.dim() == 1
         assert forward_input.dim() == 1
         assert weight.dim() == 2
-        attribution = weight * forward_input #(out_feature, in_feature)
-        if type(forward_output) == bool:
-            forward_output = torch.matmul(forward_input, weight.transpose(0,1))
-            # print('matml', forward_output.size())
-        forward_output_eps = self.EPS * forward_output.sign() + forward_output  # Z.sign() returns -1 or 0 or 1
-
-        forward_output_eps.masked_fill_(forward_output_eps == 0, self.EPS)  #(out_feature,)
-        # print(forward_output_eps.size())
-        attribution_norm = attribution.transpose(0,1) / forward_output_eps #(in_feature, out_feature)
-        # print(attribution_norm.size())
-        relevance_input = torch.sum(attribution_norm * r_out, dim=-1) #(in_feature,)
-        assert relevance_input.size() == forward_input.size()
-        torch.cuda.empty_cache()
-        return relevance_input
+        return lrp_rules.lrp_linear_eps(r_out, forward_input, forward_output, weight, self.EPS)
 
     def lrp_mha(self, alpha, value, r_context, context):
         '''
@@ -2209,55 +2549,37 @@ class AOAModelBU(nn.Module):
         :param value: shape is  num_pixel hiddendim
         :param r_context: shape is  1, hiddendim
         :param context shape is 1, hiddendim
-        :return:
+        :return: the value relevance summed over the heads, num_pixel, hiddendim
         '''
-        num_head = alpha.size(0)
-        num_pixel = alpha.size(1)
-        num_query = r_context.size(0)  #(should be 1 if we use ht ad the query)
-        '''spread single head'''
-        d_k = self.model.hidden_dim//num_head #(should be 64 if using vgg and 8 heads)
-        r_context = r_context.clone().contiguous().view(num_query, num_head, d_k).transpose(0, 1) #(num_head, num_query, d_k)
-        context = context.clone().contiguous().view(num_query, num_head, d_k).transpose(0,1)  #(num_head, num_query, d_k)
-        value = value.clone().contiguous().view(num_pixel, num_head, d_k).transpose(0, 1) #(num_head, num_pixel, d_k)
-        r_value = value.clone()
-        for h in range(num_head):
-            for i in range(num_pixel):
-                r = self.lrp_linear_eps(r_out=r_context[h,0],
-                                                forward_input=value[h,i]*alpha[h,i],
-                                                forward_output=context[h,0],
-                                                weight=torch.eye(d_k).cuda())
-                r_value[h, i] = r
-        # print(r_value[:, 0].squeeze())
-        r_value = r_value.transpose(0, 1).contiguous().view(num_pixel, self.model.hidden_dim)
-        # print(r_value[0])
+        _, r_value = lrp_rules.lrp_mha_eps(alpha, value, r_context, context, self.EPS)
         return r_value
 
     def get_lrp_weight_step(self, predictions_t, rev_word_map, ht_, context_aoa):
         batch_size, vocab_size = predictions_t.size()
         with torch.no_grad():
-            weight_of_context_aoa = torch.zeros(batch_size, self.hidden_dim).cuda()
-            weight_of_ht = torch.zeros(batch_size, self.hidden_dim).cuda()
+            weight_of_context_aoa = torch.zeros(batch_size, self.hidden_dim, device=self.device, dtype=self.dtype)
+            weight_of_ht = torch.zeros(batch_size, self.hidden_dim, device=self.device, dtype=self.dtype)
             for b in range(batch_size):
                 predicted_labels = torch.argmax(predictions_t[b], dim=-1)  # (the predicted label of image b)  (max_length)
                 word_t = predicted_labels.item()
                 if rev_word_map[word_t] in STOP_WORDS + ['<start>','<end>','<pad>','<unk>']:
                     continue
                 else:
-                    word_relevance = torch.zeros(self.vocab_size).cuda()
+                    word_relevance = torch.zeros(self.vocab_size, device=self.device, dtype=self.dtype)
                     word_relevance[word_t] = predictions_t[b][word_t]
                     r_h2t_context_aoa = self.lrp_linear_eps(r_out=word_relevance,
                                                             forward_input=ht_[b] + context_aoa[b],
                                                             forward_output=predictions_t[b],
                                                             weight=self.fc.weight)
-                    r_h2t = self.lrp_linear_eps(r_out=r_h2t_context_aoa,
-                                                forward_input=ht_[b],
-                                                forward_output=ht_[b] + context_aoa[b],
-                                                weight=torch.eye(self.hidden_dim).cuda())
+                    r_h2t = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_aoa,
+                                                          forward_input=ht_[b],
+                                                          forward_output=ht_[b] + context_aoa[b],
+                                                          eps=self.EPS)
                     weight_of_ht[b] = r_h2t
-                    r_context_aoa = self.lrp_linear_eps(r_out=r_h2t_context_aoa,
-                                                        forward_input=context_aoa[b],
-                                                        forward_output=ht_[b] + context_aoa[b],
-                                                        weight=torch.eye(self.hidden_dim).cuda())
+                    r_context_aoa = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_aoa,
+                                                                  forward_input=context_aoa[b],
+                                                                  forward_output=ht_[b] + context_aoa[b],
+                                                                  eps=self.EPS)
                     weight_of_context_aoa[b] = r_context_aoa
             weight_of_context_aoa = LRPutil.normalize_relevance(weight_of_context_aoa, dim=-1)
             weight_of_ht = LRPutil.normalize_relevance(weight_of_ht, dim=-1)
@@ -2284,11 +2606,10 @@ class AOAModelBU(nn.Module):
         h, c = self.init_hidden_state(image_feature_proj)
         state = (h, c)
 
-        key = self.decoder_k_proj(image_feature_proj)
-        value = self.decoder_v_proj(image_feature_proj)
+        key, value = self.project_memory(image_feature_proj)
         max_length = max(caption_lengths) - 1
-        predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
-        weighted_predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
+        predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        weighted_predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
         for t in range(max_length):
             word_embedding = self.embedding(encoded_captions[:, t])
             if global_img_feature.dim() == 1:
@@ -2328,15 +2649,14 @@ class AOAModelBU(nn.Module):
         max_length = max(caption_lengths) - 1
         image_feature_proj = self.relu(self.img_projector(images_features))  # (bs, hiddendim, H, W)
         global_img_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hidden_dim)
-        key = self.decoder_k_proj(image_feature_proj)
-        value = self.decoder_v_proj(image_feature_proj)
+        key, value = self.project_memory(image_feature_proj)
         h, c = self.init_hidden_state(image_feature_proj)
         state = (h, c)
-        seq = torch.zeros(batch_size,max_length).long().cuda()
-        seq_logprobs = torch.zeros(batch_size, max_length).cuda()
+        seq = torch.zeros(batch_size,max_length, device=self.device, dtype=torch.long)
+        seq_logprobs = torch.zeros(batch_size, max_length, device=self.device, dtype=self.dtype)
         for t in range(max_length):
             if t == 0:
-                it = torch.ones(batch_size).long().cuda() * word_map['<start>']
+                it = torch.ones(batch_size, device=self.device, dtype=torch.long) * word_map['<start>']
             word_embedding = self.embedding(it)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
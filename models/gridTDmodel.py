@@ -10,8 +10,9 @@ from matplotlib import pyplot as plt
 import torchvision.transforms as transforms
 import gc
 import os
-from LRPtools import lrp_wrapper
+from LRPtools import lrp_engine
 from LRPtools import utils as LRPutil
+from LRPtools import lrp_rules
 import yaml
 import skimage.transform
 from nltk.corpus import stopwords
@@ -68,23 +69,28 @@ class AdaptiveAttention(nn.Module):
         self.W_g_proj = nn.Linear(hidden_dim,n_pixel,bias=False)
         self.w_h = nn.Linear(n_pixel, 1, bias=False)
 
-    def forward(self, V, ht, st):
+    def prepare(self, V):
         """
+        The image side of the attention does not change over the decoding steps, so it is computed once per image
         V: the spatial image of size (batch_size,hidden_size,num_pixel)
-        decoder_out: the decoder hidden state of shape (batch_size, hidden_size)
-        st: visual sentinal returned by the Sentinal class, of shape: (batch_size, hidden_size)
+        return: V transposed to (batch_size, num_pixel, hidden_size) and its projection (batch_size, num_pixel, num_pixel)
         """
         V = V.transpose(1,2)  #(bs, num_pixel,hidden_dim)
-        batch_size = ht.size(0)
         img_proj = self.W_v_proj(V) # (bs, num_pixel, num_pixel)
-        # print('img_proj', img_proj.size())
+        return V, img_proj
+
+    def forward(self, V, ht, st):
+        """
+        V: the spatial image of size (batch_size,hidden_size,num_pixel) or the (V, img_proj) tuple returned by prepare
+        decoder_out: the decoder hidden state of shape (batch_size, hidden_size)
+        st: visual sentinal returned by the Sentinal class, of shape: (batch_size, hidden_size)
+        """
+        if not isinstance(V, tuple):
+            V = self.prepare(V)
+        V, img_proj = V
         ht_proj = self.W_g_proj(ht)        # (-1, num_pixel)
         # print('ht_proj', ht_proj.size())
-        one_matrix = torch.ones(batch_size,1, self.num_pixel).cuda() # (bs, 1, num_pixel)
-        # print('one_matrix', one_matrix.size())
-        ht_proj_expand = torch.bmm(ht_proj.unsqueeze(2), one_matrix) #(bs, num_pixel, num_pixel)
-        # print('ht_proj_expand', ht_proj_expand.size())
-        z_t = self.w_h(torch.tanh(img_proj+ht_proj_expand)) #(bs, num_pixel, 1)
+        z_t = self.w_h(torch.tanh(img_proj+ht_proj.unsqueeze(2))) #(bs, num_pixel, 1), ht_proj is broadcast over the last dim
         # print('zt', z_t.size())
         alpha_t = torch.softmax(z_t, dim=1) #(bs, num_pixel,1)
         # print('alpha', alpha_t.size())
@@ -129,15 +135,24 @@ class GridTDModel(nn.Module):
         self.fc = nn.Linear(hidden_dim, vocab_size)
         self.relu = nn.ReLU()
 
+    @property
+    def device(self):
+        # the device and dtype follow the parameters, call model.to(device, dtype) to move the model
+        return self.fc.weight.device
+
+    @property
+    def dtype(self):
+        return self.fc.weight.dtype
+
     def init_hidden_state(self, V):
-        h = torch.zeros(V.shape[0], self.hidden_dim).cuda()
-        c = torch.zeros(V.shape[0], self.hidden_dim).cuda()
+        h = torch.zeros(V.shape[0], self.hidden_dim, device=self.device, dtype=self.dtype)
+        c = torch.zeros(V.shape[0], self.hidden_dim, device=self.device, dtype=self.dtype)
         return h, c
 
-    def predict_next_word(self,image_feature_proj, xt, states):
+    def predict_next_word(self, memory, xt, states):
         h1t, c1t, h2t, c2t = states  # (bs, hidden_dim, )
         h1t, c1t, st = self.AdaLSTM(xt, (h1t, c1t))  #(bs, hidden_dim, )
-        context_t_hat, context_t, alpha_t, beta_t = self.AdaAttention(image_feature_proj, h1t, st)  #(bs, hidden_dim) alpha: (bs, num_pixel), beta:(bs, 1)
+        context_t_hat, context_t, alpha_t, beta_t = self.AdaAttention(memory, h1t, st)  #(bs, hidden_dim) alpha: (bs, num_pixel), beta:(bs, 1)
         language_input = torch.cat((context_t_hat, h1t), dim=-1) #(bs, 2*hiddendim)
         h2t, c2t = self.LanguageLSTM(language_input, (h2t, c2t))  #(bs, hiddendim)
         predict_score_t = self.fc(self.dropout(context_t_hat + h2t))  # (bs, vocab_size)
@@ -161,19 +176,20 @@ class GridTDModel(nn.Module):
         image_feature_proj = image_feature_proj.contiguous()
         image_feature_proj = image_feature_proj.view(batch_size, self.hidden_dim, -1) # (bs, hidden_dim, num_pixel)
         # print(image_feature_proj.size())
+        memory = self.AdaAttention.prepare(image_feature_proj)
         h1, c1 = self.init_hidden_state(image_feature_proj)
         h2, c2 = self.init_hidden_state(image_feature_proj)
         state = (h1, c1, h2, c2)
         max_length = max(caption_lengths)-1
-        predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
-        alphas = torch.zeros(batch_size, max_length , num_pixels).cuda()
-        betas = torch.zeros(batch_size, max_length,1).cuda()
+        predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        alphas = torch.zeros(batch_size, max_length , num_pixels, device=self.device, dtype=self.dtype)
+        betas = torch.zeros(batch_size, max_length,1, device=self.device, dtype=self.dtype)
         if ss_prob is None:
             ss_flag = False
         else:
             random_num = np.random.uniform(0.0, 1.0, size=(batch_size,))
             ss_mask = random_num < ss_prob
-            ss_mask = torch.from_numpy(ss_mask).long().cuda()
+            ss_mask = torch.from_numpy(ss_mask).long().to(self.device)
             if ss_mask.sum() > 0:
                 ss_flag = True
             else:
@@ -187,7 +203,7 @@ class GridTDModel(nn.Module):
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
             xt = torch.cat((state[2], global_img_feature, word_embedding), dim=-1)   # (batch_size, 2*embed_dim + hidden_dim)
-            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
             predictions[:, t,:] = predict_score_t
             alphas[:, t, :] = alpha_t
             betas[:, t, :] = beta_t
@@ -213,17 +229,18 @@ class GridTDModel(nn.Module):
         # print(global_img_feature.size())
         image_feature_proj = image_feature_proj.contiguous()
         image_feature_proj = image_feature_proj.view(batch_size, self.hidden_dim, -1)  # (bs, hidden_dim, num_pixel)
+        memory = self.AdaAttention.prepare(image_feature_proj)
         state = self.init_hidden_state(image_feature_proj) + self.init_hidden_state(image_feature_proj)
-        seq = torch.zeros(batch_size,max_length).long().cuda()
-        seq_logprobs = torch.zeros(batch_size, max_length).cuda()
+        seq = torch.zeros(batch_size,max_length, device=self.device, dtype=torch.long)
+        seq_logprobs = torch.zeros(batch_size, max_length, device=self.device, dtype=self.dtype)
         for t in range(max_length):
             if t == 0:
-                it = torch.ones(batch_size).long().cuda() * word_map['<start>']
+                it = torch.ones(batch_size, device=self.device, dtype=torch.long) * word_map['<start>']
             word_embedding = self.embedding(it)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
             xt = torch.cat((state[2], global_img_feature, word_embedding), dim=-1)  # (batch_size, 2*embed_dim)
-            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
             predict_score_t = torch.log_softmax(predict_score_t,dim=-1)
             it, sampleLpgprobs = self.sample_next_word(predict_score_t, sample_method, temperature)
             # sample the next word
@@ -247,7 +264,7 @@ class GridTDModel(nn.Module):
             it = it.view(-1).long()
         elif sample_method == 'gumbel': # gumbel softmax
             def sample_gumbel(shape, eps=1e-20):
-                U = torch.rand(shape).cuda()
+                U = torch.rand(shape, device=self.device, dtype=self.dtype)
                 return -torch.log(-torch.log(U + eps) + eps)
             def gumbel_softmax_sample(logits, temperature):
                 y = logits + sample_gumbel(logits.size())
@@ -320,18 +337,19 @@ class GridTDModel(nn.Module):
         with torch.no_grad():
             complete_seqs = [[] for g in range(num_group)]
             complete_seqs_scores = [[] for g in range(num_group)]
-            k_prev_words = [torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() for g in range(num_group)] # (beam_size,)
-            top_k_scores = [torch.zeros(beam_size, 1).cuda() for g in range(num_group)] # (beam_size, 1)
-            seqs = [torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() for g in range(num_group)]   # (unfinished_num, )
+            k_prev_words = [torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) for g in range(num_group)] # (beam_size,)
+            top_k_scores = [torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) for g in range(num_group)] # (beam_size, 1)
+            seqs = [torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) for g in range(num_group)]   # (unfinished_num, )
             image_features, avg_feature = self.img_encoder(imgs) #
             image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
             image_feature_proj = image_feature_proj.view(batch_size, image_feature_proj.size(1), -1) # batch_size, hidden_dim, H*W
             global_img_feature = self.relu(self.global_img_feature_proj(avg_feature))
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
-            image_feature_proj = [image_feature_proj.expand(beam_size, *image_feature_proj.size()[1:]) for g in range(num_group)] # beam_size, hidden_dim, H*W
+            memory = self.AdaAttention.prepare(image_feature_proj)
+            memory = [tuple(m.expand(beam_size, *m.size()[1:]) for m in memory) for g in range(num_group)] # (V, img_proj) beam_size, H*W, hidden_dim / H*W
             global_img_feature = [global_img_feature.expand(beam_size, global_img_feature.size(-1)) for g in range(num_group)] #  beam_size, hidden_dim,
-            init_state = self.init_hidden_state(image_feature_proj[0]) + self.init_hidden_state(image_feature_proj[0])
+            init_state = self.init_hidden_state(memory[0][0]) + self.init_hidden_state(memory[0][0])
             state = [init_state for g in range(num_group)]  #(ht, ct)
             unfinished_num = [beam_size for g in range(num_group)]
             for step in range(max_cap_length):
@@ -341,7 +359,7 @@ class GridTDModel(nn.Module):
                         continue
                     word_embedding = self.embedding(k_prev_words[g]).squeeze(1)  # unfinished_num, embedding_dim
                     xt = torch.cat((state[g][2], global_img_feature[g], word_embedding), dim=-1)  # (batch_size, 2*embed_dim + hidden_dim)
-                    predict_score_t, alpha_t, beta_t, state[g] = self.predict_next_word(image_feature_proj[g], xt, state[g])
+                    predict_score_t, alpha_t, beta_t, state[g] = self.predict_next_word(memory[g], xt, state[g])
                     predict_score_t = torch.log_softmax(predict_score_t, dim=-1)  # (unfinished_num, vocab_size)
                     for i, v in enumerate(previous_idx):
                         predict_score_t[:,int(v)] = predict_score_t[:, int(v)] - diversity_prob
@@ -371,7 +389,7 @@ class GridTDModel(nn.Module):
                     for s_idx in range(len(state[g])):
                         new_state.append(state[g][s_idx][beam_idx[incomplete_inds]])
                     state[g] = tuple(new_state)
-                    image_feature_proj[g] = image_feature_proj[g][beam_idx[incomplete_inds]]
+                    memory[g] = tuple(m[beam_idx[incomplete_inds]] for m in memory[g])
                     global_img_feature[g] = global_img_feature[g][beam_idx[incomplete_inds]]
                     top_k_scores[g] = top_k_scores[g][incomplete_inds].unsqueeze(1)
                     if g < 2:
@@ -415,9 +433,9 @@ class GridTDModel(nn.Module):
         complete_seqs =[]
         complete_seqs_scores=[]
         with torch.no_grad():
-            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() # (beam_size,)
-            top_k_scores = torch.zeros(beam_size, 1).cuda() # (beam_size, 1)
-            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).cuda()  # (unfinished_num, )
+            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) # (beam_size,)
+            top_k_scores = torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) # (beam_size, 1)
+            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device)  # (unfinished_num, )
             image_features, avg_feature = self.img_encoder(imgs) #
             image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
             # print(image_feature_proj.size())
@@ -426,14 +444,15 @@ class GridTDModel(nn.Module):
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
             # print(global_img_feature.size())
-            image_feature_proj = image_feature_proj.expand(beam_size, *image_feature_proj.size()[1:]) # beam_size, hidden_dim, H*W
+            memory = self.AdaAttention.prepare(image_feature_proj)
+            memory = tuple(m.expand(beam_size, *m.size()[1:]) for m in memory) # (V, img_proj) beam_size, H*W, hidden_dim / H*W
             global_img_feature = global_img_feature.expand(beam_size, global_img_feature.size(-1)) #  beam_size, hidden_dim,
-            state = self.init_hidden_state(image_feature_proj) +  self.init_hidden_state(image_feature_proj)  #(ht, ct)
+            state = self.init_hidden_state(memory[0]) +  self.init_hidden_state(memory[0])  #(ht, ct)
             unfinished_num = beam_size
             for step in range(max_cap_length):
                 word_embedding = self.embedding(k_prev_words).squeeze(1) # unfinished_num, embedding_dim
                 xt = torch.cat((state[2], global_img_feature, word_embedding), dim=-1) # (batch_size, 2*embed_dim + hidden_dim)
-                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
                 predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(unfinished_num, vocab_size)
                 top_k_scores_exp = top_k_scores.expand((unfinished_num, vocab_size))
                 scores = top_k_scores_exp + predict_score_t
@@ -461,7 +480,7 @@ class GridTDModel(nn.Module):
                 for s_idx in range(len(state)):
                     new_state.append(state[s_idx][beam_idx[incomplete_inds]])
                 state = tuple(new_state)
-                image_feature_proj = image_feature_proj[beam_idx[incomplete_inds]]
+                memory = tuple(m[beam_idx[incomplete_inds]] for m in memory)
                 global_img_feature = global_img_feature[beam_idx[incomplete_inds]]
                 top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
                 k_prev_words = next_word_idx[incomplete_inds].unsqueeze(1)
@@ -477,26 +496,225 @@ class GridTDModel(nn.Module):
             sentence = self.remove_bad_endings(sentence)
             return sentence, sen_idx
 
+    def beam_search_batch(self, imgs, word_map, beam_size=3, max_cap_length=20):
+        '''
+        The batched version of beam_search. The beams are kept in a (batch_size, beam_size) layout and reordered with
+        gather, each image gets the same output as calling beam_search on it alone
+        :param imgs: (batch_size, C, H, W)
+        :param word_map:
+        :param beam_size:
+        :param max_cap_length:
+        :return: a list of sentences and a list of encoded sentences, one for each image
+        '''
+        self.eval()
+        batch_size = imgs.size(0)
+        rev_word_map = {v: k for k, v in word_map.items()}
+        vocab_size = len(word_map)
+        complete_seqs = [[] for _ in range(batch_size)]
+        complete_seqs_scores = [[] for _ in range(batch_size)]
+        with torch.no_grad():
+            image_features, avg_feature = self.img_encoder(imgs) #
+            image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
+            image_feature_proj = image_feature_proj.view(batch_size, image_feature_proj.size(1), -1) # batch_size, hidden_dim, H*W
+            global_img_feature = self.relu(self.global_img_feature_proj(avg_feature))
+            if global_img_feature.dim() == 1:
+                global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
+            # the beams of image b are the rows b*beam_size ... (b+1)*beam_size-1, they share the same image features
+            memory = self.AdaAttention.prepare(image_feature_proj)
+            memory = tuple(m.repeat_interleave(beam_size, dim=0) for m in memory) # (V, img_proj) batch_size*beam_size, H*W, hidden_dim / H*W
+            global_img_feature = global_img_feature.repeat_interleave(beam_size, dim=0) # batch_size*beam_size, hidden_dim
+            state = self.init_hidden_state(memory[0]) + self.init_hidden_state(memory[0])  #(h1t, c1t, h2t, c2t)
+            k_prev_words = torch.LongTensor([word_map['<start>']] * (batch_size * beam_size)).to(self.device) # (batch_size*beam_size,)
+            seqs = k_prev_words.view(batch_size, beam_size, 1) # (batch_size, beam_size, step+1)
+            # only the first beam is expanded at the first step, the dead beams are marked with -inf
+            top_k_scores = torch.full((batch_size, beam_size), float('-inf'), device=self.device, dtype=self.dtype)
+            top_k_scores[:, 0] = 0
+            unfinished_num = torch.LongTensor([beam_size] * batch_size).to(self.device) # (batch_size,)
+            beam_range = torch.arange(beam_size, device=self.device)
+            beam_offset = (torch.arange(batch_size, device=self.device) * beam_size).unsqueeze(1) # (batch_size, 1)
+            for step in range(max_cap_length):
+                word_embedding = self.embedding(k_prev_words) # batch_size*beam_size, embedding_dim
+                xt = torch.cat((state[2], global_img_feature, word_embedding), dim=-1) # (batch_size*beam_size, 2*embed_dim + hidden_dim)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
+                predict_score_t = torch.log_softmax(predict_score_t,dim=-1).view(batch_size, beam_size, vocab_size)
+                scores = top_k_scores.unsqueeze(2) + predict_score_t # (batch_size, beam_size, vocab_size)
+                top_k_scores, top_words = scores.view(batch_size, -1).topk(beam_size, -1, True, True) # (batch_size, beam_size)
+                beam_idx = top_words // vocab_size  # (batch_size, beam_size)
+                next_word_idx = top_words % vocab_size  # (batch_size, beam_size)
+                seqs = seqs.gather(1, beam_idx.unsqueeze(2).expand(-1, -1, seqs.size(2)))
+                seqs = torch.cat([seqs, next_word_idx.unsqueeze(2)], dim=2)
+                # as in beam_search, only the best unfinished_num candidates of each image are kept
+                selected = beam_range.unsqueeze(0) < unfinished_num.unsqueeze(1)
+                complete = selected & (next_word_idx == word_map['<end>'])
+                if complete.any():
+                    for b, k in complete.nonzero().tolist():
+                        complete_seqs[b].append(seqs[b, k].tolist())
+                        complete_seqs_scores[b].append(top_k_scores[b, k].item())
+                    unfinished_num = unfinished_num - complete.sum(1)
+                if unfinished_num.sum() == 0:
+                    break
+                top_k_scores = top_k_scores.masked_fill(~(selected & ~complete), float('-inf'))
+                #  update state
+                state_idx = (beam_idx + beam_offset).view(-1)
+                state = tuple(s.index_select(0, state_idx) for s in state)
+                k_prev_words = next_word_idx.view(-1)
+            sentences = []
+            sen_idxs = []
+            for b in range(batch_size):
+                if len(complete_seqs[b]) > 0:
+                    i = complete_seqs_scores[b].index(max(complete_seqs_scores[b]))
+                    seq = complete_seqs[b][i]
+                else:
+                    seq = seqs[b, top_k_scores[b].argmax()][:20].tolist()
+                sen_idx = [w for w in seq if w not in {word_map['<start>'], word_map['<end>'], word_map['<unk>'],word_map['<pad>']}]
+                sentence = [' '.join([rev_word_map[sen_idx[i]] for i in range(len(sen_idx))])]
+                sentences.extend(self.remove_bad_endings(sentence))
+                sen_idxs.append(sen_idx)
+            return sentences, sen_idxs
+
+    def lstm_forward(self, cell, xt, ht_m1, ct_m1):
+        '''
+        The same computation as cell(xt, (ht_m1, ct_m1)), the candidate cell input and the gates are returned as well
+        :param cell: nn.LSTMCell
+        :return: ht, ct, gt (before tanh), it, ft each with shape bs, hidden_dim
+        '''
+        z = torch.matmul(xt, cell.weight_ih.transpose(0, 1))  # (bs, 4*hidden_size)
+        z = z + torch.matmul(ht_m1, cell.weight_hh.transpose(0, 1))  # (bs, 4*hidden_size)
+        z = z + cell.bias_ih + cell.bias_hh
+        z0, z1, z2, z3 = z.chunk(4, dim=1)
+        i = torch.sigmoid(z0)
+        f = torch.sigmoid(z1)
+        c = f * ct_m1 + i * torch.tanh(z2)
+        o = torch.sigmoid(z3)
+        h = o * torch.tanh(c)
+        return h, c, z2, i, f
+
+    def beam_search_with_states(self, imgs, word_map, beam_size=3, max_cap_length=20):
+        '''
+        beam_search that also records the decoder intermediates of the winning hypothesis, the explainers use them
+        instead of running the encoder and the decoder a second time. Only suits for batch_size 1
+        :param imgs: (1, C, H, W)
+        :param word_map:
+        :param beam_size:
+        :param max_cap_length:
+        :return: sentence, sen_idx and a dict of the image features and the per-step states. The per-step states have
+                 one row for every step of the hypothesis (including the <end> step), seq holds the predicted words
+        '''
+        self.eval()
+        assert imgs.size(0) == 1
+        batch_size = imgs.size(0)
+        rev_word_map = {v: k for k, v in word_map.items()}
+        vocab_size = len(word_map)
+        complete_seqs =[]
+        complete_seqs_scores=[]
+        complete_rows = []
+        steps = []  # the intermediates of every step, each with shape (unfinished_num, ...)
+        with torch.no_grad():
+            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) # (beam_size,)
+            top_k_scores = torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) # (beam_size, 1)
+            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device)  # (unfinished_num, )
+            rows = torch.zeros(beam_size, 0, device=self.device, dtype=torch.long)  # the back pointers into steps
+            image_features, avg_feature = self.img_encoder(imgs) #
+            image_feature_proj_before_act = self.img_projector(image_features)
+            image_feature_proj = self.relu(image_feature_proj_before_act) # batch_size, hidden_dim, H, W
+            image_feature_proj = image_feature_proj.view(batch_size, image_feature_proj.size(1), -1) # batch_size, hidden_dim, H*W
+            global_img_feature_before_act = self.global_img_feature_proj(avg_feature)
+            global_img_feature = self.relu(global_img_feature_before_act)
+            if global_img_feature.dim() == 1:
+                global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
+            states = {'image_features': image_features,
+                      'avg_feature': avg_feature,
+                      'image_feature_proj_before_act': image_feature_proj_before_act.contiguous().view(batch_size, self.hidden_dim, -1),
+                      'image_feature_proj': image_feature_proj,
+                      'global_img_feature_before_act': global_img_feature_before_act,
+                      'global_img_feature': global_img_feature}
+            memory = self.AdaAttention.prepare(image_feature_proj)
+            memory = tuple(m.expand(beam_size, *m.size()[1:]) for m in memory) # (V, img_proj) beam_size, H*W, hidden_dim / H*W
+            global_img_feature = global_img_feature.expand(beam_size, global_img_feature.size(-1)) #  beam_size, hidden_dim,
+            state = self.init_hidden_state(memory[0]) +  self.init_hidden_state(memory[0])  #(ht, ct)
+            unfinished_num = beam_size
+            for step in range(max_cap_length):
+                word_embedding = self.embedding(k_prev_words).squeeze(1) # unfinished_num, embedding_dim
+                x1t = torch.cat((state[2], global_img_feature, word_embedding), dim=-1) # (unfinished_num, 2*embed_dim + hidden_dim)
+                h1t, c1t, g1t, i1t_act, f1t_act = self.lstm_forward(self.AdaLSTM.lstm_cell, x1t, state[0], state[1])
+                sen_gate = torch.sigmoid(self.AdaLSTM.x_gate(x1t) + self.AdaLSTM.h_gate(state[0]))
+                st = sen_gate * torch.tanh(c1t)
+                context_t_hat, context_t, alpha_t, beta_t = self.AdaAttention(memory, h1t, st)  #(unfinished_num, hidden_dim) alpha: (unfinished_num, num_pixel), beta:(unfinished_num, 1)
+                x2t = torch.cat((context_t_hat, h1t), dim=-1) #(unfinished_num, 2*hiddendim)
+                h2t, c2t, g2t, i2t_act, f2t_act = self.lstm_forward(self.LanguageLSTM, x2t, state[2], state[3])
+                predict_score_t = self.fc(context_t_hat + h2t)  # (unfinished_num, vocab_size)
+                state = (h1t, c1t, h2t, c2t)
+                steps.append({'x1t': x1t, 'x2t': x2t, 'predictions': predict_score_t, 'alphas': alpha_t,
+                              'betas': beta_t.squeeze(1), 'h1t': h1t, 'c1t': c1t, 'g1t': g1t, 'i1t_act': i1t_act,
+                              'f1t_act': f1t_act, 'h2t': h2t, 'c2t': c2t, 'g2t': g2t, 'i2t_act': i2t_act,
+                              'f2t_act': f2t_act, 'st': st, 'context': context_t, 'context_hat': context_t_hat})
+                predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(unfinished_num, vocab_size)
+                top_k_scores_exp = top_k_scores.expand((unfinished_num, vocab_size))
+                scores = top_k_scores_exp + predict_score_t
+                if step == 0:
+                    top_k_scores, top_words = scores[0].topk(beam_size, -1, True, True)  # (unfinished_num, beam_size)
+                else:
+                    top_k_scores, top_words = scores.view(-1).topk(unfinished_num, -1, True, True) # (unfinished_num, beam_size)
+                beam_idx = top_words // vocab_size  # (unfinished_num, )
+                next_word_idx = top_words % vocab_size  # (unfinished_num, )
+                seqs = torch.cat([seqs[beam_idx], next_word_idx.unsqueeze(1)], dim=1)
+                rows = torch.cat([rows[beam_idx], beam_idx.unsqueeze(1)], dim=1)
+                incomplete_inds = [ind for ind, next_word in enumerate(next_word_idx) if next_word != word_map['<end>']]
+                complete_inds = list(set(range(len(next_word_idx))) - set(incomplete_inds))
+                # Set aside complete sequences
+                if len(complete_inds) > 0:
+                    complete_seqs.extend(seqs[complete_inds].tolist())
+                    complete_seqs_scores.extend(top_k_scores[complete_inds])
+                    complete_rows.extend(rows[complete_inds].tolist())
+                unfinished_num = unfinished_num - len(complete_inds)  # reduce beam length accordingly
+                if unfinished_num == 0:
+                    break
+                # updata sequences
+                seqs = seqs[incomplete_inds]
+                rows = rows[incomplete_inds]
+                #  update state
+                state = tuple(s[beam_idx[incomplete_inds]] for s in state)
+                memory = tuple(m[beam_idx[incomplete_inds]] for m in memory)
+                global_img_feature = global_img_feature[beam_idx[incomplete_inds]]
+                top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
+                k_prev_words = next_word_idx[incomplete_inds].unsqueeze(1)
+            if len(complete_seqs) > 0:
+                i = complete_seqs_scores.index(max(complete_seqs_scores))
+                seq = complete_seqs[i]
+                seq_rows = complete_rows[i]
+            else:
+                seq = seqs[0][:20].tolist()
+                seq_rows = rows[0][:19].tolist()
+            # follow the back pointers to collect the states of the winning hypothesis
+            for name in steps[0]:
+                states[name] = torch.stack([steps[s][name][r] for s, r in enumerate(seq_rows)])
+            states['seq'] = seq[1:]
+            sen_idx = [w for w in seq if w not in {word_map['<start>'], word_map['<end>'], word_map['<unk>'],word_map['<pad>']}]
+            sentence = [' '.join([rev_word_map[sen_idx[i]] for i in range(len(sen_idx))])]
+            sentence = self.remove_bad_endings(sentence)
+            return sentence, sen_idx, states
+
     def greedy_search(self,imgs,  word_map, max_cap_length=20):
         self.eval()
         batch_size = imgs.size(0)
         rev_word_map = {v: k for k, v in word_map.items()}
         complete_seq =[]
         with torch.no_grad():
-            k_prev_words = torch.zeros(batch_size, max_cap_length).long().cuda() # (batch_size, caption_length)
+            k_prev_words = torch.zeros(batch_size, max_cap_length, device=self.device, dtype=torch.long) # (batch_size, caption_length)
             k_prev_words[:, 0] = word_map['<start>'] # the first word is '<start>'
             seqs_temp = [[word_map['<start>']] for _ in range(batch_size)]
             image_features, avg_feature = self.img_encoder(imgs) #
             image_feature_proj = self.relu(self.img_projector(image_features)) # batch_size, hidden_dim, H, W
             image_feature_proj = image_feature_proj.view(batch_size, image_feature_proj.size(1), -1)
             global_img_feature = self.relu(self.global_img_feature_proj(avg_feature))  # batch_size, hidden_dim
+            memory = self.AdaAttention.prepare(image_feature_proj)
             state = self.init_hidden_state(image_feature_proj) +  self.init_hidden_state(image_feature_proj)#(ht, ct)
             for step in range(max_cap_length-1):
                 word_embedding = self.embedding(k_prev_words[:, step]) # batch_size, embedding_dim
                 if global_img_feature.dim() == 1:
                     global_img_feature = global_img_feature.unsqueeze(0)
                 xt = torch.cat((state[2], global_img_feature, word_embedding), dim=-1) # (batch_size, 2*embed_dim + hidden_dim)
-                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
                 predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(batch_size, vocab_size)
                 top_scores, top_words = predict_score_t.topk(1, -1, True, True)
                 if step == 0:
@@ -531,47 +749,34 @@ class GridTDModel(nn.Module):
         assert r_out.dim() == 1
         assert forward_input.dim() == 1
         assert weight.dim() == 2
-        attribution = weight * forward_input #(out_feature, in_feature)
-        if type(forward_output) == bool:
-            forward_output = torch.matmul(forward_input, weight.transpose(0,1))
-            # print('matml', forward_output.size())
-        forward_output_eps = self.EPS * forward_output.sign() + forward_output  # Z.sign() returns -1 or 0 or 1
-
-        forward_output_eps.masked_fill_(forward_output_eps == 0, self.EPS)  #(out_feature,)
-        # print(forward_output_eps.size())
-        attribution_norm = attribution.transpose(0,1) / forward_output_eps #(in_feature, out_feature)
-        # print(attribution_norm.size())
-        relevance_input = torch.sum(attribution_norm * r_out, dim=-1) #(in_feature,)
-        assert relevance_input.size() == forward_input.size()
-        torch.cuda.empty_cache()
-        return relevance_input
+        return lrp_rules.lrp_linear_eps(r_out, forward_input, forward_output, weight, self.EPS)
 
     def get_lrp_weight_step(self, predictions_t, rev_word_map, h2t_, context_hat):
         batch_size, vocab_size = predictions_t.size()
         with torch.no_grad():
-            weight_of_context_hat = torch.zeros(batch_size, self.hidden_dim).cuda()
-            weight_of_h2t = torch.zeros(batch_size, self.hidden_dim).cuda()
+            weight_of_context_hat = torch.zeros(batch_size, self.hidden_dim, device=self.device, dtype=self.dtype)
+            weight_of_h2t = torch.zeros(batch_size, self.hidden_dim, device=self.device, dtype=self.dtype)
             for b in range(batch_size):
                 predicted_labels = torch.argmax(predictions_t[b], dim=-1)  # (the predicted label of image b)  (max_length)
                 word_t = predicted_labels.item()
                 if rev_word_map[word_t] in STOP_WORDS + ['<start>','<end>','<pad>','<unk>']:
                     continue
                 else:
-                    word_relevance = torch.zeros(self.vocab_size).cuda()
+                    word_relevance = torch.zeros(self.vocab_size, device=self.device, dtype=self.dtype)
                     word_relevance[word_t] = predictions_t[b][word_t]
                     r_h2t_context_hat = self.lrp_linear_eps(r_out=word_relevance,
                                                             forward_input=h2t_[b] + context_hat[b],
                                                             forward_output=predictions_t[b],
                                                             weight=self.fc.weight)
-                    r_h2t = self.lrp_linear_eps(r_out=r_h2t_context_hat,
-                                                      forward_input=h2t_[b],
-                                                      forward_output=h2t_[b] + context_hat[b],
-                                                      weight=torch.eye(self.hidden_dim).cuda())
+                    r_h2t = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_hat,
+                                                          forward_input=h2t_[b],
+                                                          forward_output=h2t_[b] + context_hat[b],
+                                                          eps=self.EPS)
                     weight_of_h2t[b] = r_h2t
-                    r_context_hat = self.lrp_linear_eps(r_out=r_h2t_context_hat,
-                                                        forward_input=context_hat[b],
-                                                        forward_output=h2t_[b] + context_hat[b],
-                                                        weight=torch.eye(self.hidden_dim).cuda())
+                    r_context_hat = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_hat,
+                                                                  forward_input=context_hat[b],
+                                                                  forward_output=h2t_[b] + context_hat[b],
+                                                                  eps=self.EPS)
                     weight_of_context_hat[b] = r_context_hat
             weight_of_context_hat = LRPutil.normalize_relevance(weight_of_context_hat,dim=-1)
             weight_of_h2t = LRPutil.normalize_relevance(weight_of_h2t, dim=-1)
@@ -604,8 +809,9 @@ class GridTDModel(nn.Module):
         global_img_feature_before_act = self.global_img_feature_proj(avg_feature)  # (bs, hidden_dim)
         global_img_feature = self.relu(global_img_feature_before_act)
         max_length = max(caption_lengths) - 1
-        predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
-        weighted_predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
+        predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        weighted_predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        memory = self.AdaAttention.prepare(image_feature_proj)
         for t in range(max_length):
             word_embedding = self.embedding(encoded_captions[:, t])
             if global_img_feature.dim() == 1:
@@ -616,7 +822,7 @@ class GridTDModel(nn.Module):
                                                           self.AdaLSTM.lstm_cell.bias_ih, self.AdaLSTM.lstm_cell.bias_hh)
             sen_gate = torch.sigmoid(self.AdaLSTM.x_gate(x1t_) + self.AdaLSTM.h_gate(h1_))
             st_ = sen_gate * torch.tanh(c1_)
-            context_t_hat_, context_t_, alpha_t_, beta_t_ = self.AdaAttention(image_feature_proj, h1_, st_)  # (1, hidden_dim), (1, num_pixel), (1,1)
+            context_t_hat_, context_t_, alpha_t_, beta_t_ = self.AdaAttention(memory, h1_, st_)  # (1, hidden_dim), (1, num_pixel), (1,1)
             x2t_ = torch.cat((context_t_hat_, h1_), dim=-1)
             h2_, c2_, g2_, i2_act_, f2_act_ = lstm_forward(x2t_, state[2], state[3], self.LanguageLSTM.weight_ih,
                                                           self.LanguageLSTM.weight_hh,
@@ -660,12 +866,13 @@ class GridTDModel(nn.Module):
         image_feature_proj = image_feature_proj.contiguous()
         image_feature_proj = image_feature_proj.view(batch_size, self.hidden_dim, -1)  # (bs, hidden_dim, num_pixel)
         state = self.init_hidden_state(image_feature_proj) + self.init_hidden_state(image_feature_proj)
-        seq = torch.zeros(batch_size,max_length).long().cuda()
-        seq_logprobs = torch.zeros(batch_size, max_length).cuda()
+        seq = torch.zeros(batch_size,max_length, device=self.device, dtype=torch.long)
+        seq_logprobs = torch.zeros(batch_size, max_length, device=self.device, dtype=self.dtype)
 
+        memory = self.AdaAttention.prepare(image_feature_proj)
         for t in range(max_length):
             if t == 0:
-                it = torch.ones(batch_size).long().cuda() * word_map['<start>']
+                it = torch.ones(batch_size, device=self.device, dtype=torch.long) * word_map['<start>']
             word_embedding = self.embedding(it)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
@@ -675,7 +882,7 @@ class GridTDModel(nn.Module):
                                                           self.AdaLSTM.lstm_cell.bias_ih, self.AdaLSTM.lstm_cell.bias_hh)
             sen_gate = torch.sigmoid(self.AdaLSTM.x_gate(x1t_) + self.AdaLSTM.h_gate(h1_))
             st_ = sen_gate * torch.tanh(c1_)
-            context_t_hat_, context_t_, alpha_t_, beta_t_ = self.AdaAttention(image_feature_proj, h1_, st_)  # (1, hidden_dim), (1, num_pixel), (1,1)
+            context_t_hat_, context_t_, alpha_t_, beta_t_ = self.AdaAttention(memory, h1_, st_)  # (1, hidden_dim), (1, num_pixel), (1,1)
             x2t_ = torch.cat((context_t_hat_, h1_), dim=-1)
             h2_, c2_, g2_, i2_act_, f2_act_ = lstm_forward(x2t_, state[2], state[3], self.LanguageLSTM.weight_ih,
                                                           self.LanguageLSTM.weight_hh,
@@ -714,10 +921,12 @@ class ExplainGridTDAttention(object):
             self.model = model
         else:
             self.model = GridTDModel(args.embed_dim, args.hidden_dim, len(word_map), args.encoder)
-            checkpoint = torch.load(args.weight)
+            checkpoint = torch.load(args.weight, map_location=args.device)
             self.model.load_state_dict(checkpoint['state_dict'])
-            self.model.cuda()
+            self.model.to(args.device)
         self.model.eval()
+        self.device = self.model.device
+        self.dtype = self.model.dtype
 
         self.mean = [0.485, 0.456, 0.406]
         self.std = [0.229, 0.224, 0.225]
@@ -741,6 +950,20 @@ class ExplainGridTDAttention(object):
         if not os.path.isdir(self.visualizatioin_save_path):
             os.makedirs(self.visualizatioin_save_path)
 
+        # a DecodeCache shared with the other explainers of the model, None decodes every image here
+        self.decode_cache = None
+        # everything set so far lives as long as the explainer, the rest is per-image state dropped by reset
+        self.session_attributes = set(self.__dict__) | {'session_attributes'}
+
+    def reset(self):
+        '''
+        drops the per-image state (the image, the caption, the hidden states and the relevance), the model is kept so
+        that the explainer can be reused for the next image
+        '''
+        for name in set(self.__dict__) - self.session_attributes:
+            delattr(self, name)
+        self.model.zero_grad()
+
     def lrp_linear_eps(self, r_out, forward_input, forward_output, weight):
         '''
 
@@ -750,24 +973,12 @@ class ExplainGridTDAttention(object):
         :param weight:  weight tensor shape (out_feature, in_feature)
         :return: r_in (in_feature,)
         '''
-        attribution = weight * forward_input #(out_feature, in_feature)
-        # print(attribution.size())
-        if type(forward_output) == bool:
-            forward_output = torch.matmul(forward_input, weight.transpose(0,1))
-        forward_output_eps = self.EPS * forward_output.sign() + forward_output  # Z.sign() returns -1 or 0 or 1
-
-        forward_output_eps.masked_fill_(forward_output_eps == 0, self.EPS)  #(out_feature,)
-        # print(forward_output_eps.size())
-        attribution_norm = attribution.transpose(0,1) / forward_output_eps #(in_feature, out_feature)
-        # print(attribution_norm.size())
-        relevance_input = torch.sum(attribution_norm * r_out, dim=1) #(in_feature,)
-        torch.cuda.empty_cache()
-        return relevance_input
+        return lrp_rules.lrp_linear_eps(r_out, forward_input, forward_output, weight, self.EPS)
 
     def preprocess_img(self, img_filepath):
         image_data = Image.open(img_filepath).convert('RGB')
         img = self.img_transform(image_data)
-        img = img.unsqueeze(0).cuda()
+        img = img.unsqueeze(0).to(self.device, self.dtype)
         return img
 
     def adalstm_forward(self, xt, ht_m1, ct_m1):
@@ -786,7 +997,7 @@ class ExplainGridTDAttention(object):
     def language_lstm_forward(self, xt, ht_m1, ct_m1):
         z = torch.matmul(self.language_weight_i, xt.squeeze())  #(4*hidden_size, 1)
         z = z + torch.matmul(self.language_weight_h, ht_m1) #(4*hidden_size,1)
-        z = z + self.language_bias_i + self.language_bias_i
+        z = z + self.language_bias_h + self.language_bias_i
         z0, z1, z2, z3 = z.chunk(4)
         i = torch.sigmoid(z0)
         f = torch.sigmoid(z1)
@@ -810,27 +1021,28 @@ class ExplainGridTDAttention(object):
         self.image_feature_proj = self.image_feature_proj.contiguous()
         self.image_feature_proj = self.image_feature_proj.view(1, self.model.hidden_dim, -1)  # (bs, hidden_dim, num_pixel)
         self.caption_length = len(self.beam_caption_encode) - 1
-        self.predictions = torch.zeros(self.caption_length, self.vocab_size).cuda()
-        self.x1t = torch.zeros(self.caption_length, 2 * self.model.embed_dim + self.model.hidden_dim).cuda()
-        self.x2t = torch.zeros(self.caption_length, 2 * self.model.hidden_dim).cuda()
-        self.betas = torch.zeros(self.caption_length).cuda()
-        self.alphas = torch.zeros(self.caption_length, self.num_pixels).cuda()
-        self.h1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.c1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.h2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.c2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.g1t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.i1t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.f1t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.g2t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.i2t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.f2t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.st = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
+        self.predictions = torch.zeros(self.caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        self.x1t = torch.zeros(self.caption_length, 2 * self.model.embed_dim + self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.x2t = torch.zeros(self.caption_length, 2 * self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.betas = torch.zeros(self.caption_length, device=self.device, dtype=self.dtype)
+        self.alphas = torch.zeros(self.caption_length, self.num_pixels, device=self.device, dtype=self.dtype)
+        self.h1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.c1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.h2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.c2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.g1t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.i1t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.f1t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.g2t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.i2t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.f2t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.st = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         caption = [self.word_map['<start>']]
+        memory = self.model.AdaAttention.prepare(self.image_feature_proj)
         for t in range(50):
-            it = torch.LongTensor([caption[t]]).cuda()
+            it = torch.LongTensor([caption[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if self.global_img_feature.dim() == 1:
                 self.global_img_feature = self.global_img_feature.unsqueeze(0)
@@ -842,7 +1054,7 @@ class ExplainGridTDAttention(object):
             h1_t, c1_t, g1_t, i1_t_act, f1_t_act = self.adalstm_forward(x1_t, h1t_m1, c1t_m1)
             sen_gate = torch.sigmoid(self.model.AdaLSTM.x_gate(x1_t) + self.model.AdaLSTM.h_gate(h1t_m1))
             s_t = sen_gate * torch.tanh(c1_t)
-            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(self.image_feature_proj, h1_t.unsqueeze(0), s_t) #(1, hidden_dim), (1, num_pixel), (1,1)
+            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(memory, h1_t.unsqueeze(0), s_t) #(1, hidden_dim), (1, num_pixel), (1,1)
             x2_t = torch.cat((context_t_hat, h1_t.unsqueeze(0)), dim=-1)
             h2_t, c2_t, g2_t, i2_t_act, f2_t_act = self.language_lstm_forward(x2_t, h2t_m1, c2t_m1)
             predict_score_t = self.model.fc(context_t_hat + h2_t) #(1, vocab_size)
@@ -898,13 +1110,14 @@ class ExplainGridTDAttention(object):
         image_feature_proj = image_feature_proj.contiguous()
         image_feature_proj = image_feature_proj.view(1, self.model.hidden_dim,-1)  # (bs, hidden_dim, num_pixel)
         caption_length = len(beam_caption_encode)
-        predictions = torch.zeros(caption_length, self.vocab_size).cuda()
-        h1t = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
-        c1t = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
-        h2t = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
-        c2t = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
+        predictions = torch.zeros(caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        h1t = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        c1t = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        h2t = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        c2t = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        memory = self.model.AdaAttention.prepare(image_feature_proj)
         for t in range(caption_length):
-            it = torch.LongTensor([beam_caption_encode[t]]).cuda()
+            it = torch.LongTensor([beam_caption_encode[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
@@ -916,7 +1129,7 @@ class ExplainGridTDAttention(object):
             h1_t, c1_t, g1_t, i1_t_act, f1_t_act = self.adalstm_forward(x1_t, h1t_m1, c1t_m1)
             sen_gate = torch.sigmoid(self.model.AdaLSTM.x_gate(x1_t) + self.model.AdaLSTM.h_gate(h1t_m1))
             s_t = sen_gate * torch.tanh(c1_t)
-            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(image_feature_proj,
+            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(memory,
                                                                                 h1_t.unsqueeze(0),
                                                                                 s_t)  # (1, hidden_dim), (1, num_pixel), (1,1)
             x2_t = torch.cat((context_t_hat, h1_t.unsqueeze(0)), dim=-1)
@@ -930,13 +1143,44 @@ class ExplainGridTDAttention(object):
             c2t[t + 1] = c2_t
         return predictions
 
+    def decode(self, img_filepath, beam_size, max_cap_length):
+        '''
+        preprocesses the image and runs beam_search_with_states. With a decode_cache the image is decoded only once for
+        all the explainers sharing it, and they all explain the same caption
+        :return: img, beam_caption, beam_caption_encode, states
+        '''
+        if self.decode_cache is not None:
+            return self.decode_cache.decode(self, img_filepath)
+        img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
+        beam_caption, beam_caption_encode, states = self.model.beam_search_with_states(img, self.word_map,
+                                                                                       beam_size=beam_size,
+                                                                                       max_cap_length=max_cap_length)
+        return img, beam_caption, beam_caption_encode, states
+
     def get_hidden_parameters(self, img_filepath ):
-        self.img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
-        self.beam_caption, self.beam_caption_encode = self.model.beam_search(self.img, self.word_map, beam_size=2,
-                                                                             max_cap_length=50)
+        self.img, self.beam_caption, self.beam_caption_encode, states = self.decode(img_filepath, beam_size=2,
+                                                                                    max_cap_length=50)
         self.beam_caption_encode = [self.word_map['<start>']] + self.beam_caption_encode
         print(f'the predicted caption of {img_filepath} is "{self.beam_caption[0]}"')
         print(self.beam_caption_encode)
+        self.caption_length = len(self.beam_caption_encode) - 1
+        if states['seq'][:self.caption_length] != self.beam_caption_encode[1:]:
+            # a word such as <unk> was dropped from the caption, the recorded states do not match it
+            self.replay_hidden_parameters()
+            return
+        # the intermediate variables recorded by the beam search
+        for name in ['image_features', 'avg_feature', 'image_feature_proj_before_act', 'image_feature_proj',
+                     'global_img_feature_before_act', 'global_img_feature']:
+            setattr(self, name, states[name])
+        self.num_pixels = self.image_features.size(-1) * self.image_features.size(-2)
+        for name in ['x1t', 'x2t', 'predictions', 'alphas', 'betas', 'g1t', 'i1t_act', 'f1t_act', 'g2t', 'i2t_act',
+                     'f2t_act', 'st', 'context', 'context_hat']:
+            setattr(self, name, states[name][:self.caption_length])
+        init_state = torch.zeros(1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        for name in ['h1t', 'c1t', 'h2t', 'c2t']:
+            setattr(self, name, torch.cat((init_state, states[name][:self.caption_length]), dim=0))  # (caption_length+1, hidden_dim)
+
+    def replay_hidden_parameters(self):
         # perform the forward pass and save the intermediate variables
         self.image_features, self.avg_feature = self.model.img_encoder(self.img)  # (bs, fea_dim, H, W), (bs, fea_dim)
         self.num_pixels = self.image_features.size(-1) * self.image_features.size(-2)
@@ -950,26 +1194,27 @@ class ExplainGridTDAttention(object):
         self.image_feature_proj_before_act = self.image_feature_proj_before_act.contiguous().view(1, self.model.hidden_dim, -1)
 
         self.caption_length = len(self.beam_caption_encode) - 1
-        self.predictions = torch.zeros(self.caption_length, self.vocab_size).cuda()
-        self.x1t = torch.zeros(self.caption_length, 2 * self.model.embed_dim + self.model.hidden_dim).cuda()
-        self.x2t = torch.zeros(self.caption_length, 2 * self.model.hidden_dim).cuda()
-        self.betas = torch.zeros(self.caption_length).cuda()
-        self.alphas = torch.zeros(self.caption_length, self.num_pixels).cuda()
-        self.h1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.c1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.h2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.c2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.g1t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.i1t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.f1t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.g2t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.i2t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.f2t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.st = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
+        self.predictions = torch.zeros(self.caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        self.x1t = torch.zeros(self.caption_length, 2 * self.model.embed_dim + self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.x2t = torch.zeros(self.caption_length, 2 * self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.betas = torch.zeros(self.caption_length, device=self.device, dtype=self.dtype)
+        self.alphas = torch.zeros(self.caption_length, self.num_pixels, device=self.device, dtype=self.dtype)
+        self.h1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.c1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.h2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.c2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.g1t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.i1t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.f1t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.g2t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.i2t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.f2t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.st = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        memory = self.model.AdaAttention.prepare(self.image_feature_proj)
         for t in range(self.caption_length):
-            it = torch.LongTensor([self.beam_caption_encode[t]]).cuda()
+            it = torch.LongTensor([self.beam_caption_encode[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if self.global_img_feature.dim() == 1:
                 self.global_img_feature = self.global_img_feature.unsqueeze(0)
@@ -981,7 +1226,7 @@ class ExplainGridTDAttention(object):
             h1_t, c1_t, g1_t, i1_t_act, f1_t_act = self.adalstm_forward(x1_t, h1t_m1, c1t_m1)
             sen_gate = torch.sigmoid(self.model.AdaLSTM.x_gate(x1_t) + self.model.AdaLSTM.h_gate(h1t_m1))
             s_t = sen_gate * torch.tanh(c1_t)
-            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(self.image_feature_proj,
+            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(memory,
                                                                                 h1_t.unsqueeze(0),
                                                                                 s_t)  # (1, hidden_dim), (1, num_pixel), (1,1)
             x2_t = torch.cat((context_t_hat, h1_t.unsqueeze(0)), dim=-1)
@@ -1030,43 +1275,41 @@ class ExplainGridTDAttention(object):
         image_feature = image_feature.transpose(1,2).squeeze(0) #(num_pixel, encode_raw_dim)
         image_feature_proj = self.image_feature_proj.transpose(1,2).squeeze(0) #(num_pixel, hidden_dim)
         image_feature_proj_before_act = self.image_feature_proj_before_act.transpose(1,2).squeeze(0)
-        word_relevance = torch.zeros(1, self.vocab_size).cuda()
-        word_relevance[0, target_word_encode] = predict_score_t[target_word_encode]
-        self.r_h1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        self.r_c1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        self.r_h2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        self.r_c2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        self.r_xh1t = torch.zeros(preceeding_cap_length, 2 * self.model.hidden_dim + 2 * self.model.embed_dim).cuda()
-        self.r_xh2t = torch.zeros(preceeding_cap_length, 3 * self.model.hidden_dim).cuda()
-        self.r_global_img_feature = torch.zeros(self.model.embed_dim).cuda()
-        self.r_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim).cuda()
-        self.r_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim).cuda()
-        self.r_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim).cuda()
-        self.r_context = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        self.r_context_hat = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
+        word_relevance = torch.zeros(self.vocab_size, device=self.device, dtype=self.dtype)
+        word_relevance[target_word_encode] = predict_score_t[target_word_encode]
+        self.r_h1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_c1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_h2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_c2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_xh1t = torch.zeros(preceeding_cap_length, 2 * self.model.hidden_dim + 2 * self.model.embed_dim, device=self.device, dtype=self.dtype)
+        self.r_xh2t = torch.zeros(preceeding_cap_length, 3 * self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_global_img_feature = torch.zeros(self.model.embed_dim, device=self.device, dtype=self.dtype)
+        self.r_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim, device=self.device, dtype=self.dtype)
+        self.r_context = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_context_hat = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         r_h2t_context = self.lrp_linear_eps(r_out=word_relevance,
                                            forward_input=self.h2t[t+1]+self.context_hat[t],
                                            forward_output=predict_score_t,
                                            weight=self.output_weight)
-        self.r_h2t[t+1] = self.lrp_linear_eps(r_out=r_h2t_context,
-                                             forward_input=self.h2t[t+1],
-                                             forward_output=self.h2t[t+1]+self.context_hat[t],
-                                             weight=torch.eye(self.model.hidden_dim).cuda())
-
-        self.r_context_hat[t] = self.lrp_linear_eps(r_out=r_h2t_context,
-                                                    forward_input=self.context_hat[t],
-                                                    forward_output=self.h2t[t+1]+self.context_hat[t],
-                                                    weight=torch.eye(self.model.hidden_dim).cuda())
+        self.r_h2t[t+1] = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context,
+                                                        forward_input=self.h2t[t+1],
+                                                        forward_output=self.h2t[t+1]+self.context_hat[t],
+                                                        eps=self.EPS)
+
+        self.r_context_hat[t] = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context,
+                                                              forward_input=self.context_hat[t],
+                                                              forward_output=self.h2t[t+1]+self.context_hat[t],
+                                                              eps=self.EPS)
         for i in range(t+1)[::-1]:
             self.r_c2t[i+1] = self.r_c2t[i+1] + self.r_h2t[i+1]
-            r_g2t = self.lrp_linear_eps(r_out=self.r_c2t[i + 1],
-                                       forward_input=self.i2t_act[i] * torch.tanh(self.g2t[i]),
-                                       forward_output=self.c2t[i+1],
-                                       weight=torch.eye(self.model.hidden_dim).cuda())
-            self.r_c2t[i] = self.lrp_linear_eps(r_out=self.r_c2t[i + 1],
-                                                forward_input=self.f2t_act[i] * self.c2t[i],
-                                                forward_output=self.c2t[i+1],
-                                                weight=torch.eye(self.model.hidden_dim).cuda())
+            r_g2t = lrp_rules.lrp_elementwise_eps(r_out=self.r_c2t[i + 1],
+                                                  forward_input=self.i2t_act[i] * torch.tanh(self.g2t[i]),
+                                                  forward_output=self.c2t[i+1],
+                                                  eps=self.EPS)
+            self.r_c2t[i] = lrp_rules.lrp_elementwise_eps(r_out=self.r_c2t[i + 1],
+                                                          forward_input=self.f2t_act[i] * self.c2t[i],
+                                                          forward_output=self.c2t[i+1],
+                                                          eps=self.EPS)
             self.r_xh2t[i] = self.lrp_linear_eps(r_out=r_g2t,
                                                 forward_input=xh2t[i],
                                                 forward_output=self.g2t[i],
@@ -1074,35 +1317,30 @@ class ExplainGridTDAttention(object):
             self.r_h2t[i] = self.r_xh2t[i][self.model.hidden_dim*2:]
             self.r_h1t[i+1] = self.r_xh2t[i][self.model.hidden_dim:2*self.model.hidden_dim]
             self.r_context_hat[i] += self.r_xh2t[i][:self.model.hidden_dim]
-            r_st = self.lrp_linear_eps(r_out=self.r_context_hat[i],
-                                       forward_input=self.betas[i] * self.st[i],
-                                       forward_output=self.context_hat[i],
-                                       weight=torch.eye(self.model.hidden_dim).cuda())
-            self.r_context[i] = self.lrp_linear_eps(r_out=self.r_context_hat[i],
-                                                    forward_input=self.context[i]*(1-self.betas[i]),
-                                                    forward_output=self.context_hat[i],
-                                                    weight=torch.eye(self.model.hidden_dim).cuda())
+            r_st = lrp_rules.lrp_elementwise_eps(r_out=self.r_context_hat[i],
+                                                 forward_input=self.betas[i] * self.st[i],
+                                                 forward_output=self.context_hat[i],
+                                                 eps=self.EPS)
+            self.r_context[i] = lrp_rules.lrp_elementwise_eps(r_out=self.r_context_hat[i],
+                                                              forward_input=self.context[i]*(1-self.betas[i]),
+                                                              forward_output=self.context_hat[i],
+                                                              eps=self.EPS)
             # if i == t:
             #     for k in range(self.num_pixels):
             #         self.r_img_feature_proj[k] += self.lrp_linear_eps(r_out=self.r_context[i],
             #                                                           forward_input=image_feature_proj[k]*self.alphas[i][k],
             #                                                           forward_output=self.context[i],
             #                                                           weight=torch.eye(self.model.hidden_dim).cuda())
-            for k in range(self.num_pixels):
-                self.r_img_feature_proj[k] += self.lrp_linear_eps(r_out=self.r_context[i],
-                                                                  forward_input=image_feature_proj[k] * self.alphas[i][k],
-                                                                  forward_output=self.context[i],
-                                                                  weight=torch.eye(self.model.hidden_dim).cuda())
             self.r_c1t[i+1] += r_st
             self.r_c1t[i+1] += self.r_h1t[i+1]
-            r_g1t = self.lrp_linear_eps(r_out=self.r_c1t[i+1],
-                                        forward_input=self.i1t_act[i] * torch.tanh(self.g1t[i]),
-                                        forward_output=self.c1t[i+1],
-                                        weight=torch.eye(self.model.hidden_dim).cuda())
-            self.r_c1t[i] = self.lrp_linear_eps(r_out=self.r_c1t[i+1],
-                                                forward_input=self.f1t_act[i] * self.c1t[i],
-                                                forward_output=self.c1t[i+1],
-                                                weight=torch.eye(self.model.hidden_dim).cuda())
+            r_g1t = lrp_rules.lrp_elementwise_eps(r_out=self.r_c1t[i+1],
+                                                  forward_input=self.i1t_act[i] * torch.tanh(self.g1t[i]),
+                                                  forward_output=self.c1t[i+1],
+                                                  eps=self.EPS)
+            self.r_c1t[i] = lrp_rules.lrp_elementwise_eps(r_out=self.r_c1t[i+1],
+                                                          forward_input=self.f1t_act[i] * self.c1t[i],
+                                                          forward_output=self.c1t[i+1],
+                                                          eps=self.EPS)
             self.r_xh1t[i] = self.lrp_linear_eps(r_out=r_g1t,
                                                  forward_input=xh1t[i],
                                                  forward_output=self.g1t[i],
@@ -1117,15 +1355,20 @@ class ExplainGridTDAttention(object):
                                                     forward_input=self.avg_feature,
                                                     forward_output=self.global_img_feature_before_act,
                                                     weight=self.model.global_img_feature_proj.weight)
-        for i in range(self.num_pixels):
-            self.r_img_feature[i] = self.lrp_linear_eps(r_out=r_average_img_feature,
-                                                        forward_input=image_feature[i]/self.num_pixels,
-                                                        forward_output=self.avg_feature,
-                                                        weight=torch.eye(self.model.encoder_raw_dim).cuda())
-            self.r_img_feature[i] = self.r_img_feature[i] + self.lrp_linear_eps(r_out=self.r_img_feature_proj[i],
-                                                                                forward_input=image_feature[i],
-                                                                                forward_output=image_feature_proj_before_act[i],
-                                                                                weight=self.model.img_projector.weight.squeeze(-1).squeeze(-1))
+        # context_i = sum_k alpha_ik * v_k, the relevance of pixel k summed over the steps is
+        # v_k * sum_i alpha_ik * r_context_i / context_i, which is a single matmul over all pixels and steps
+        r_context_ratio = self.r_context / lrp_rules.stabilize(self.context[:preceeding_cap_length], self.EPS) #(preceeding_length, hidden_dim)
+        self.r_img_feature_proj = image_feature_proj * torch.matmul(self.alphas[:preceeding_cap_length].transpose(0, 1),
+                                                                    r_context_ratio)  #(num_pixel, hidden_dim)
+        self.r_img_feature = lrp_rules.lrp_elementwise_eps(r_out=r_average_img_feature,
+                                                           forward_input=image_feature/self.num_pixels,
+                                                           forward_output=self.avg_feature,
+                                                           eps=self.EPS)  #(num_pixel, encode_raw_dim)
+        self.r_img_feature = self.r_img_feature + lrp_rules.lrp_linear_eps(r_out=self.r_img_feature_proj,
+                                                                           forward_input=image_feature,
+                                                                           forward_output=image_feature_proj_before_act,
+                                                                           weight=self.model.img_projector.weight.squeeze(-1).squeeze(-1),
+                                                                           eps=self.EPS)
         r_words = torch.sum(self.r_word_embedding, dim=-1)
         max_abs_r_words = torch.max(torch.abs(r_words))
         if max_abs_r_words > 0:
@@ -1134,22 +1377,144 @@ class ExplainGridTDAttention(object):
         torch.cuda.empty_cache()
         return r_img_feature, r_words
 
+    def explain_caption_allwords(self):
+        '''
+        explain every word of the caption in one backward sweep. The relevance of all the words is carried through the
+        recurrence along a target axis, the relevance of word t enters at step t, so the result of every word is the same
+        as explain_caption_wordt
+        :return: the relevance of the image feature (caption_length, fea_dim, H, W) and the list of the relevance of the
+                 preceeding words of every word
+        '''
+        T = self.caption_length
+        steps = torch.arange(T, device=self.device)
+        target_word_encode = torch.tensor(self.beam_caption_encode[1:], device=self.device)
+        weight_ig = self.adalstm_weight_i.chunk(4,0)[2]  #(hidden_dim, embed_dim*2 + hidden_dim)
+        weight_hg = self.adalstm_weight_h.chunk(4,0)[2]  #(hidden_dim, hidden_dim)
+        weight_g = torch.cat((weight_ig, weight_hg), dim=1) #(hidden_dim, 2 * hidden_dim+2*embed_dim)
+        language_weight_ig = self.language_weight_i.chunk(4,0)[2]  #(hidden_dim, 2*hidden_dim)
+        language_weight_hg = self.language_weight_h.chunk(4,0)[2]  #(hidden_dim, hidden_dim)
+        language_weight_g = torch.cat((language_weight_ig, language_weight_hg), dim=-1) #(hidden_dim, 3 * hidden_dim)
+        xh1t = torch.cat((self.x1t[:T], self.h1t[:T]), dim=1) #(caption_length, 2*hidden_dim+2*embed_dim)
+        xh2t = torch.cat((self.x2t[:T], self.h2t[:T]), dim=1) #(caption_length, 3*hidden_dim)
+        image_feature = self.image_features.view(1, self.model.encoder_raw_dim, self.num_pixels)
+        image_feature = image_feature.transpose(1,2).squeeze(0) #(num_pixel, encode_raw_dim)
+        image_feature_proj = self.image_feature_proj.transpose(1,2).squeeze(0) #(num_pixel, hidden_dim)
+        image_feature_proj_before_act = self.image_feature_proj_before_act.transpose(1,2).squeeze(0)
+        word_relevance = torch.zeros(T, self.vocab_size, device=self.device, dtype=self.dtype)
+        word_relevance[steps, target_word_encode] = self.predictions[steps, target_word_encode]
+
+        # the output layer of every word, row t is the word t
+        h2t_context_hat = self.h2t[1:T+1] + self.context_hat[:T] #(caption_length, hidden_dim)
+        r_h2t_context = self.lrp_linear_eps(r_out=word_relevance,
+                                            forward_input=h2t_context_hat,
+                                            forward_output=self.predictions[:T],
+                                            weight=self.output_weight)
+        r_h2t_out = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context,
+                                                  forward_input=self.h2t[1:T+1],
+                                                  forward_output=h2t_context_hat,
+                                                  eps=self.EPS)
+        r_context_hat_out = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context,
+                                                          forward_input=self.context_hat[:T],
+                                                          forward_output=h2t_context_hat,
+                                                          eps=self.EPS)
+
+        # the relevance buffers are (step, target word, feature)
+        self.r_h1t = torch.zeros(T+1, T, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_c1t = torch.zeros(T+1, T, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_h2t = torch.zeros(T+1, T, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_c2t = torch.zeros(T+1, T, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_xh1t = torch.zeros(T, T, 2 * self.model.hidden_dim + 2 * self.model.embed_dim, device=self.device, dtype=self.dtype)
+        self.r_xh2t = torch.zeros(T, T, 3 * self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_global_img_feature = torch.zeros(T, self.model.embed_dim, device=self.device, dtype=self.dtype)
+        self.r_word_embedding = torch.zeros(T, T, self.model.embed_dim, device=self.device, dtype=self.dtype)
+        self.r_context = torch.zeros(T, T, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.r_context_hat = torch.zeros(T, T, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        for i in range(T)[::-1]:
+            # the words after i have overwritten r_h2t[i+1] with their own relevance, word i starts here
+            self.r_h2t[i+1, i] += r_h2t_out[i]
+            self.r_context_hat[i, i] += r_context_hat_out[i]
+            self.r_c2t[i+1] = self.r_c2t[i+1] + self.r_h2t[i+1]
+            r_g2t = lrp_rules.lrp_elementwise_eps(r_out=self.r_c2t[i + 1],
+                                                  forward_input=self.i2t_act[i] * torch.tanh(self.g2t[i]),
+                                                  forward_output=self.c2t[i+1],
+                                                  eps=self.EPS)
+            self.r_c2t[i] = lrp_rules.lrp_elementwise_eps(r_out=self.r_c2t[i + 1],
+                                                          forward_input=self.f2t_act[i] * self.c2t[i],
+                                                          forward_output=self.c2t[i+1],
+                                                          eps=self.EPS)
+            self.r_xh2t[i] = self.lrp_linear_eps(r_out=r_g2t,
+                                                 forward_input=xh2t[i],
+                                                 forward_output=self.g2t[i],
+                                                 weight=language_weight_g)  #(caption_length, 3*hidden_dim)
+            self.r_h2t[i] = self.r_xh2t[i][:, self.model.hidden_dim*2:]
+            self.r_h1t[i+1] = self.r_xh2t[i][:, self.model.hidden_dim:2*self.model.hidden_dim]
+            self.r_context_hat[i] += self.r_xh2t[i][:, :self.model.hidden_dim]
+            r_st = lrp_rules.lrp_elementwise_eps(r_out=self.r_context_hat[i],
+                                                 forward_input=self.betas[i] * self.st[i],
+                                                 forward_output=self.context_hat[i],
+                                                 eps=self.EPS)
+            self.r_context[i] = lrp_rules.lrp_elementwise_eps(r_out=self.r_context_hat[i],
+                                                              forward_input=self.context[i]*(1-self.betas[i]),
+                                                              forward_output=self.context_hat[i],
+                                                              eps=self.EPS)
+            self.r_c1t[i+1] += r_st
+            self.r_c1t[i+1] += self.r_h1t[i+1]
+            r_g1t = lrp_rules.lrp_elementwise_eps(r_out=self.r_c1t[i+1],
+                                                  forward_input=self.i1t_act[i] * torch.tanh(self.g1t[i]),
+                                                  forward_output=self.c1t[i+1],
+                                                  eps=self.EPS)
+            self.r_c1t[i] = lrp_rules.lrp_elementwise_eps(r_out=self.r_c1t[i+1],
+                                                          forward_input=self.f1t_act[i] * self.c1t[i],
+                                                          forward_output=self.c1t[i+1],
+                                                          eps=self.EPS)
+            self.r_xh1t[i] = self.lrp_linear_eps(r_out=r_g1t,
+                                                 forward_input=xh1t[i],
+                                                 forward_output=self.g1t[i],
+                                                 weight=weight_g)  #(caption_length, 2*hidden_dim+2*embed_dim)
+            self.r_h1t[i] = self.r_xh1t[i][:, 2*self.model.embed_dim+self.model.hidden_dim:]
+            self.r_h2t[i] += self.r_xh1t[i][:, :self.model.hidden_dim]
+            self.r_global_img_feature = self.r_global_img_feature + self.r_xh1t[i][:, self.model.hidden_dim:self.model.embed_dim + self.model.hidden_dim]
+            self.r_word_embedding[i] = self.r_xh1t[i][:, self.model.hidden_dim+self.model.embed_dim:self.model.embed_dim*2+self.model.hidden_dim]
+        r_average_img_feature = self.lrp_linear_eps(r_out=self.r_global_img_feature,
+                                                    forward_input=self.avg_feature,
+                                                    forward_output=self.global_img_feature_before_act,
+                                                    weight=self.model.global_img_feature_proj.weight)  #(caption_length, encode_raw_dim)
+        # the pixel relevance of word t is v_k * sum_i alpha_ik * r_context_it / context_i, for all the words at once
+        r_context_ratio = self.r_context / lrp_rules.stabilize(self.context[:T], self.EPS).unsqueeze(1) #(step, target word, hidden_dim)
+        self.r_img_feature_proj = image_feature_proj * torch.einsum('ip,ith->tph', self.alphas[:T],
+                                                                    r_context_ratio)  #(caption_length, num_pixel, hidden_dim)
+        self.r_img_feature = lrp_rules.lrp_elementwise_eps(r_out=r_average_img_feature.view(T, 1, -1),
+                                                           forward_input=image_feature/self.num_pixels,
+                                                           forward_output=self.avg_feature,
+                                                           eps=self.EPS)  #(caption_length, num_pixel, encode_raw_dim)
+        self.r_img_feature = self.r_img_feature + lrp_rules.lrp_linear_eps(r_out=self.r_img_feature_proj,
+                                                                           forward_input=image_feature,
+                                                                           forward_output=image_feature_proj_before_act,
+                                                                           weight=self.model.img_projector.weight.squeeze(-1).squeeze(-1),
+                                                                           eps=self.EPS)
+        r_img_feature = self.r_img_feature.transpose(1,2).contiguous().view(T, *self.image_features.size()[1:])
+        r_words_all = torch.sum(self.r_word_embedding, dim=-1) #(step, target word)
+        relevance_preceeding_words = []
+        for t in range(T):
+            r_words = r_words_all[:t+1, t]
+            max_abs_r_words = torch.max(torch.abs(r_words))
+            if max_abs_r_words > 0:
+                r_words = r_words / max_abs_r_words
+            relevance_preceeding_words.append(r_words)
+        torch.cuda.empty_cache()
+        return r_img_feature, relevance_preceeding_words
+
     def explain_cnn(self, r_img_feature):
-        relevance_img = self.model.img_encoder.encoder.compute_lrp(self.img, target=r_img_feature)
+        # r_img_feature can stack the relevance of several words, they are explained in one batch
+        relevance_img = lrp_engine.compute_lrp(self.model.img_encoder.encoder, self.img, r_img_feature)
         return relevance_img
 
     def explain_caption(self, img_filepath, t_list=None):
         self.img_filepath = img_filepath
         self.get_hidden_parameters(img_filepath)
-        relevance_imgs = []
-        relevance_preceeding_words = []
-        lrp_wrapper.add_lrp(self.model.img_encoder.encoder)
-        for t in range(self.caption_length):
-            with torch.no_grad():
-                relevance_img_feature, r_words = self.explain_caption_wordt(t)
-            relevance_img = self.explain_cnn(relevance_img_feature)
-            relevance_imgs.append(relevance_img)
-            relevance_preceeding_words.append(r_words)
+        with torch.no_grad():
+            relevance_img_features, relevance_preceeding_words = self.explain_caption_allwords()
+        relevance_imgs = list(self.explain_cnn(relevance_img_features).split(1)) #caption_length * (1, 3, H, W)
         assert len(relevance_imgs) == self.caption_length
         self.visualize_explanations(relevance_imgs, t=t_list)
         self.save_linguistic_explanation(relevance_preceeding_words)
@@ -1213,16 +1578,21 @@ class ExplainGridTDAttention(object):
 
 class ExplainGridTDGradient(object):
     EX_TYPE = 'gradient'
-    def __init__(self, args, word_map):
+    def __init__(self, args, word_map, model=None):
         super(ExplainGridTDGradient, self).__init__()
         self.args = args
         self.word_map = word_map
         self.vocab_size = len(word_map)
-        self.model = GridTDModel(args.embed_dim, args.hidden_dim, len(word_map), args.encoder)
-        checkpoint = torch.load(args.weight)
-        self.model.load_state_dict(checkpoint['state_dict'])
-        self.model.cuda()
+        if model is not None:
+            self.model = model
+        else:
+            self.model = GridTDModel(args.embed_dim, args.hidden_dim, len(word_map), args.encoder)
+            checkpoint = torch.load(args.weight, map_location=args.device)
+            self.model.load_state_dict(checkpoint['state_dict'])
+            self.model.to(args.device)
         self.model.eval()
+        self.device = self.model.device
+        self.dtype = self.model.dtype
         self.mean = [0.485, 0.456, 0.406]
         self.std = [0.229, 0.224, 0.225]
         self.img_transform = transforms.Compose([transforms.Resize(size=(args.height, args.width)),
@@ -1245,6 +1615,20 @@ class ExplainGridTDGradient(object):
         if not os.path.isdir(self.visualizatioin_save_path):
             os.makedirs(self.visualizatioin_save_path)
 
+        # a DecodeCache shared with the other explainers of the model, None decodes every image here
+        self.decode_cache = None
+        # everything set so far lives as long as the explainer, the rest is per-image state dropped by reset
+        self.session_attributes = set(self.__dict__) | {'session_attributes'}
+
+    def reset(self):
+        '''
+        drops the per-image state (the image, the caption, the hidden states and the relevance), the model is kept so
+        that the explainer can be reused for the next image
+        '''
+        for name in set(self.__dict__) - self.session_attributes:
+            delattr(self, name)
+        self.model.zero_grad()
+
     def adalstm_forward(self, xt, ht_m1, ct_m1):
         z = torch.matmul(self.adalstm_weight_i, xt.squeeze(0))  #(4*hidden_size, )
         z = z + torch.matmul(self.adalstm_weight_h, ht_m1) #(4*hidden_size,)
@@ -1276,7 +1660,7 @@ class ExplainGridTDGradient(object):
     def preprocess_img(self, img_filepath):
         image_data = Image.open(img_filepath).convert('RGB')
         img = self.img_transform(image_data)
-        img = img.unsqueeze(0).cuda()
+        img = img.unsqueeze(0).to(self.device, self.dtype)
         return img
 
     def teacherforce_forward(self, img, beam_caption_encode):
@@ -1288,13 +1672,14 @@ class ExplainGridTDGradient(object):
         image_feature_proj = image_feature_proj.contiguous()
         image_feature_proj = image_feature_proj.view(1, self.model.hidden_dim,-1)  # (bs, hidden_dim, num_pixel)
         caption_length = len(beam_caption_encode)
-        predictions = torch.zeros(caption_length, self.vocab_size).cuda()
-        h1t = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
-        c1t = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
-        h2t = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
-        c2t = torch.zeros(caption_length + 1, self.model.hidden_dim).cuda()
+        predictions = torch.zeros(caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        h1t = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        c1t = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        h2t = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        c2t = torch.zeros(caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        memory = self.model.AdaAttention.prepare(image_feature_proj)
         for t in range(caption_length):
-            it = torch.LongTensor([beam_caption_encode[t]]).cuda()
+            it = torch.LongTensor([beam_caption_encode[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
@@ -1306,7 +1691,7 @@ class ExplainGridTDGradient(object):
             h1_t, c1_t, i1_t, f1_t, g1_t, o1_t, i1_t_act, f1_t_act, g1_t_act, o1_t_act = self.adalstm_forward(x1_t, h1t_m1, c1t_m1)
             sen_gate = torch.sigmoid(self.model.AdaLSTM.x_gate(x1_t) + self.model.AdaLSTM.h_gate(h1t_m1))
             s_t = sen_gate * torch.tanh(c1_t)
-            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(image_feature_proj,
+            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(memory,
                                                                                 h1_t.unsqueeze(0),
                                                                                 s_t)  # (1, hidden_dim), (1, num_pixel), (1,1)
             x2_t = torch.cat((context_t_hat, h1_t.unsqueeze(0)), dim=-1)
@@ -1320,15 +1705,29 @@ class ExplainGridTDGradient(object):
             c2t[t + 1] = c2_t
         return predictions
 
+    def decode(self, img_filepath, beam_size, max_cap_length):
+        '''
+        preprocesses the image, runs the beam search and the encoder. With a decode_cache the image is decoded only once
+        for all the explainers sharing it, and they all explain the same caption
+        :return: img, beam_caption, beam_caption_encode and a dict of the image_features and the avg_feature
+        '''
+        if self.decode_cache is not None:
+            return self.decode_cache.decode(self, img_filepath)
+        img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
+        beam_caption, beam_caption_encode = self.model.beam_search(img, self.word_map, beam_size=beam_size,
+                                                                   max_cap_length=max_cap_length)
+        image_features, avg_feature = self.model.img_encoder(img)  # (bs, fea_dim, H, W), (bs, fea_dim)
+        return img, beam_caption, beam_caption_encode, {'image_features': image_features, 'avg_feature': avg_feature}
+
     def get_hidden_parameters(self, img_filepath):
-        self.img = self.preprocess_img(img_filepath)  # (bs, C, H, W)
-        self.beam_caption, self.beam_caption_encode = self.model.beam_search(self.img, self.word_map, beam_size=3,
-                                                                             max_cap_length=50)
+        self.img, self.beam_caption, self.beam_caption_encode, states = self.decode(img_filepath, beam_size=3,
+                                                                                    max_cap_length=50)
         self.beam_caption_encode = [self.word_map['<start>']] + self.beam_caption_encode
         print(f'the predicted caption of {img_filepath} is "{self.beam_caption[0]}"')
         print(self.beam_caption_encode)
         # perform the forward pass and save the intermediate variables
-        self.image_features, self.avg_feature = self.model.img_encoder(self.img)  # (bs, fea_dim, H, W), (bs, fea_dim)
+        self.image_features = states['image_features']  # (bs, fea_dim, H, W)
+        self.avg_feature = states['avg_feature']  # (bs, fea_dim)
         self.num_pixels = self.image_features.size(-1) * self.image_features.size(-2)
         self.image_feature_proj = self.model.relu(
             self.model.img_projector(self.image_features))  # (bs, hiddendim, H, W)
@@ -1338,37 +1737,38 @@ class ExplainGridTDGradient(object):
         self.image_feature_proj = self.image_feature_proj.view(1, self.model.hidden_dim,
                                                                -1)  # (bs, hidden_dim, num_pixel)
         self.caption_length = len(self.beam_caption_encode) - 1
-        self.predictions = torch.zeros(self.caption_length, self.vocab_size).cuda()
-        self.x1t = torch.zeros(self.caption_length, 2 * self.model.embed_dim + self.model.hidden_dim).cuda()
-        self.x2t = torch.zeros(self.caption_length, 2 * self.model.hidden_dim).cuda()
-        self.betas = torch.zeros(self.caption_length).cuda()
-        self.alphas = torch.zeros(self.caption_length, self.num_pixels).cuda()
-        self.h1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.c1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.h2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.c2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim).cuda()
-        self.i1t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.f1t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.g1t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.o1t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.i1t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.f1t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.g1t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.o1t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.i2t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.f2t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.g2t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.o2t = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.i2t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.f2t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.g2t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.o2t_act = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.st = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.sen_gate = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
-        self.context = torch.zeros(self.caption_length, self.model.hidden_dim).cuda()
+        self.predictions = torch.zeros(self.caption_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        self.x1t = torch.zeros(self.caption_length, 2 * self.model.embed_dim + self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.x2t = torch.zeros(self.caption_length, 2 * self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.betas = torch.zeros(self.caption_length, device=self.device, dtype=self.dtype)
+        self.alphas = torch.zeros(self.caption_length, self.num_pixels, device=self.device, dtype=self.dtype)
+        self.h1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.c1t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.h2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.c2t = torch.zeros(self.caption_length + 1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.i1t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.f1t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.g1t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.o1t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.i1t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.f1t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.g1t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.o1t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.i2t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.f2t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.g2t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.o2t = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.i2t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.f2t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.g2t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.o2t_act = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.st = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.sen_gate = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context_hat = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        self.context = torch.zeros(self.caption_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        memory = self.model.AdaAttention.prepare(self.image_feature_proj)
         for t in range(self.caption_length):
-            it = torch.LongTensor([self.beam_caption_encode[t]]).cuda()
+            it = torch.LongTensor([self.beam_caption_encode[t]]).to(self.device)
             word_embedding = self.model.embedding(it)  # (1, embed_dim)
             if self.global_img_feature.dim() == 1:
                 self.global_img_feature = self.global_img_feature.unsqueeze(0)
@@ -1380,7 +1780,7 @@ class ExplainGridTDGradient(object):
             h1_t, c1_t, i1_t, f1_t, g1_t, o1_t, i1_t_act, f1_t_act, g1_t_act, o1_t_act = self.adalstm_forward(x1_t, h1t_m1, c1t_m1)
             sen_gate_t = torch.sigmoid(self.model.AdaLSTM.x_gate(x1_t) + self.model.AdaLSTM.h_gate(h1t_m1))
             s_t = sen_gate_t * torch.tanh(c1_t)
-            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(self.image_feature_proj,
+            context_t_hat, context_t, alpha_t, beta_t = self.model.AdaAttention(memory,
                                                                                 h1_t.unsqueeze(0),
                                                                                 s_t)  # (1, hidden_dim), (1, num_pixel), (1,1)
             x2_t = torch.cat((context_t_hat, h1_t.unsqueeze(0)), dim=-1)
@@ -1425,36 +1825,36 @@ class ExplainGridTDGradient(object):
         assert t < self.caption_length  #(t starts from 0)
         preceeding_cap_length = t+1
         target_word_encode = self.beam_caption_encode[t+1]
-        d_word_pred = torch.zeros(1, self.vocab_size).cuda()
+        d_word_pred = torch.zeros(1, self.vocab_size, device=self.device, dtype=self.dtype)
         d_word_pred[0, target_word_encode] = 1.  #(1, vocab_size)
-        d_h1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_c1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_i1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_f1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_g1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_o1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_i1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_f1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_g1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_o1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_h2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_c2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_i2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_f2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_g2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_o2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_i2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_f2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_g2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_o2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_x1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim + 2*self.model.embed_dim).cuda()
-        d_x2t = torch.zeros(preceeding_cap_length, 2*self.model.hidden_dim ).cuda()
-        d_context_hat = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_st = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_global_img_feature = torch.zeros(self.model.embed_dim).cuda()
-        d_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim).cuda()
-        d_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim).cuda()
-        d_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim).cuda()
+        d_h1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_c1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_i1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_f1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_g1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_o1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_i1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_f1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_g1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_o1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_h2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_c2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_i2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_f2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_g2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_o2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_i2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_f2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_g2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_o2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_x1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim + 2*self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_x2t = torch.zeros(preceeding_cap_length, 2*self.model.hidden_dim , device=self.device, dtype=self.dtype)
+        d_context_hat = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_st = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_global_img_feature = torch.zeros(self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim, device=self.device, dtype=self.dtype)
+        d_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         #backward starts
         d_h2t_context_hat = torch.matmul(d_word_pred, self.output_weight).squeeze()
         d_context_hat[t] = d_h2t_context_hat * 1
@@ -1589,36 +1989,36 @@ class ExplainiGridTDGuidedGradient(ExplainGridTDGradient):
         assert t < self.caption_length  #(t starts from 0)
         preceeding_cap_length = t+1
         target_word_encode = self.beam_caption_encode[t+1]
-        d_word_pred = torch.zeros(1, self.vocab_size).cuda()
+        d_word_pred = torch.zeros(1, self.vocab_size, device=self.device, dtype=self.dtype)
         d_word_pred[0, target_word_encode] = 1.  #(1, vocab_size)
-        d_h1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_c1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_i1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_f1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_g1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_o1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_i1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_f1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_g1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_o1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_h2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_c2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim).cuda()
-        d_i2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_f2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_g2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_o2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_i2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_f2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_g2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_o2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_x1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim + 2*self.model.embed_dim).cuda()
-        d_x2t = torch.zeros(preceeding_cap_length, 2*self.model.hidden_dim ).cuda()
-        d_context_hat = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_st = torch.zeros(preceeding_cap_length, self.model.hidden_dim).cuda()
-        d_global_img_feature = torch.zeros(self.model.embed_dim).cuda()
-        d_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim).cuda()
-        d_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim).cuda()
-        d_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim).cuda()
+        d_h1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_c1t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_i1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_f1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_g1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_o1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_i1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_f1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_g1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_o1t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_h2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_c2t = torch.zeros(preceeding_cap_length+1, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_i2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_f2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_g2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_o2t = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_i2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_f2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_g2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_o2t_act = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_x1t = torch.zeros(preceeding_cap_length, self.model.hidden_dim + 2*self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_x2t = torch.zeros(preceeding_cap_length, 2*self.model.hidden_dim , device=self.device, dtype=self.dtype)
+        d_context_hat = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_st = torch.zeros(preceeding_cap_length, self.model.hidden_dim, device=self.device, dtype=self.dtype)
+        d_global_img_feature = torch.zeros(self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_word_embedding = torch.zeros(preceeding_cap_length, self.model.embed_dim, device=self.device, dtype=self.dtype)
+        d_img_feature = torch.zeros(self.num_pixels, self.model.encoder_raw_dim, device=self.device, dtype=self.dtype)
+        d_img_feature_proj = torch.zeros(self.num_pixels, self.model.hidden_dim, device=self.device, dtype=self.dtype)
         #backward starts
         d_h2t_context_hat = torch.matmul(d_word_pred, self.output_weight).squeeze()
         d_context_hat[t] = d_h2t_context_hat * 1
@@ -1825,7 +2225,7 @@ class ExplainGridTDGuidedGradCam(ExplainiGridTDGuidedGradient):
         # cam = F.interpolate(cam.unsqueeze(0).unsqueeze(0), size=(self.img.size(2), self.img.size(3)), mode='bilinear', align_corners=True)
         cam = skimage.transform.pyramid_expand(cam.detach().cpu().numpy(), upscale=16,multichannel=False)
         with torch.no_grad():
-            guided_results = guided_gradient * torch.from_numpy(cam).cuda().float().expand_as(guided_gradient)
+            guided_results = guided_gradient * torch.from_numpy(cam).to(self.device, self.dtype).expand_as(guided_gradient)
         cnn_encoder.zero_grad()
         sample.grad.zero_()
         self.delete_hooks(cnn_encoder)
@@ -1885,15 +2285,24 @@ class GridTDModelBU(nn.Module):
         self.fc = nn.Linear(hidden_dim, vocab_size)
         self.relu = nn.ReLU()
 
+    @property
+    def device(self):
+        # the device and dtype follow the parameters, call model.to(device, dtype) to move the model
+        return self.fc.weight.device
+
+    @property
+    def dtype(self):
+        return self.fc.weight.dtype
+
     def init_hidden_state(self, V):
-        h = torch.zeros(V.shape[0], self.hidden_dim).cuda()
-        c = torch.zeros(V.shape[0], self.hidden_dim).cuda()
+        h = torch.zeros(V.shape[0], self.hidden_dim, device=self.device, dtype=self.dtype)
+        c = torch.zeros(V.shape[0], self.hidden_dim, device=self.device, dtype=self.dtype)
         return h, c
 
-    def predict_next_word(self,image_feature_proj, xt, states):
+    def predict_next_word(self, memory, xt, states):
         h1t, c1t, h2t, c2t = states  # (bs, hidden_dim, )
         h1t, c1t, st = self.AdaLSTM(xt, (h1t, c1t))  #(bs, hidden_dim, )
-        context_t_hat, context_t, alpha_t, beta_t = self.AdaAttention(image_feature_proj, h1t, st)  #(bs, hidden_dim) alpha: (bs, num_pixel), beta:(bs, 1)
+        context_t_hat, context_t, alpha_t, beta_t = self.AdaAttention(memory, h1t, st)  #(bs, hidden_dim) alpha: (bs, num_pixel), beta:(bs, 1)
         language_input = torch.cat((context_t_hat, h1t), dim=-1) #(bs, 2*hiddendim)
         h2t, c2t = self.LanguageLSTM(language_input, (h2t, c2t))  #(bs, hiddendim)
         predict_score_t = self.fc(self.dropout(context_t_hat + h2t))  # (bs, vocab_size)
@@ -1917,19 +2326,20 @@ class GridTDModelBU(nn.Module):
         image_feature_proj = image_feature_proj.contiguous()
         image_feature_proj = image_feature_proj.transpose(1,2) # (bs, hidden_dim, num_pixel)
         # print(image_feature_proj.size())
+        memory = self.AdaAttention.prepare(image_feature_proj)
         h1, c1 = self.init_hidden_state(image_feature_proj)
         h2, c2 = self.init_hidden_state(image_feature_proj)
         state = (h1, c1, h2, c2)
         max_length = max(caption_lengths)-1
-        predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
-        alphas = torch.zeros(batch_size, max_length , num_pixels).cuda()
-        betas = torch.zeros(batch_size, max_length,1).cuda()
+        predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        alphas = torch.zeros(batch_size, max_length , num_pixels, device=self.device, dtype=self.dtype)
+        betas = torch.zeros(batch_size, max_length,1, device=self.device, dtype=self.dtype)
         if ss_prob is None:
             ss_flag = False
         else:
             random_num = np.random.uniform(0.0, 1.0, size=(batch_size,))
             ss_mask = random_num < ss_prob
-            ss_mask = torch.from_numpy(ss_mask).long().cuda()
+            ss_mask = torch.from_numpy(ss_mask).long().to(self.device)
             if ss_mask.sum() > 0:
                 ss_flag = True
             else:
@@ -1943,7 +2353,7 @@ class GridTDModelBU(nn.Module):
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
             xt = torch.cat((state[2], global_img_feature, word_embedding), dim=-1)   # (batch_size, 2*embed_dim + hidden_dim)
-            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
             predictions[:, t,:] = predict_score_t
             alphas[:, t, :] = alpha_t
             betas[:, t, :] = beta_t
@@ -1969,18 +2379,19 @@ class GridTDModelBU(nn.Module):
         # print(global_img_feature.size())
         image_feature_proj = image_feature_proj.contiguous()
         image_feature_proj = image_feature_proj.transpose(1,2)   # (bs, hidden_dim, num_pixel)
+        memory = self.AdaAttention.prepare(image_feature_proj)
         state = self.init_hidden_state(image_feature_proj) + self.init_hidden_state(image_feature_proj)
-        seq = torch.zeros(batch_size,max_length).long().cuda()
-        seq_logprobs = torch.zeros(batch_size, max_length).cuda()
+        seq = torch.zeros(batch_size,max_length, device=self.device, dtype=torch.long)
+        seq_logprobs = torch.zeros(batch_size, max_length, device=self.device, dtype=self.dtype)
         for t in range(max_length):
             if t == 0:
-                it = torch.ones(batch_size).long().cuda() * word_map['<start>']
+                it = torch.ones(batch_size, device=self.device, dtype=torch.long) * word_map['<start>']
             word_embedding = self.embedding(it)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
             # print(global_img_feature.size(), word_embedding.size(), state[2].size())
             xt = torch.cat((state[2], global_img_feature, word_embedding), dim=-1)  # (batch_size, 2*embed_dim)
-            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+            predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
             predict_score_t = torch.log_softmax(predict_score_t,dim=-1)
             it, sampleLpgprobs = self.sample_next_word(predict_score_t, sample_method, temperature)
             # sample the next word
@@ -2004,7 +2415,7 @@ class GridTDModelBU(nn.Module):
             it = it.view(-1).long()
         elif sample_method == 'gumbel': # gumbel softmax
             def sample_gumbel(shape, eps=1e-20):
-                U = torch.rand(shape).cuda()
+                U = torch.rand(shape, device=self.device, dtype=self.dtype)
                 return -torch.log(-torch.log(U + eps) + eps)
             def gumbel_softmax_sample(logits, temperature):
                 y = logits + sample_gumbel(logits.size())
@@ -2077,9 +2488,9 @@ class GridTDModelBU(nn.Module):
         with torch.no_grad():
             complete_seqs = [[] for g in range(num_group)]
             complete_seqs_scores = [[] for g in range(num_group)]
-            k_prev_words = [torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() for g in range(num_group)] # (beam_size,)
-            top_k_scores = [torch.zeros(beam_size, 1).cuda() for g in range(num_group)] # (beam_size, 1)
-            seqs = [torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() for g in range(num_group)]   # (unfinished_num, )
+            k_prev_words = [torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) for g in range(num_group)] # (beam_size,)
+            top_k_scores = [torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) for g in range(num_group)] # (beam_size, 1)
+            seqs = [torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) for g in range(num_group)]   # (unfinished_num, )
             image_feature_proj = self.relu(self.img_projector(images_features)) # batch_size, 36, hidden_dim
 
             avg_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hiddendim)
@@ -2089,9 +2500,10 @@ class GridTDModelBU(nn.Module):
             image_feature_proj = image_feature_proj.transpose(1,2)  # (bs, hidden_dim, num_pixel)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
-            image_feature_proj = [image_feature_proj.expand(beam_size, *image_feature_proj.size()[1:]) for g in range(num_group)] # beam_size, hidden_dim, H*W
+            memory = self.AdaAttention.prepare(image_feature_proj)
+            memory = [tuple(m.expand(beam_size, *m.size()[1:]) for m in memory) for g in range(num_group)] # (V, img_proj) beam_size, H*W, hidden_dim / H*W
             global_img_feature = [global_img_feature.expand(beam_size, global_img_feature.size(-1)) for g in range(num_group)] #  beam_size, hidden_dim,
-            init_state = self.init_hidden_state(image_feature_proj[0]) + self.init_hidden_state(image_feature_proj[0])
+            init_state = self.init_hidden_state(memory[0][0]) + self.init_hidden_state(memory[0][0])
             state = [init_state for g in range(num_group)]  #(ht, ct)
             unfinished_num = [beam_size for g in range(num_group)]
             for step in range(max_cap_length):
@@ -2101,7 +2513,7 @@ class GridTDModelBU(nn.Module):
                         continue
                     word_embedding = self.embedding(k_prev_words[g]).squeeze(1)  # unfinished_num, embedding_dim
                     xt = torch.cat((state[g][2], global_img_feature[g], word_embedding), dim=-1)  # (batch_size, 2*embed_dim + hidden_dim)
-                    predict_score_t, alpha_t, beta_t, state[g] = self.predict_next_word(image_feature_proj[g], xt, state[g])
+                    predict_score_t, alpha_t, beta_t, state[g] = self.predict_next_word(memory[g], xt, state[g])
                     predict_score_t = torch.log_softmax(predict_score_t, dim=-1)  # (unfinished_num, vocab_size)
                     for i, v in enumerate(previous_idx):
                         predict_score_t[:,int(v)] = predict_score_t[:, int(v)] - diversity_prob
@@ -2131,7 +2543,7 @@ class GridTDModelBU(nn.Module):
                     for s_idx in range(len(state[g])):
                         new_state.append(state[g][s_idx][beam_idx[incomplete_inds]])
                     state[g] = tuple(new_state)
-                    image_feature_proj[g] = image_feature_proj[g][beam_idx[incomplete_inds]]
+                    memory[g] = tuple(m[beam_idx[incomplete_inds]] for m in memory[g])
                     global_img_feature[g] = global_img_feature[g][beam_idx[incomplete_inds]]
                     top_k_scores[g] = top_k_scores[g][incomplete_inds].unsqueeze(1)
                     if g < 2:
@@ -2175,9 +2587,9 @@ class GridTDModelBU(nn.Module):
         complete_seqs =[]
         complete_seqs_scores=[]
         with torch.no_grad():
-            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).cuda() # (beam_size,)
-            top_k_scores = torch.zeros(beam_size, 1).cuda() # (beam_size, 1)
-            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).cuda()  # (unfinished_num, )
+            k_prev_words = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device) # (beam_size,)
+            top_k_scores = torch.zeros(beam_size, 1, device=self.device, dtype=self.dtype) # (beam_size, 1)
+            seqs = torch.LongTensor([[word_map['<start>']]] *beam_size).to(self.device)  # (unfinished_num, )
             image_feature_proj = self.relu(self.img_projector(images_features)) # batch_size, 36, hidden_dim
 
             avg_feature = torch.mean(image_feature_proj, dim=1)  # (bs, hiddendim)
@@ -2188,14 +2600,15 @@ class GridTDModelBU(nn.Module):
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)   # batch_size, hidden_dim
             # print(global_img_feature.size())
-            image_feature_proj = image_feature_proj.expand(beam_size, *image_feature_proj.size()[1:]) # beam_size, hidden_dim, H*W
+            memory = self.AdaAttention.prepare(image_feature_proj)
+            memory = tuple(m.expand(beam_size, *m.size()[1:]) for m in memory) # (V, img_proj) beam_size, H*W, hidden_dim / H*W
             global_img_feature = global_img_feature.expand(beam_size, global_img_feature.size(-1)) #  beam_size, hidden_dim,
-            state = self.init_hidden_state(image_feature_proj) +  self.init_hidden_state(image_feature_proj)  #(ht, ct)
+            state = self.init_hidden_state(memory[0]) +  self.init_hidden_state(memory[0])  #(ht, ct)
             unfinished_num = beam_size
             for step in range(max_cap_length):
                 word_embedding = self.embedding(k_prev_words).squeeze(1) # unfinished_num, embedding_dim
                 xt = torch.cat((state[2], global_img_feature, word_embedding), dim=-1) # (batch_size, 2*embed_dim + hidden_dim)
-                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
                 predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(unfinished_num, vocab_size)
                 top_k_scores_exp = top_k_scores.expand((unfinished_num, vocab_size))
                 scores = top_k_scores_exp + predict_score_t
@@ -2223,7 +2636,7 @@ class GridTDModelBU(nn.Module):
                 for s_idx in range(len(state)):
                     new_state.append(state[s_idx][beam_idx[incomplete_inds]])
                 state = tuple(new_state)
-                image_feature_proj = image_feature_proj[beam_idx[incomplete_inds]]
+                memory = tuple(m[beam_idx[incomplete_inds]] for m in memory)
                 global_img_feature = global_img_feature[beam_idx[incomplete_inds]]
                 top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
                 k_prev_words = next_word_idx[incomplete_inds].unsqueeze(1)
@@ -2245,7 +2658,7 @@ class GridTDModelBU(nn.Module):
         rev_word_map = {v: k for k, v in word_map.items()}
         complete_seq =[]
         with torch.no_grad():
-            k_prev_words = torch.zeros(batch_size, max_cap_length).long().cuda() # (batch_size, caption_length)
+            k_prev_words = torch.zeros(batch_size, max_cap_length, device=self.device, dtype=torch.long) # (batch_size, caption_length)
             k_prev_words[:, 0] = word_map['<start>'] # the first word is '<start>'
             seqs_temp = [[word_map['<start>']] for _ in range(batch_size)]
             image_feature_proj = self.relu(self.img_projector(images_features)) # batch_size, 36, hidden_dim
@@ -2255,13 +2668,14 @@ class GridTDModelBU(nn.Module):
 
             image_feature_proj = image_feature_proj.contiguous()
             image_feature_proj = image_feature_proj.transpose(1,2)   # (bs, hidden_dim, num_pixel)
+            memory = self.AdaAttention.prepare(image_feature_proj)
             state = self.init_hidden_state(image_feature_proj) +  self.init_hidden_state(image_feature_proj)#(ht, ct)
             for step in range(max_cap_length-1):
                 word_embedding = self.embedding(k_prev_words[:, step]) # batch_size, embedding_dim
                 if global_img_feature.dim() == 1:
                     global_img_feature = global_img_feature.unsqueeze(0)
                 xt = torch.cat((state[2], global_img_feature, word_embedding), dim=-1) # (batch_size, 2*embed_dim + hidden_dim)
-                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(image_feature_proj, xt, state)
+                predict_score_t, alpha_t, beta_t, state = self.predict_next_word(memory, xt, state)
                 predict_score_t = torch.log_softmax(predict_score_t,dim=-1) #(batch_size, vocab_size)
                 top_scores, top_words = predict_score_t.topk(1, -1, True, True)
                 if step == 0:
@@ -2296,47 +2710,34 @@ class GridTDModelBU(nn.Module):
         assert r_out.dim() == 1
         assert forward_input.dim() == 1
         assert weight.dim() == 2
-        attribution = weight * forward_input #(out_feature, in_feature)
-        if type(forward_output) == bool:
-            forward_output = torch.matmul(forward_input, weight.transpose(0,1))
-            # print('matml', forward_output.size())
-        forward_output_eps = self.EPS * forward_output.sign() + forward_output  # Z.sign() returns -1 or 0 or 1
-
-        forward_output_eps.masked_fill_(forward_output_eps == 0, self.EPS)  #(out_feature,)
-        # print(forward_output_eps.size())
-        attribution_norm = attribution.transpose(0,1) / forward_output_eps #(in_feature, out_feature)
-        # print(attribution_norm.size())
-        relevance_input = torch.sum(attribution_norm * r_out, dim=-1) #(in_feature,)
-        assert relevance_input.size() == forward_input.size()
-        torch.cuda.empty_cache()
-        return relevance_input
+        return lrp_rules.lrp_linear_eps(r_out, forward_input, forward_output, weight, self.EPS)
 
     def get_lrp_weight_step(self, predictions_t, rev_word_map, h2t_, context_hat):
         batch_size, vocab_size = predictions_t.size()
         with torch.no_grad():
-            weight_of_context_hat = torch.zeros(batch_size, self.hidden_dim).cuda()
-            weight_of_h2t = torch.zeros(batch_size, self.hidden_dim).cuda()
+            weight_of_context_hat = torch.zeros(batch_size, self.hidden_dim, device=self.device, dtype=self.dtype)
+            weight_of_h2t = torch.zeros(batch_size, self.hidden_dim, device=self.device, dtype=self.dtype)
             for b in range(batch_size):
                 predicted_labels = torch.argmax(predictions_t[b], dim=-1)  # (the predicted label of image b)  (max_length)
                 word_t = predicted_labels.item()
                 if rev_word_map[word_t] in STOP_WORDS + ['<start>','<end>','<pad>','<unk>']:
                     continue
                 else:
-                    word_relevance = torch.zeros(self.vocab_size).cuda()
+                    word_relevance = torch.zeros(self.vocab_size, device=self.device, dtype=self.dtype)
                     word_relevance[word_t] = predictions_t[b][word_t]
                     r_h2t_context_hat = self.lrp_linear_eps(r_out=word_relevance,
                                                             forward_input=h2t_[b] + context_hat[b],
                                                             forward_output=predictions_t[b],
                                                             weight=self.fc.weight)
-                    r_h2t = self.lrp_linear_eps(r_out=r_h2t_context_hat,
-                                                      forward_input=h2t_[b],
-                                                      forward_output=h2t_[b] + context_hat[b],
-                                                      weight=torch.eye(self.hidden_dim).cuda())
+                    r_h2t = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_hat,
+                                                          forward_input=h2t_[b],
+                                                          forward_output=h2t_[b] + context_hat[b],
+                                                          eps=self.EPS)
                     weight_of_h2t[b] = r_h2t
-                    r_context_hat = self.lrp_linear_eps(r_out=r_h2t_context_hat,
-                                                        forward_input=context_hat[b],
-                                                        forward_output=h2t_[b] + context_hat[b],
-                                                        weight=torch.eye(self.hidden_dim).cuda())
+                    r_context_hat = lrp_rules.lrp_elementwise_eps(r_out=r_h2t_context_hat,
+                                                                  forward_input=context_hat[b],
+                                                                  forward_output=h2t_[b] + context_hat[b],
+                                                                  eps=self.EPS)
                     weight_of_context_hat[b] = r_context_hat
             weight_of_context_hat = LRPutil.normalize_relevance(weight_of_context_hat,dim=-1)
             weight_of_h2t = LRPutil.normalize_relevance(weight_of_h2t, dim=-1)
@@ -2368,8 +2769,9 @@ class GridTDModelBU(nn.Module):
         state = (h1, c1, h2, c2)
 
         max_length = max(caption_lengths) - 1
-        predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
-        weighted_predictions = torch.zeros(batch_size, max_length, self.vocab_size).cuda()
+        predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        weighted_predictions = torch.zeros(batch_size, max_length, self.vocab_size, device=self.device, dtype=self.dtype)
+        memory = self.AdaAttention.prepare(image_feature_proj)
         for t in range(max_length):
             word_embedding = self.embedding(encoded_captions[:, t])
             if global_img_feature.dim() == 1:
@@ -2380,7 +2782,7 @@ class GridTDModelBU(nn.Module):
                                                           self.AdaLSTM.lstm_cell.bias_ih, self.AdaLSTM.lstm_cell.bias_hh)
             sen_gate = torch.sigmoid(self.AdaLSTM.x_gate(x1t_) + self.AdaLSTM.h_gate(h1_))
             st_ = sen_gate * torch.tanh(c1_)
-            context_t_hat_, context_t_, alpha_t_, beta_t_ = self.AdaAttention(image_feature_proj, h1_, st_)  # (1, hidden_dim), (1, num_pixel), (1,1)
+            context_t_hat_, context_t_, alpha_t_, beta_t_ = self.AdaAttention(memory, h1_, st_)  # (1, hidden_dim), (1, num_pixel), (1,1)
             x2t_ = torch.cat((context_t_hat_, h1_), dim=-1)
             h2_, c2_, g2_, i2_act_, f2_act_ = lstm_forward(x2t_, state[2], state[3], self.LanguageLSTM.weight_ih,
                                                           self.LanguageLSTM.weight_hh,
@@ -2422,12 +2824,13 @@ class GridTDModelBU(nn.Module):
         image_feature_proj = image_feature_proj.contiguous()
         image_feature_proj = image_feature_proj.transpose(1,2)  # (bs, hidden_dim, num_pixel)
         state = self.init_hidden_state(image_feature_proj) + self.init_hidden_state(image_feature_proj)
-        seq = torch.zeros(batch_size,max_length).long().cuda()
-        seq_logprobs = torch.zeros(batch_size, max_length).cuda()
+        seq = torch.zeros(batch_size,max_length, device=self.device, dtype=torch.long)
+        seq_logprobs = torch.zeros(batch_size, max_length, device=self.device, dtype=self.dtype)
 
+        memory = self.AdaAttention.prepare(image_feature_proj)
         for t in range(max_length):
             if t == 0:
-                it = torch.ones(batch_size).long().cuda() * word_map['<start>']
+                it = torch.ones(batch_size, device=self.device, dtype=torch.long) * word_map['<start>']
             word_embedding = self.embedding(it)
             if global_img_feature.dim() == 1:
                 global_img_feature = global_img_feature.unsqueeze(0)
@@ -2437,7 +2840,7 @@ class GridTDModelBU(nn.Module):
                                                           self.AdaLSTM.lstm_cell.bias_ih, self.AdaLSTM.lstm_cell.bias_hh)
             sen_gate = torch.sigmoid(self.AdaLSTM.x_gate(x1t_) + self.AdaLSTM.h_gate(h1_))
             st_ = sen_gate * torch.tanh(c1_)
-            context_t_hat_, context_t_, alpha_t_, beta_t_ = self.AdaAttention(image_feature_proj, h1_, st_)  # (1, hidden_dim), (1, num_pixel), (1,1)
+            context_t_hat_, context_t_, alpha_t_, beta_t_ = self.AdaAttention(memory, h1_, st_)  # (1, hidden_dim), (1, num_pixel), (1,1)
             x2t_ = torch.cat((context_t_hat_, h1_), dim=-1)
             h2_, c2_, g2_, i2_act_, f2_act_ = lstm_forward(x2t_, state[2], state[3], self.LanguageLSTM.weight_ih,
                                                           self.LanguageLSTM.weight_hh,
@@ -5,6 +5,9 @@ from pycocoevalcap.rouge import rouge
 from pycocoevalcap.spice import spice
 from pycocoevalcap.bert import bert
 from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer
+import multiprocessing
+import signal
+import time
 import os
 
 class Score(object):
@@ -21,6 +24,10 @@ class Score(object):
         #     id_to_preds[id_] = [pred]
         id_to_references = self.tokenizer.tokenize(id_to_references)
         id_to_prediction = self.tokenizer.tokenize(id_to_prediction)
+        return self.calculate_tokenized(id_to_prediction, id_to_references)
+
+    def calculate_tokenized(self, id_to_prediction, id_to_references):
+        """The same as calculate for the captions already tokenized by PTBTokenizer."""
         avg_score, scores = self._implementation.compute_score(
                                                 id_to_references, id_to_prediction)
         if isinstance(avg_score, (list, tuple)):
@@ -29,6 +36,18 @@ class Score(object):
             avg_score = float(avg_score)
         return {self._score_name: avg_score}
 
+    def missing_result(self):
+        """The result reported when the score could not be computed in time."""
+        return {self._score_name: float('nan')}
+
+    def spec(self):
+        """The class and the constructor arguments that rebuild this score.
+
+        The implementations can hold a JVM subprocess, pipes and locks that
+        cannot be pickled, so a worker process builds its own score from this.
+        """
+        return type(self), ()
+
 
 class BLEU(Score):
     def __init__(self, n=4):
@@ -36,10 +55,10 @@ class BLEU(Score):
         super(BLEU, self).__init__('bleu', implementation)
         self._n = n
 
-    def calculate(self, id_to_prediction, id_to_references):
+    def calculate_tokenized(self, id_to_prediction, id_to_references):
 
-        name_to_score = super(BLEU, self).calculate(id_to_prediction,
-                                                    id_to_references)
+        name_to_score = super(BLEU, self).calculate_tokenized(id_to_prediction,
+                                                              id_to_references)
         scores = list(name_to_score.values())[0]
         result = {}
         for i, score in enumerate(scores, start=1):
@@ -47,6 +66,13 @@ class BLEU(Score):
             result[name] = score
         return result
 
+    def missing_result(self):
+        return {'{}_{}'.format(self._score_name, i): float('nan')
+                for i in range(1, self._n + 1)}
+
+    def spec(self):
+        return type(self), (self._n,)
+
 
 class CIDEr(Score):
     def __init__(self):
@@ -59,10 +85,10 @@ class METEOR(Score):
         implementation = meteor.Meteor()
         super(METEOR, self).__init__('meteor', implementation)
 
-    def calculate(self, id_to_prediction, id_to_references):
+    def calculate_tokenized(self, id_to_prediction, id_to_references):
         if self._data_downloaded():
-            return super(METEOR, self).calculate(id_to_prediction,
-                                                 id_to_references)
+            return super(METEOR, self).calculate_tokenized(id_to_prediction,
+                                                           id_to_references)
         else:
             return {self._score_name: 0.0}
 
@@ -88,3 +114,139 @@ class BERT(Score):
         implementation = bert.Bert()
         super(BERT,self).__init__('bert', implementation)
 
+
+def _timed_calculate(score, id_to_prediction, id_to_references):
+    start = time.time()
+    result = score.calculate_tokenized(id_to_prediction, id_to_references)
+    return result, time.time() - start
+
+
+def _init_worker(pid_queue):
+    # every worker leads its own process group, the java processes the score
+    # starts join it, so a timeout can kill them together with the worker
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    pid_queue.put(os.getpid())
+
+
+def _kill_process_groups(pid_queue):
+    while not pid_queue.empty():
+        pid = pid_queue.get()
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def _timed_calculate_spec(spec, id_to_prediction, id_to_references):
+    score_class, args = spec
+    return _timed_calculate(score_class(*args), id_to_prediction,
+                            id_to_references)
+
+
+class MetricSuite(object):
+    """Several scores fed from one tokenization.
+
+    The references and the predictions are tokenized once for all the scores,
+    instead of once per score. The tokenized references of a split are kept,
+    so the validation of every epoch only tokenizes the new predictions.
+    tokenizer_backend selects the PTBTokenizer backend. The default 'java' is
+    the COCO tokenization, 'python' avoids starting the JVM at all but is
+    opt-in since its tokens can differ.
+
+    With num_workers > 0 the scores run concurrently in a pool of processes,
+    so the wall time is the one of the slowest score. timeout is the number of
+    seconds a score may take, a float for all of them or a dict keyed by the
+    score name. A score that times out is reported as nan, and its worker is
+    killed together with the java processes it started. A worker builds its
+    own score from Score.spec, the score instances of the suite stay in this
+    process.
+    """
+
+    def __init__(self, scores, tokenizer_backend='java', num_workers=0,
+                 timeout=None):
+        self.scores = scores
+        self.tokenizer = PTBTokenizer(tokenizer_backend)
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.timings = {}
+        self._references = {}  # split: (id_to_references, tokenized references)
+
+    def tokenize_references(self, id_to_references, split=None):
+        if split is None:
+            return self.tokenizer.tokenize(id_to_references)
+        if split in self._references:
+            cached_references, tokenized_references = self._references[split]
+            if cached_references == id_to_references:
+                return tokenized_references
+        tokenized_references = self.tokenizer.tokenize(id_to_references)
+        self._references[split] = (id_to_references, tokenized_references)
+        return tokenized_references
+
+    def calculate(self, id_to_prediction, id_to_references, split=None):
+        start = time.time()
+        id_to_references = self.tokenize_references(id_to_references, split)
+        id_to_prediction = self.tokenizer.tokenize(id_to_prediction)
+        self.timings = {'tokenize': time.time() - start}
+        if self.num_workers > 0:
+            result = self._calculate_parallel(id_to_prediction, id_to_references)
+        else:
+            result = {}
+            for score in self.scores:
+                score_result, elapsed = _timed_calculate(score, id_to_prediction,
+                                                         id_to_references)
+                result.update(score_result)
+                self.timings[score._score_name] = elapsed
+        self.timings['total'] = time.time() - start
+        print('metric timings: ' + ', '.join(
+            '{}: {:.1f}s'.format(name, elapsed) for name, elapsed in self.timings.items()))
+        return result
+
+    def _score_timeout(self, score):
+        if isinstance(self.timeout, dict):
+            return self.timeout.get(score._score_name)
+        return self.timeout
+
+    def _calculate_parallel(self, id_to_prediction, id_to_references):
+        # spawn does not inherit the CUDA state of the parent, the java scorers
+        # run in their own subprocesses anyway. The score instances are not
+        # sent, every worker builds its score from the picklable spec.
+        ctx = multiprocessing.get_context('spawn')
+        pid_queue = ctx.SimpleQueue()
+        pool = ctx.Pool(min(self.num_workers, len(self.scores)),
+                        initializer=_init_worker, initargs=(pid_queue,))
+        submitted = time.time()
+        jobs = [pool.apply_async(_timed_calculate_spec,
+                                 (score.spec(), id_to_prediction, id_to_references))
+                for score in self.scores]
+        result = {}
+        timed_out = False
+        completed = False
+        try:
+            for score, job in zip(self.scores, jobs):
+                timeout = self._score_timeout(score)
+                if timeout is not None:
+                    # the timeout counts from the submission of all the scores
+                    timeout = max(0., submitted + timeout - time.time())
+                try:
+                    score_result, elapsed = job.get(timeout)
+                except multiprocessing.TimeoutError:
+                    print('{} did not finish in {}s'.format(
+                        score._score_name, self._score_timeout(score)))
+                    score_result = score.missing_result()
+                    elapsed = time.time() - submitted
+                    timed_out = True
+                result.update(score_result)
+                self.timings[score._score_name] = elapsed
+            completed = not timed_out
+        finally:
+            if completed:
+                pool.close()
+            else:
+                # stops the scores still running after a timeout or an error,
+                # terminate only reaches the workers, not their java children
+                pool.terminate()
+                if hasattr(os, 'killpg'):
+                    _kill_process_groups(pid_queue)
+            pool.join()
+        return result
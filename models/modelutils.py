@@ -3,9 +3,7 @@ import torch.nn as nn
 import numpy as np
 import torch
 import glob
-from collections import OrderedDict
 from pycocoevalcap.bleu.bleu import Bleu as Bleu_scorer
-from pycocoevalcap.cider.cider import Cider as CiderD_scorer
 
 class AverageMeter(object):
     """
@@ -197,34 +195,206 @@ def array_to_str(arr, rev_word_map, end_encode):
     return ' '.join(out)
 
 
-def get_self_critical_reward(greedy_res, data_gts, gen_result, word_map, cider_reward_weight,bleu_reward_weight):
-    rev_word_map = {v: k for k, v in word_map.items()}
+class TokenCiderD(object):
+    '''
+    CIDEr-D on the token ids of the captions, it gives the same scores as the pycocoevalcap CiderScorer on the captions
+    of array_to_str. the n-grams are hashed to int64 keys and the tf-idf vectors of the whole batch are compared with
+    sparse dot products instead of the python dicts of counts2vec and sim.
+    with a document frequency index of build_cider_document_frequency, the idf comes from the training corpus instead of
+    the references of the batch
+    '''
+
+    def __init__(self, word_map, n=4, sigma=6.0, document_frequency=None):
+        '''
+        :param document_frequency: the path of a document frequency index, None to count it in every batch
+        '''
+        self.n = n
+        self.sigma = sigma
+        self.ignore = np.array([word_map['<start>'], word_map['<pad>']])
+        # the tokens are shifted by one so that a key is the base-`base` number of the n-gram, unique over all orders
+        self.base = max(word_map.values()) + 2
+        assert float(self.base) ** n < 2 ** 63, 'the vocabulary is too large to hash the {}-grams in int64'.format(n)
+        self.df_keys = None
+        self.df_counts = None
+        self.df_ref_len = None
+        if document_frequency is not None:
+            self.load_document_frequency(document_frequency)
+
+    def load_document_frequency(self, path):
+        index = np.load(path)
+        if int(index['n']) != self.n or int(index['base']) != self.base:
+            raise ValueError(f'the document frequency index {path} is not built for this word map and n')
+        self.df_keys = index['keys']
+        self.df_counts = index['df']
+        self.df_ref_len = np.log(float(index['num_images']))
+
+    def token_ids(self, seq):
+        '''
+        :param seq: a sequence of word ids
+        :return: the tokens array_to_str keeps, every word but <start> and <pad>
+        '''
+        seq = np.asarray(seq).astype(np.int64).reshape(-1)
+        return seq[~np.isin(seq, self.ignore)]
+
+    def ngrams(self, sentences):
+        '''
+        :param sentences: a list of token id arrays
+        :return: the sentence index, the key and the order (0 for the unigrams) of every n-gram in the sentences
+        '''
+        lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+        max_len = max(int(lengths.max(initial=0)), 1)
+        ids = np.zeros((len(sentences), max_len), dtype=np.int64)
+        for i, s in enumerate(sentences):
+            ids[i, :len(s)] = np.asarray(s) + 1
+        sent, keys, order = [], [], []
+        key = np.zeros_like(ids)
+        for k in range(min(self.n, max_len)):
+            key = key[:, :max_len - k] * self.base + ids[:, k:]  #(n_sent, max_len - k) the (k+1)-grams
+            valid = np.arange(max_len - k)[None, :] + k < lengths[:, None]
+            sent.append(np.nonzero(valid)[0])
+            keys.append(key[valid])
+            order.append(np.full(len(sent[-1]), k, dtype=np.int64))
+        return np.concatenate(sent), np.concatenate(keys), np.concatenate(order)
+
+    def document_frequency(self, refs):
+        '''
+        :param refs: a list of lists of token id arrays, the reference captions of every image
+        :return: the sorted n-gram keys of refs and the number of images whose references contain each of them
+        '''
+        ref_counts = np.array([len(r) for r in refs], dtype=np.int64)
+        sent, keys, _ = self.ngrams([r for image_refs in refs for r in image_refs])
+        grams, gram_idx = np.unique(keys, return_inverse=True)
+        image_grams = np.unique(np.repeat(np.arange(len(refs)), ref_counts)[sent] * len(grams) + gram_idx)
+        return grams, np.bincount(image_grams % len(grams), minlength=len(grams))
+
+    def compute_score(self, hyps, refs, hyp_refs):
+        '''
+        :param hyps: a list of token id arrays, one hypothesis per entry
+        :param refs: a list of lists of token id arrays, the reference captions of every image
+        :param hyp_refs: (n_hyp,) the index in refs of the references of every hypothesis
+        :return: (n_hyp,) the CIDEr-D score of every hypothesis
+        '''
+        hyp_refs = np.asarray(hyp_refs, dtype=np.int64)
+        n_hyp = len(hyps)
+        ref_counts = np.array([len(r) for r in refs], dtype=np.int64)
+        ref_start = np.cumsum(ref_counts) - ref_counts
+        ref_image = np.repeat(np.arange(len(refs)), ref_counts)
+        sentences = list(hyps) + [r for image_refs in refs for r in image_refs]
+        n_sent = len(sentences)
+
+        # the term frequency of every n-gram in every sentence, one entry per (sentence, n-gram)
+        sent, keys, order = self.ngrams(sentences)
+        grams, gram_idx = np.unique(keys, return_inverse=True)
+        n_gram = len(grams)
+        gram_order = np.zeros(n_gram, dtype=np.int64)
+        gram_order[gram_idx] = order
+        entries, tf = np.unique(sent * n_gram + gram_idx, return_counts=True)
+        sent, gram_idx = entries // n_gram, entries % n_gram
+        order = gram_order[gram_idx]
+
+        is_ref = sent >= n_hyp
+        if self.df_keys is None:
+            # as compute_doc_freq, an n-gram counts once for the reference set of every hypothesis
+            image_grams = np.unique(ref_image[sent[is_ref] - n_hyp] * n_gram + gram_idx[is_ref])
+            hyps_per_image = np.bincount(hyp_refs, minlength=len(refs))
+            df = np.bincount(image_grams % n_gram, weights=hyps_per_image[image_grams // n_gram], minlength=n_gram)
+            ref_len = np.log(float(n_hyp))
+        else:
+            # the n-grams out of the training references have a df of 0
+            pos = np.minimum(np.searchsorted(self.df_keys, grams), len(self.df_keys) - 1)
+            df = np.where(self.df_keys[pos] == grams, self.df_counts[pos], 0)
+            ref_len = self.df_ref_len
+        vec = tf * (ref_len - np.log(np.maximum(1., df[gram_idx])))
+        norm = np.sqrt(np.bincount(sent * self.n + order, weights=vec ** 2,
+                                   minlength=n_sent * self.n)).reshape(n_sent, self.n)
+        # counts2vec takes the number of bigrams as the length of a sentence
+        length = np.bincount(sent, weights=tf * (order == 1), minlength=n_sent)
+
+        # every hypothesis n-gram meets the same n-gram in the references of its image
+        ref_entries = np.nonzero(is_ref)[0]
+        ref_keys = ref_image[sent[ref_entries] - n_hyp] * n_gram + gram_idx[ref_entries]
+        sort = np.argsort(ref_keys, kind='stable')
+        ref_entries, ref_keys = ref_entries[sort], ref_keys[sort]
+        hyp_entries = np.nonzero(~is_ref)[0]
+        hyp_keys = hyp_refs[sent[hyp_entries]] * n_gram + gram_idx[hyp_entries]
+        lo = np.searchsorted(ref_keys, hyp_keys, 'left')
+        matches = np.searchsorted(ref_keys, hyp_keys, 'right') - lo
+        match_hyp = np.repeat(hyp_entries, matches)
+        match_ref = ref_entries[np.repeat(lo - np.cumsum(matches) + matches, matches) + np.arange(matches.sum())]
+
+        # one row per (hypothesis, reference) pair, the references of a hypothesis are contiguous
+        pair_counts = ref_counts[hyp_refs]
+        pair_start = np.cumsum(pair_counts) - pair_counts
+        n_pair = int(pair_counts.sum())
+        pair_hyp = np.repeat(np.arange(n_hyp), pair_counts)
+        pair_ref = n_hyp + np.repeat(ref_start[hyp_refs] - pair_start, pair_counts) + np.arange(n_pair)
+        h, r = sent[match_hyp], sent[match_ref]
+        pair = pair_start[h] + r - n_hyp - ref_start[hyp_refs[h]]
+        # the clipped dot product of sim
+        clipped = np.minimum(vec[match_hyp], vec[match_ref]) * vec[match_ref]
+        val = np.bincount(pair * self.n + order[match_hyp], weights=clipped,
+                          minlength=n_pair * self.n).reshape(n_pair, self.n)
+        norm_prod = norm[pair_hyp] * norm[pair_ref]
+        val = np.where(norm_prod != 0, val / np.where(norm_prod != 0, norm_prod, 1.), val)
+        delta = length[pair_hyp] - length[pair_ref]
+        val *= np.exp(-(delta ** 2) / (2 * self.sigma ** 2))[:, None]
+        scores = np.bincount(pair_hyp, weights=val.mean(1), minlength=n_hyp)
+        return scores / pair_counts * 10.0
+
+
+def build_cider_document_frequency(data, word_map, save_path, n=4, chunk_size=5000):
+    '''
+    counts the CIDEr-D document frequency of the training references once and saves it as a compressed npz index of
+    the sorted n-gram keys of TokenCiderD and their number of images
+    :param data: the items of a train_imagecap json, the references of an image are repeated for each of its captions
+    :param chunk_size: the number of images counted at a time
+    '''
+    engine = TokenCiderD(word_map, n=n)
+    image_refs = {}
+    for item in data:
+        image_refs.setdefault(item['image_path'], item['encoded_all_caps'])
+    image_refs = list(image_refs.values())
+    keys, counts = [], []
+    for start in range(0, len(image_refs), chunk_size):
+        refs = [[engine.token_ids(ref) for ref in image] for image in image_refs[start:start + chunk_size]]
+        chunk_keys, chunk_counts = engine.document_frequency(refs)
+        keys.append(chunk_keys)
+        counts.append(chunk_counts)
+    keys, gram_idx = np.unique(np.concatenate(keys), return_inverse=True)
+    df = np.bincount(gram_idx, weights=np.concatenate(counts), minlength=len(keys)).astype(np.int32)
+    with open(save_path, 'wb') as f:
+        np.savez_compressed(f, keys=keys, df=df, num_images=len(image_refs), n=n, base=engine.base)
+    print(f'{len(keys)} n-grams of {len(image_refs)} images are saved to {save_path}')
+
+
+def get_self_critical_reward(greedy_res, data_gts, gen_result, word_map, cider_reward_weight,bleu_reward_weight,
+                             cider_engine=None):
+    '''
+    :param cider_engine: the TokenCiderD of the cider rewards, a new one for word_map when None
+    '''
     batch_size = gen_result.size(0)  # batch_size = sample_size * seq_per_img
-    res = OrderedDict()
     gen_result = gen_result.data.cpu().numpy()
     greedy_res = greedy_res.data.cpu().numpy()
-    for i in range(batch_size):
-        res[i] = [array_to_str(gen_result[i], rev_word_map=rev_word_map, end_encode=word_map['<end>'])]
-    for i in range(batch_size):
-        res[batch_size + i] = [array_to_str(greedy_res[i], rev_word_map=rev_word_map,end_encode=word_map['<end>'])]
-
-    gts = OrderedDict()
-    for i in range(len(data_gts)):
-        gts[i] = [array_to_str(data_gts[i][j], rev_word_map=rev_word_map,end_encode=word_map['<end>']) for j in range(len(data_gts[i]))]
-
-    # res_ = [{'image_id': i, 'caption': res[i]} for i in range(2 * batch_size)]
-    res__ = {i: res[i] for i in range(2 * batch_size)}
-    gts = {i: gts[i % batch_size] for i in range(2 * batch_size)}
-    # for i in range(batch_size):
-        # print(res__[i])
-        # print(res__[i+batch_size])
-        # print(gts[i])
+    if torch.is_tensor(data_gts):
+        data_gts = data_gts.cpu().numpy()
     if cider_reward_weight > 0:
-        _, cider_scores = CiderD_scorer().compute_score(gts=gts, res=res__)
-        # print('Cider scores:', _)
+        if cider_engine is None:
+            cider_engine = TokenCiderD(word_map)
+        hyps = [cider_engine.token_ids(seq) for seq in gen_result] + [cider_engine.token_ids(seq) for seq in greedy_res]
+        refs = [[cider_engine.token_ids(ref) for ref in data_gts[i]] for i in range(len(data_gts))]
+        # the sampled and the greedy captions of image i are both scored against the references of image i
+        cider_scores = cider_engine.compute_score(hyps, refs, np.arange(2 * batch_size) % batch_size)
     else:
         cider_scores = 0
     if bleu_reward_weight > 0:
+        rev_word_map = {v: k for k, v in word_map.items()}
+        res__ = {}
+        for i in range(batch_size):
+            res__[i] = [array_to_str(gen_result[i], rev_word_map=rev_word_map, end_encode=word_map['<end>'])]
+            res__[batch_size + i] = [array_to_str(greedy_res[i], rev_word_map=rev_word_map,
+                                                  end_encode=word_map['<end>'])]
+        gts = {i: [array_to_str(ref, rev_word_map=rev_word_map, end_encode=word_map['<end>'])
+                   for ref in data_gts[i % batch_size]] for i in range(2 * batch_size)}
         _, bleu_scores = Bleu_scorer().compute_score(gts=gts, res=res__)
         bleu_scores = np.array(bleu_scores[3])
         # print('Bleu scores:', _[3])
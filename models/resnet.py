@@ -239,6 +239,45 @@ class ResNet(nn.Module):
         return self._forward_impl(x)
 
 
+def fuse_conv_bn(conv, bn):
+    """conv followed by bn in eval mode is a single convolution with the weight scaled by gamma / std and a bias"""
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                      dilation=conv.dilation, groups=conv.groups, bias=True)
+    fused = fused.to(conv.weight.device, conv.weight.dtype)
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.weight.copy_(conv.weight * scale[:, None, None, None])
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
+def fold_batchnorm(model):
+    """
+    Folds every BatchNorm of a ResNet into the convolution before it, for inference. The BatchNorm is replaced by
+    nn.Identity, so there are fewer layers to run. The model is changed in place and must be in eval mode, the other
+    encoders are returned unchanged. It is not meant for the LRP explanations: the folded convolution gets the
+    alpha-beta rule on the scaled weights instead of the BatchNorm rule, so the relevance is not the same.
+    """
+    if not isinstance(model, ResNet):
+        return model
+    assert not model.training, 'BatchNorm can only be folded in eval mode'
+    pairs = [(model, 'conv1', 'bn1')]
+    for module in model.modules():
+        if isinstance(module, Bottleneck):
+            pairs += [(module, 'conv1', 'bn1'), (module, 'conv2', 'bn2'), (module, 'conv3', 'bn3')]
+        elif isinstance(module, BasicBlock):
+            pairs += [(module, 'conv1', 'bn1'), (module, 'conv2', 'bn2')]
+        if isinstance(module, (Bottleneck, BasicBlock)) and module.downsample is not None:
+            pairs.append((module.downsample, '0', '1'))
+    for parent, conv_name, bn_name in pairs:
+        bn = getattr(parent, bn_name)
+        if isinstance(bn, nn.BatchNorm2d):
+            setattr(parent, conv_name, fuse_conv_bn(getattr(parent, conv_name), bn))
+            setattr(parent, bn_name, nn.Identity())
+    return model
+
+
 
 def resnet18(pretrained=False, **kwargs):
     """Constructs a ResNet-18 model.
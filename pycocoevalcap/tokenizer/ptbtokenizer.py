@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-# 
+#
 # File Name : ptbtokenizer.py
 #
 # Description : Do the PTB Tokenization and remove punctuations.
@@ -9,7 +9,9 @@
 # Authors : Hao Fang <hfang@uw.edu> and Tsung-Yi Lin <tl483@cornell.edu>
 
 import os
+import re
 import sys
+import shutil
 import subprocess
 import tempfile
 import itertools
@@ -19,22 +21,112 @@ STANFORD_CORENLP_3_4_1_JAR = 'stanford-corenlp-3.4.1.jar'
 
 # punctuations to be removed from the sentences
 PUNCTUATIONS = ["''", "'", "``", "`", "-LRB-", "-RRB-", "-LCB-", "-RCB-", \
-        ".", "?", "!", ",", ":", "-", "--", "...", ";"] 
+        ".", "?", "!", ",", ":", "-", "--", "...", ";"]
+
+# the titles the stanford tokenizer keeps with their period, as in mr. smith
+PTB_TITLES = {'mr', 'mrs', 'ms', 'dr', 'drs', 'prof', 'profs', 'sen', 'rep', 'gen', 'col', 'lt', 'capt', 'sgt', 'rev',
+              'gov', 'adm', 'maj', 'cpl', 'pvt', 'hon'}
+
+# the rewriting rules of the python backend, applied in order to a lower cased line. They follow the PTB conventions
+# of the stanford tokenizer: quotes become `` and '', brackets become -lrb- -rrb- -lsb- -rsb- -lcb- -rcb-,
+# punctuations and clitics are split from the words, hyphens and numbers such as 1,000 or 3.5 stay in the word
+PTB_RULES = [
+    # opening quotes
+    (re.compile(r'^"'), r' `` '),
+    (re.compile(r'([ (\[{<])"'), r'\1 `` '),
+    # punctuations
+    (re.compile(r'\.\.\.'), r' ... '),
+    (re.compile(r'([:,])([^\d])'), r' \1 \2'),
+    (re.compile(r'([:,])$'), r' \1 '),
+    (re.compile(r'[;@#$%&?!]'), r' \g<0> '),
+    # a final period is split from the word, an abbreviation such as u.s. or a title such as mr. keeps it
+    (re.compile(r'(\S*[^.\s])\.(?=[\])}>"\']*\s)'),
+     lambda m: m.group(0) if re.match(r'^(?:[a-z]\.)+[a-z]$', m.group(1)) or m.group(1) in PTB_TITLES
+     else m.group(1) + ' . '),
+    (re.compile(r'--'), r' -- '),
+    (re.compile(r'(^|\s)-(?=\s|$)'), r'\1 - '),
+    # brackets, lower cased as the jar does with -lowerCase, so they are not in PUNCTUATIONS either
+    (re.compile(r'\('), r' -lrb- '),
+    (re.compile(r'\)'), r' -rrb- '),
+    (re.compile(r'\['), r' -lsb- '),
+    (re.compile(r'\]'), r' -rsb- '),
+    (re.compile(r'\{'), r' -lcb- '),
+    (re.compile(r'\}'), r' -rcb- '),
+    # closing quotes
+    (re.compile(r'"'), r" '' "),
+    (re.compile(r"(\S)('')"), r'\1 \2 '),
+    # clitics
+    (re.compile(r"([^' ])('s|'m|'d|') "), r'\1 \2 '),
+    (re.compile(r"([^' ])('ll|'re|'ve|n't) "), r'\1 \2 '),
+    (re.compile(r"(?<=\s)(can)(not)(?=\s)"), r'\1 \2'),
+    (re.compile(r"(?<=\s)(gon|wan|got)(na|ta)(?=\s)"), r'\1 \2'),
+    (re.compile(r"^'(?=\S)"), r"' "),
+    (re.compile(r"(\s)'(?=[^\s'])(?!s |m |d |ll |re |ve )"), r"\1' "),
+]
+
+
+def ptb_tokenize_line(line):
+    '''
+    the in-process equivalent of the stanford PTBTokenizer with -lowerCase on one caption
+    :return: the list of tokens, punctuations included
+    '''
+    line = ' ' + line.lower() + ' '
+    for pattern, substitution in PTB_RULES:
+        line = pattern.sub(substitution, line)
+    return line.split()
+
 
 class PTBTokenizer:
-    """Python wrapper of Stanford PTBTokenizer"""
+    """Python wrapper of Stanford PTBTokenizer
 
-    def tokenize(self, captions_for_image):
-        cmd = ['java', '-cp', STANFORD_CORENLP_3_4_1_JAR, \
-                'edu.stanford.nlp.process.PTBTokenizer', \
-                '-preserveLines', '-lowerCase']
+    backend is 'java' to run the stanford jar, the default that keeps the
+    scores COCO-comparable, 'python' for the in-process ptb_tokenize_line, or
+    'auto' to use java only when it and the jar are available, with a warning
+    when it falls back to python.
+    """
 
+    def __init__(self, backend='java'):
+        if backend == 'auto':
+            path_to_jar = os.path.join(os.path.dirname(os.path.abspath(__file__)), STANFORD_CORENLP_3_4_1_JAR)
+            if shutil.which('java') is not None and os.path.isfile(path_to_jar):
+                backend = 'java'
+            else:
+                backend = 'python'
+                sys.stderr.write('PTBTokenizer: java or %s is not available, falling back to the python backend, '
+                                 'the scores may differ from the COCO evaluation\n' % STANFORD_CORENLP_3_4_1_JAR)
+        if backend not in ['java', 'python']:
+            raise ValueError('the tokenizer backend is java, python or auto')
+        self.backend = backend
+
+    def tokenize(self, captions_for_image):
         # ======================================================
         # prepare data for PTB Tokenizer
         # ======================================================
         final_tokenized_captions_for_image = {}
         image_id = [k for k, v in captions_for_image.items() for _ in range(len(v))]
-        sentences = '\n'.join([c['caption'].replace('\n', ' ') for k, v in captions_for_image.items() for c in v])
+        if self.backend == 'python':
+            lines = [' '.join(ptb_tokenize_line(c['caption'].replace('\n', ' ')))
+                     for k, v in captions_for_image.items() for c in v]
+        else:
+            sentences = '\n'.join([c['caption'].replace('\n', ' ') for k, v in captions_for_image.items() for c in v])
+            lines = self._tokenize_java(sentences)
+
+        # ======================================================
+        # create dictionary for tokenized captions
+        # ======================================================
+        for k, line in zip(image_id, lines):
+            if not k in final_tokenized_captions_for_image:
+                final_tokenized_captions_for_image[k] = []
+            tokenized_caption = ' '.join([w for w in line.rstrip().split(' ') \
+                    if w not in PUNCTUATIONS])
+            final_tokenized_captions_for_image[k].append(tokenized_caption)
+
+        return final_tokenized_captions_for_image
+
+    def _tokenize_java(self, sentences):
+        cmd = ['java', '-cp', STANFORD_CORENLP_3_4_1_JAR, \
+                'edu.stanford.nlp.process.PTBTokenizer', \
+                '-preserveLines', '-lowerCase']
 
         # ======================================================
         # save sentences to temporary file
@@ -54,15 +146,4 @@ class PTBTokenizer:
         lines = token_lines.decode().split('\n')
         # remove temp file
         os.remove(tmp_file.name)
-
-        # ======================================================
-        # create dictionary for tokenized captions
-        # ======================================================
-        for k, line in zip(image_id, lines):
-            if not k in final_tokenized_captions_for_image:
-                final_tokenized_captions_for_image[k] = []
-            tokenized_caption = ' '.join([w for w in line.rstrip().split(' ') \
-                    if w not in PUNCTUATIONS])
-            final_tokenized_captions_for_image[k].append(tokenized_caption)
-
-        return final_tokenized_captions_for_image
+        return lines
@@ -6,7 +6,8 @@ from dataset.dataloader import ImagecapDataset
 from models import aoamodel
 from models import adaptiveattention
 from models import gridTDmodel
-from models.metrics import BLEU, CIDEr, BERT, SPICE, ROUGE,METEOR
+from models import resnet
+from models.metrics import BLEU, CIDEr, BERT, SPICE, ROUGE, METEOR, MetricSuite
 import os
 import yaml
 def main(beam_search_type, args):
@@ -14,6 +15,8 @@ def main(beam_search_type, args):
 
     print(f'The arguments are')
     print(args)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
     word_map_path = f'./dataset/wordmap_{args.dataset}.json'
     word_map = json.load(open(word_map_path, 'r'))
 
@@ -26,7 +29,7 @@ def main(beam_search_type, args):
     ])
     print('==========Loading Data==========')
     val_data = ImagecapDataset(args.dataset, args.test_split, val_transform, )
-    val_loader = torch.utils.data.DataLoader(val_data, batch_size=1, shuffle=False, num_workers=args.workers,pin_memory=True)
+    val_loader = torch.utils.data.DataLoader(val_data, batch_size=1 if beam_search_type == 'dbs' else args.batch_size, shuffle=False, num_workers=args.workers,pin_memory=True)
     print(len(val_loader))
     print('==========Data Loaded==========')
     print('==========Setting Model==========')
@@ -39,11 +42,11 @@ def main(beam_search_type, args):
         model = aoamodel.AOAModel(args.embed_dim, args.hidden_dim, args.num_head, len(word_map), args.encoder)
     else:
         raise NotImplementedError(f'model_type {args.model_type} does not available yet')
-    model.cuda()
+    model.to(args.device)
 
     if args.weight:
         print(f'==========Resuming weights from {args.weight}==========')
-        checkpoint = torch.load(args.weight)
+        checkpoint = torch.load(args.weight, map_location=args.device)
         start_epoch = checkpoint['epoch']
         # epochs_since_improvement = checkpoint['epochs_since_improvement']
         # best_cider = checkpoint['cider']
@@ -53,6 +56,8 @@ def main(beam_search_type, args):
         start_epoch = 0
         epochs_since_improvement = 0
         best_cider = 0
+    model.eval()
+    resnet.fold_batchnorm(model.img_encoder.encoder)
     print(f'==========Start Testing==========')
     validate(val_loader, model, word_map, args, beam_search_type=beam_search_type, start_epoch=start_epoch)
 
@@ -67,55 +72,49 @@ def validate(val_loader, model, word_map, args, start_epoch, beam_search_type='d
         gt_save = {}
         image_id = 0
         for i, (imgs, allcaps, caplens, img_filenames) in enumerate(val_loader):
-            imgs = imgs.cuda()
+            imgs = imgs.to(model.device)
             if beam_search_type == 'dbs':
-                sentences = model.diverse_beam_search(imgs,  beam_size, word_map)
+                batch_sentences = [model.diverse_beam_search(imgs,  beam_size, word_map)]
             elif beam_search_type == 'beam_search':
-                sentences, _ = model.beam_search(imgs,  word_map, beam_size=beam_size)
+                sentences, _ = model.beam_search_batch(imgs,  word_map, beam_size=beam_size)
+                batch_sentences = [[sentence] for sentence in sentences]
             elif beam_search_type == 'greedy':
                 sentences, _ = model.greedy_search(imgs,  word_map)
+                batch_sentences = [[sentence] for sentence in sentences]
             else:
                 raise NotImplementedError(
                     'please specify the decoding method in [dbs, beam_search, greedy] in string type')
-            # assert len(sentences) == batch_size
-            img_filename = img_filenames[0]
-            if img_filename not in prediction_save.keys():
-                prediction_save[img_filename] = []
-                gt_save[img_filename] = []
-            for idx , sentence in enumerate(sentences):
-                if not image_id in hypotheses.keys():
-                    hypotheses[image_id] = []
-                    references[image_id] = []
-                hypotheses[image_id].append({'caption':sentence})
-                prediction_save[img_filename].append(sentence)
-                for ref_item in allcaps[0]:
-                    # print(ref_item)
-                    enc_ref = [w.item() for w in ref_item if w.item() not in {word_map['<start>'], word_map['<end>'], word_map['<pad>'], word_map['<unk>']}]
-                    ref = ' '.join([rev_word_map[enc_ref[i]] for i in range(len(enc_ref))])
-                    if ref not in gt_save[img_filename]:
-                        gt_save[img_filename].append(ref)
-                    references[image_id].append({'caption':ref})
-                image_id += 1
+            assert len(batch_sentences) == len(img_filenames)
+            for bs, sentences in enumerate(batch_sentences):
+                img_filename = img_filenames[bs]
+                if img_filename not in prediction_save.keys():
+                    prediction_save[img_filename] = []
+                    gt_save[img_filename] = []
+                for idx , sentence in enumerate(sentences):
+                    if not image_id in hypotheses.keys():
+                        hypotheses[image_id] = []
+                        references[image_id] = []
+                    hypotheses[image_id].append({'caption':sentence})
+                    prediction_save[img_filename].append(sentence)
+                    for ref_item in allcaps[bs]:
+                        # print(ref_item)
+                        enc_ref = [w.item() for w in ref_item if w.item() not in {word_map['<start>'], word_map['<end>'], word_map['<pad>'], word_map['<unk>']}]
+                        ref = ' '.join([rev_word_map[enc_ref[i]] for i in range(len(enc_ref))])
+                        if ref not in gt_save[img_filename]:
+                            gt_save[img_filename].append(ref)
+                        references[image_id].append({'caption':ref})
+                    image_id += 1
     # print(hypotheses)
     # print(references)
     results_dict = {}
     print("Calculating Evalaution Metric Scores......\n")
-    avg_bleu_dict = BLEU().calculate(hypotheses,references)
-    bleu4 = avg_bleu_dict['bleu_4']
-    avg_cider_dict = CIDEr().calculate(hypotheses, references)
-    cider = avg_cider_dict['cider']
-    avg_bert_dict = BERT().calculate(hypotheses,references)
-    bert = avg_bert_dict['bert']
-    avg_spice_dict = SPICE().calculate(hypotheses, references)
-    avg_rouge_dict = ROUGE().calculate(hypotheses,references)
-    avg_meteor_dict = METEOR().calculate(hypotheses, references)
-    print(f'Evaluatioin results, BLEU-4: {bleu4}, Cider: {cider}, SPICE: {avg_spice_dict["spice"]}, ROUGE: {avg_rouge_dict["rouge"]}')
-    results_dict.update(avg_bert_dict)
-    results_dict.update(avg_bleu_dict)
-    results_dict.update(avg_cider_dict)
-    results_dict.update(avg_rouge_dict)
-    results_dict.update(avg_spice_dict)
-    results_dict.update(avg_meteor_dict)
+    # the captions are tokenized once for all the metrics, which then run in parallel
+    metric_suite = MetricSuite([BLEU(), CIDEr(), BERT(), SPICE(), ROUGE(), METEOR()],
+                               num_workers=args.metric_workers, timeout=args.metric_timeout)
+    results_dict.update(metric_suite.calculate(hypotheses, references))
+    bleu4 = results_dict['bleu_4']
+    cider = results_dict['cider']
+    print(f'Evaluatioin results, BLEU-4: {bleu4}, Cider: {cider}, SPICE: {results_dict["spice"]}, ROUGE: {results_dict["rouge"]}')
 
 
     # write the predictions and ground truth to files
@@ -6,7 +6,7 @@ from dataset.dataloader import ImagecapDataset, ImagecapDatasetFromFeature
 from models import aoamodel
 from models import adaptiveattention
 from models import gridTDmodel
-from models.metrics import BLEU, CIDEr, BERT, SPICE, ROUGE,METEOR
+from models.metrics import BLEU, CIDEr, BERT, SPICE, ROUGE, METEOR, MetricSuite
 import os
 import yaml
 def main(beam_search_type, args):
@@ -14,6 +14,8 @@ def main(beam_search_type, args):
 
     print(f'The arguments are')
     print(args)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
     word_map_path = f'./dataset/wordmap_{args.dataset}.json'
     word_map = json.load(open(word_map_path, 'r'))
 
@@ -37,11 +39,11 @@ def main(beam_search_type, args):
         model = aoamodel.AOAModelBU(args.embed_dim, args.hidden_dim, args.num_head, len(word_map), args.encoder)
     else:
         raise NotImplementedError(f'model_type {args.model_type} does not available yet')
-    model.cuda()
+    model.to(args.device)
 
     if args.weight:
         print(f'==========Resuming weights from {args.weight}==========')
-        checkpoint = torch.load(args.weight)
+        checkpoint = torch.load(args.weight, map_location=args.device)
         start_epoch = checkpoint['epoch']
         # epochs_since_improvement = checkpoint['epochs_since_improvement']
         # best_cider = checkpoint['cider']
@@ -65,7 +67,7 @@ def validate(val_loader, model, word_map, args, start_epoch, beam_search_type='d
         gt_save = {}
         image_id = 0
         for i, (imgs, allcaps, caplens, img_filenames) in enumerate(val_loader):
-            imgs = imgs.cuda()
+            imgs = imgs.to(model.device)
             if beam_search_type == 'dbs':
                 sentences = model.diverse_beam_search(imgs,  beam_size, word_map)
             elif beam_search_type == 'beam_search':
@@ -99,22 +101,13 @@ def validate(val_loader, model, word_map, args, start_epoch, beam_search_type='d
     # print(references)
     results_dict = {}
     print("Calculating Evalaution Metric Scores......\n")
-    avg_bleu_dict = BLEU().calculate(hypotheses,references)
-    bleu4 = avg_bleu_dict['bleu_4']
-    avg_cider_dict = CIDEr().calculate(hypotheses, references)
-    cider = avg_cider_dict['cider']
-    avg_bert_dict = BERT().calculate(hypotheses,references)
-    bert = avg_bert_dict['bert']
-    avg_spice_dict = SPICE().calculate(hypotheses, references)
-    avg_rouge_dict = ROUGE().calculate(hypotheses,references)
-    avg_meteor_dict = METEOR().calculate(hypotheses, references)
-    print(f'Evaluatioin results, BLEU-4: {bleu4}, Cider: {cider}, SPICE: {avg_spice_dict["spice"]}, ROUGE: {avg_rouge_dict["rouge"]}')
-    results_dict.update(avg_bert_dict)
-    results_dict.update(avg_bleu_dict)
-    results_dict.update(avg_cider_dict)
-    results_dict.update(avg_rouge_dict)
-    results_dict.update(avg_spice_dict)
-    results_dict.update(avg_meteor_dict)
+    # the captions are tokenized once for all the metrics, which then run in parallel
+    metric_suite = MetricSuite([BLEU(), CIDEr(), BERT(), SPICE(), ROUGE(), METEOR()],
+                               num_workers=args.metric_workers, timeout=args.metric_timeout)
+    results_dict.update(metric_suite.calculate(hypotheses, references))
+    bleu4 = results_dict['bleu_4']
+    cider = results_dict['cider']
+    print(f'Evaluatioin results, BLEU-4: {bleu4}, Cider: {cider}, SPICE: {results_dict["spice"]}, ROUGE: {results_dict["rouge"]}')
 
 
     # write the predictions and ground truth to files
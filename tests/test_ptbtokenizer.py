@@ -0,0 +1,78 @@
+'''
+parity of the python PTBTokenizer backend with the stanford CoreNLP 3.4.1 jar run with -preserveLines -lowerCase.
+the fixture holds the raw lines of the jar, python tests/test_ptbtokenizer.py regenerates them with java and the jar
+'''
+import os
+import sys
+import json
+import shutil
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pycocoevalcap.tokenizer import ptbtokenizer
+from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer, ptb_tokenize_line
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'ptb_corenlp_3.4.1_lowercase.json')
+CASES = json.load(open(FIXTURE, 'r'))
+
+# the sentences on which the python backend is known to differ from the jar
+KNOWN_DIVERGENCES = {
+    'A man walks down Main St. with a dog.': 'abbreviations other than the titles lose their period',
+    'A man walks down Main St.': 'abbreviations other than the titles lose their period',
+    'Dogs, cats, birds, etc. are in the yard.': 'abbreviations other than the titles lose their period',
+    'A store owned by Acme Inc. sells toys.': 'abbreviations other than the titles lose their period',
+    'A flag of the U.S.': 'the jar adds a final period after an abbreviation that ends the line',
+    "A rock 'n' roll band plays on stage.": "'n' is split into quotes",
+    "A sign reads 'hello' in red letters.": 'an opening single quote is not rewritten to `',
+    'A DOG RUNS FAST!!': 'repeated punctuations are split',
+    "Children play with y'all and ma'am.": "y'all is not split",
+}
+
+
+def jvm_available():
+    path_to_jar = os.path.join(os.path.dirname(os.path.abspath(ptbtokenizer.__file__)),
+                               ptbtokenizer.STANFORD_CORENLP_3_4_1_JAR)
+    return shutil.which('java') is not None and os.path.isfile(path_to_jar)
+
+
+def jvm_lines(sentences):
+    lines = PTBTokenizer('java')._tokenize_java('\n'.join(sentences))
+    return [line.rstrip() for line in lines[:len(sentences)]]
+
+
+def parity_case(case):
+    reason = KNOWN_DIVERGENCES.get(case['sentence'])
+    if reason is None:
+        return case
+    return pytest.param(case, marks=pytest.mark.xfail(reason=reason, strict=True))
+
+
+@pytest.mark.parametrize('case', [parity_case(case) for case in CASES], ids=[case['sentence'] for case in CASES])
+def test_python_backend_matches_jvm_output(case):
+    assert ' '.join(ptb_tokenize_line(case['sentence'])) == case['tokenized']
+
+
+def test_known_divergences_are_in_fixture():
+    assert set(KNOWN_DIVERGENCES) <= set(case['sentence'] for case in CASES)
+
+
+@pytest.mark.skipif(not jvm_available(), reason='java or the stanford corenlp jar is not available')
+def test_fixture_matches_jvm():
+    assert jvm_lines([case['sentence'] for case in CASES]) == [case['tokenized'] for case in CASES]
+
+
+def test_tokenize_removes_punctuations_with_python_backend():
+    cases = [case for case in CASES if case['sentence'] not in KNOWN_DIVERGENCES]
+    captions = {0: [{'caption': case['sentence']} for case in cases]}
+    tokenized = PTBTokenizer('python').tokenize(captions)[0]
+    expected = [' '.join(w for w in case['tokenized'].split(' ') if w not in ptbtokenizer.PUNCTUATIONS)
+                for case in cases]
+    assert tokenized == expected
+
+
+if __name__ == '__main__':
+    # rewrites the tokenized lines of the fixture with the output of the jar
+    assert jvm_available(), 'java and the stanford corenlp jar are needed to regenerate the fixture'
+    sentences = [case['sentence'] for case in CASES]
+    with open(FIXTURE, 'w') as f:
+        json.dump([{'sentence': s, 'tokenized': t} for s, t in zip(sentences, jvm_lines(sentences))], f, indent=1)
@@ -7,13 +7,16 @@ from models import adaptiveattention
 from models import gridTDmodel
 from models import aoamodel
 import models.modelutils as mutils
-from models.metrics import BLEU, CIDEr, SPICE, ROUGE
+from models.metrics import BLEU, CIDEr, SPICE, ROUGE, MetricSuite
 import os
 import glob
+from functools import partial
 
 def main(args):
     print(f'The arguments are')
     print(args)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
     print(f'model_type is {args.model_type}')
     word_map_path = f'./dataset/wordmap_{args.dataset}.json'
     word_map = json.load(open(word_map_path, 'r'))
@@ -40,7 +43,7 @@ def main(args):
     train_loader = torch.utils.data.DataLoader(train_data, batch_size=args.batch_size, shuffle=True,
                                               num_workers=args.workers, pin_memory=True, sampler=None)
     print(len(train_loader))
-    val_loader = torch.utils.data.DataLoader(val_data, batch_size=1, shuffle=False, num_workers=args.workers,
+    val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
                                              pin_memory=True)
     print(len(val_loader))
     print('==========Data Loaded==========')
@@ -78,11 +81,11 @@ def main(args):
                               {'params': model.fc.parameters()}]
     else:
         raise NotImplementedError(f'model_type {args.model_type} does not available yet')
-    model.cuda()
+    model.to(args.device)
 
     if args.resume:
         print(f'==========Resuming weights from {args.resume}==========')
-        checkpoint = torch.load(args.resume)
+        checkpoint = torch.load(args.resume, map_location=args.device)
         start_epoch = checkpoint['epoch'] + 1
         epochs_since_improvement = checkpoint['epochs_since_improvement']
         best_cider = checkpoint['cider']
@@ -110,6 +113,17 @@ def main(args):
 
 
     print(f'==========Start Training==========')
+    # the tokenized validation references are kept across the epochs
+    metric_suite = MetricSuite([BLEU(), CIDEr(), SPICE(), ROUGE()], num_workers=args.metric_workers,
+                               timeout=args.metric_timeout)
+    # the cider rewards take the document frequency of the training references, counted once and kept on disk
+    cider_engine = None
+    if args.cider_tune or args.lrp_cider_tune:
+        cider_df = args.cider_df if args.cider_df else f'./dataset/cider_df_{args.dataset}.npz'
+        if not os.path.isfile(cider_df):
+            print(f'==========Building the cider document frequency {cider_df}==========')
+            mutils.build_cider_document_frequency(train_data.data, word_map, cider_df)
+        cider_engine = mutils.TokenCiderD(word_map, document_frequency=cider_df)
     for epoch in range(start_epoch, args.epochs):
         # if args.model_type == 'aoa':
         #     if epoch > 0 and (epoch)%3==0:
@@ -119,25 +133,26 @@ def main(args):
             epochs_since_improvement = 0
         if args.cider_tune:
             print(f'==========Training with Cider Optm==========')
-            criterion = mutils.RewardCriterion().cuda()
-            train_func = traincider
+            criterion = mutils.RewardCriterion().to(model.device)
+            train_func = partial(traincider, cider_engine=cider_engine)
         elif args.lrp_tune:
             print(f'==========Training with lrp Optm==========')
-            criterion = torch.nn.CrossEntropyLoss(ignore_index=word_map['<pad>']).cuda()
+            criterion = torch.nn.CrossEntropyLoss(ignore_index=word_map['<pad>']).to(model.device)
             train_func = train_lrp
         elif args.lrp_cider_tune:
             print(f'==========Training with lrp cider Optm==========')
-            criterion = mutils.RewardCriterion().cuda()
-            train_func = trainciderlrp
+            criterion = mutils.RewardCriterion().to(model.device)
+            train_func = partial(trainciderlrp, cider_engine=cider_engine)
         else:
             print(f'==========Training ==========')
-            criterion = torch.nn.CrossEntropyLoss(ignore_index=word_map['<pad>']).cuda()
+            criterion = torch.nn.CrossEntropyLoss(ignore_index=word_map['<pad>']).to(model.device)
             train_func = train
             # args.ss_prob = args.ss_prob + (epoch //10) * 0.03
             # print(f'Traning with ss_prob {args.ss_prob}')
         train_func(train_loader, model, criterion, optimizer, epoch, args.ss_prob, word_map, args.print_freq, args.grad_clip)
 
-        bleu, cider = validate(val_loader,model, word_map, 3, epoch, beam_search_type='beam_search')
+        bleu, cider = validate(val_loader,model, word_map, 3, epoch, beam_search_type='beam_search',
+                               metric_suite=metric_suite)
         is_best = cider > best_cider
         best_cider = max(cider, best_cider)
         if not is_best:
@@ -156,8 +171,8 @@ def train(train_loader, model, criterion, optimizer, epoch, ss_prob, word_map, p
     losses = mutils.AverageMeter()         # loss (per decoded word)
     top5accs = mutils.AverageMeter()       # top5 accuracy
     for i, (imgs, caps, all_caps, caplens) in enumerate(train_loader):
-        imgs = imgs.cuda()
-        caps = caps.cuda()
+        imgs = imgs.to(model.device)
+        caps = caps.to(model.device)
         predictions, alphas, betas, _, max_length = model(imgs,caps, caplens, ss_prob)
         targets = caps[:, 1:max_length+1]
         scores = predictions.contiguous().view(-1, predictions.size(2))
@@ -179,19 +194,21 @@ def train(train_loader, model, criterion, optimizer, epoch, ss_prob, word_map, p
                                                                             top5=top5accs))
 
 
-def traincider(train_loader, model, criterion, optimizer, epoch, ss_prob, word_map, print_freq, grad_clip):
+def traincider(train_loader, model, criterion, optimizer, epoch, ss_prob, word_map, print_freq, grad_clip,
+               cider_engine=None):
     model.train()
     losses = mutils.AverageMeter()  # loss (per decoded word)
     rewards = mutils.AverageMeter()
     for i, (imgs, caps, all_caps, caplens) in enumerate(train_loader):
-        imgs = imgs.cuda()
+        imgs = imgs.to(model.device)
         model.eval()
         with torch.no_grad():
             greedy_res , _, _ = model.sample(imgs, word_map, caplens)
         model.train()
         gen_result, sample_logprobs, max_length = model.sample(imgs, word_map, caplens, opt={'sample_method':'sample'})
-        reward = mutils.get_self_critical_reward(greedy_res, all_caps, gen_result, word_map, cider_reward_weight=1., bleu_reward_weight=0)
-        reward = torch.from_numpy(reward).float().cuda()
+        reward = mutils.get_self_critical_reward(greedy_res, all_caps, gen_result, word_map, cider_reward_weight=1., bleu_reward_weight=0,
+                                                 cider_engine=cider_engine)
+        reward = torch.from_numpy(reward).to(model.device, model.dtype)
         loss = criterion(sample_logprobs, gen_result.data, reward)
         optimizer.zero_grad()
         loss.backward()
@@ -214,8 +231,8 @@ def train_lrp(train_loader, model, criterion, optimizer, epoch, ss_prob, word_ma
     top5accs = mutils.AverageMeter()       # top5 accuracy
     rev_word_map = {v: k for k, v in word_map.items()}
     for i, (imgs, caps, all_caps, caplens) in enumerate(train_loader):
-        imgs = imgs.cuda()
-        caps = caps.cuda()
+        imgs = imgs.to(model.device)
+        caps = caps.to(model.device)
         predictions, weighted_predictions, max_length = model.forwardlrp_context(imgs,caps, caplens, rev_word_map)
         scores = predictions.contiguous().view(-1, predictions.size(2))
         targets = caps[:, 1:max_length + 1]
@@ -249,20 +266,22 @@ def train_lrp(train_loader, model, criterion, optimizer, epoch, ss_prob, word_ma
             # torch.save(state, os.path.join('/home/sunjiamei/work/ImageCaptioning/ImgCaptioningPytorch/output/gridTD/vgg16/flickr30k/lrpfinetune/', filename))
 
 
-def trainciderlrp(train_loader, model, criterion, optimizer, epoch, ss_prob, word_map, print_freq, grad_clip):
+def trainciderlrp(train_loader, model, criterion, optimizer, epoch, ss_prob, word_map, print_freq, grad_clip,
+                  cider_engine=None):
     model.train()
     losses = mutils.AverageMeter()  # loss (per decoded word)
     rewards = mutils.AverageMeter()
     rev_word_map = {v: k for k, v in word_map.items()}
     for i, (imgs, caps, all_caps, caplens) in enumerate(train_loader):
-        imgs = imgs.cuda()
+        imgs = imgs.to(model.device)
         model.eval()
         with torch.no_grad():
             greedy_res , _, _ = model.sample(imgs, word_map, caplens)
         model.train()
         gen_result, sample_logprobs, max_length = model.sample_lrp(imgs, rev_word_map, word_map, caplens, opt={'sample_method':'sample'})
-        reward = mutils.get_self_critical_reward(greedy_res, all_caps, gen_result, word_map, cider_reward_weight=1., bleu_reward_weight=0)
-        reward = torch.from_numpy(reward).float().cuda()
+        reward = mutils.get_self_critical_reward(greedy_res, all_caps, gen_result, word_map, cider_reward_weight=1., bleu_reward_weight=0,
+                                                 cider_engine=cider_engine)
+        reward = torch.from_numpy(reward).to(model.device, model.dtype)
         loss = criterion(sample_logprobs, gen_result.data, reward)
         optimizer.zero_grad()
         loss.backward()
@@ -285,7 +304,8 @@ def trainciderlrp(train_loader, model, criterion, optimizer, epoch, ss_prob, wor
             torch.save(state, os.path.join('/home/sunjiamei/work/ImageCaptioning/ImgCaptioningPytorch/output/gridTD/vgg16/flickr30k/lrpciderfinetune/', filename))
 
 
-def validate(val_loader, model, word_map, beam_size, epoch, beam_search_type='greedy'):
+def validate(val_loader, model, word_map, beam_size, epoch, beam_search_type='greedy', metric_suite=None,
+             metric_workers=4, metric_timeout=None):
     model.eval()
     rev_word_map = {v: k for k, v in word_map.items()}
     with torch.no_grad():
@@ -295,45 +315,48 @@ def validate(val_loader, model, word_map, beam_size, epoch, beam_search_type='gr
         gt_save = {}
         image_id = 0
         for i, (imgs, allcaps, caplens, img_filenames) in enumerate(val_loader):
-            imgs = imgs.cuda()
+            imgs = imgs.to(model.device)
             if beam_search_type == 'dbs':
-                sentences = model.diverse_beam_search(imgs,  beam_size, word_map)
+                batch_sentences = [model.diverse_beam_search(imgs,  beam_size, word_map)]
             elif beam_search_type == 'beam_search':
-                sentences, _ = model.beam_search(imgs,  word_map, beam_size=beam_size)
+                sentences, _ = model.beam_search_batch(imgs,  word_map, beam_size=beam_size)
+                batch_sentences = [[sentence] for sentence in sentences]
             elif beam_search_type == 'greedy':
                 sentences, _ = model.greedy_search(imgs,  word_map)
+                batch_sentences = [[sentence] for sentence in sentences]
             else:
                 raise NotImplementedError(
                     'please specify the decoding method in [dbs, beam_search, greedy] in string type')
-            # assert len(sentences) == batch_size
-            img_filename = img_filenames[0]
-            if img_filename not in prediction_save.keys():
-                prediction_save[img_filename] = []
-                gt_save[img_filename] = []
-            for idx , sentence in enumerate(sentences):
-                if not image_id in hypotheses.keys():
-                    hypotheses[image_id] = []
-                    references[image_id] = []
-                hypotheses[image_id].append({'caption':sentence})
-                prediction_save[img_filename].append(sentence)
-                for ref_item in allcaps[0]:
-                    # print(ref_item)
-                    enc_ref = [w.item() for w in ref_item if w.item() not in {word_map['<start>'], word_map['<end>'], word_map['<pad>'], word_map['<unk>']}]
-                    ref = ' '.join([rev_word_map[enc_ref[i]] for i in range(len(enc_ref))])
-                    if ref not in gt_save[img_filename]:
-                        gt_save[img_filename].append(ref)
-                    references[image_id].append({'caption':ref})
-                image_id += 1
+            assert len(batch_sentences) == len(img_filenames)
+            for bs, sentences in enumerate(batch_sentences):
+                img_filename = img_filenames[bs]
+                if img_filename not in prediction_save.keys():
+                    prediction_save[img_filename] = []
+                    gt_save[img_filename] = []
+                for idx , sentence in enumerate(sentences):
+                    if not image_id in hypotheses.keys():
+                        hypotheses[image_id] = []
+                        references[image_id] = []
+                    hypotheses[image_id].append({'caption':sentence})
+                    prediction_save[img_filename].append(sentence)
+                    for ref_item in allcaps[bs]:
+                        # print(ref_item)
+                        enc_ref = [w.item() for w in ref_item if w.item() not in {word_map['<start>'], word_map['<end>'], word_map['<pad>'], word_map['<unk>']}]
+                        ref = ' '.join([rev_word_map[enc_ref[i]] for i in range(len(enc_ref))])
+                        if ref not in gt_save[img_filename]:
+                            gt_save[img_filename].append(ref)
+                        references[image_id].append({'caption':ref})
+                    image_id += 1
     # print(hypotheses)
     print("Calculating Evalaution Metric Scores......\n")
-    avg_bleu_dict = BLEU().calculate(hypotheses,references)
-    bleu4 = avg_bleu_dict['bleu_4']
-    avg_cider_dict = CIDEr().calculate(hypotheses, references)
-    cider = avg_cider_dict['cider']
-    avg_spice_dict = SPICE().calculate(hypotheses, references)
-    avg_rouge_dict = ROUGE().calculate(hypotheses,references)
+    if metric_suite is None:
+        metric_suite = MetricSuite([BLEU(), CIDEr(), SPICE(), ROUGE()], num_workers=metric_workers,
+                                   timeout=metric_timeout)
+    results_dict = metric_suite.calculate(hypotheses, references, split='val')
+    bleu4 = results_dict['bleu_4']
+    cider = results_dict['cider']
 
-    print(f'Evaluatioin results at Epoch {epoch}, BLEU-4: {bleu4}, Cider: {cider}, SPICE: {avg_spice_dict["spice"]}, ROUGE: {avg_rouge_dict["rouge"]}')
+    print(f'Evaluatioin results at Epoch {epoch}, BLEU-4: {bleu4}, Cider: {cider}, SPICE: {results_dict["spice"]}, ROUGE: {results_dict["rouge"]}')
     return bleu4, cider
 
 